@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from queue import Queue as ThreadQueue
+from threading import Lock, Thread
+from typing import Optional, List
+
+import paho.mqtt.client as mqtt
+
+from logging_util import setup_logger
+from song_service import (SongService, RequestIntake, Request, new_mqtt_client, get_config, RECEIVE_QUEUE_MAX_SIZE,
+                          RECONNECT_MIN_DELAY_SECS, RECONNECT_MAX_DELAY_SECS, PLAY_NEXT)
+from startup_timing import startup_timer
+
+# How often paho's keepalive and retry handling runs. Done by loop_forever in the receiver process otherwise.
+MQTT_HOUSEKEEPING_INTERVAL_SECS = 1
+
+# The receive queue is only a soft limit here. Once it's reached, the MQTT socket stops being read until the
+#  downloaders catch up, which holds back the broker. A message that was already read (e.g. a long playlist) may still
+#  overshoot it, up to this hard limit, after which the rest of it is shed.
+RECEIVE_QUEUE_SHED_SIZE = 2 * RECEIVE_QUEUE_MAX_SIZE
+
+# How long shutting down waits for the event loop before giving up on it.
+LOOP_STOP_TIMEOUT_SECS = 5
+
+
+class _Counter:
+    """Stands in for a multiprocessing Value where the counter is only shared between threads."""
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def get_lock(self) -> Lock:
+        return self._lock
+
+
+class AsyncSongService(SongService):
+    """A SongService that doesn't fork. The MQTT client runs on an asyncio event loop in a background thread, and
+    downloads run in a thread pool, taking requests straight from the scheduler and handing their results over through
+    a thread-safe queue instead of pickling them between processes. Saves the memory of two extra interpreters, at the
+    cost of the downloads sharing this process's CPU time. Terminating the service waits for downloads that are
+    underway to finish."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread: Optional[Thread] = None
+        self._executor = ThreadPoolExecutor(self._download_workers, thread_name_prefix="download")
+        self._tasks: List[asyncio.Task] = []
+
+        self._intake: Optional[RequestIntake] = None
+        self._client: Optional[mqtt.Client] = None
+        self._socket = None
+        self._reading_paused = False
+
+    def _new_queue(self) -> ThreadQueue:
+        return ThreadQueue()
+
+    def _new_counter(self, typecode: str) -> _Counter:
+        return _Counter()
+
+    def _start_workers(self) -> None:
+        self._loop_thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_on_loop(), self._loop).result()
+        startup_timer.mark("receiver and downloaders started")
+
+    async def _start_on_loop(self) -> None:
+        message_logger = setup_logger("messages", "messages.log")
+        dl_logger = setup_logger("download", "download.log")
+        self._intake = RequestIntake(self._queue_request, self._next_sequence_number, self._duplicates_suppressed,
+                                     self._requests_shed, message_logger, self._playable_extensions)
+
+        # Instead of paho running its own network loop, the event loop tells it when its socket is ready.
+        self._client = new_mqtt_client(self._intake.handle_message, message_logger)
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = lambda client, _, sock: self._loop.add_writer(sock, client.loop_write)
+        self._client.on_socket_unregister_write = lambda client, _, sock: self._loop.remove_writer(sock)
+
+        for _ in range(self._download_workers):
+            self._executor.submit(self._download_forever, dl_logger)
+        self._tasks = [self._loop.create_task(self._stay_connected(message_logger))]
+
+    def _on_socket_open(self, client: mqtt.Client, user_data, sock) -> None:
+        self._socket = sock
+        self._reading_paused = False
+        self._loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, client: mqtt.Client, user_data, sock) -> None:
+        self._loop.remove_reader(sock)
+        self._socket = None
+
+    async def _stay_connected(self, message_logger: Logger) -> None:
+        delay = RECONNECT_MIN_DELAY_SECS
+        while True:
+            try:
+                self._client.connect(get_config().host, get_config().port)
+                delay = RECONNECT_MIN_DELAY_SECS
+                while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:  # Until the connection is lost.
+                    await asyncio.sleep(MQTT_HOUSEKEEPING_INTERVAL_SECS)
+            except OSError as e:
+                message_logger.warning(f"Could not contact the MQTT server: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY_SECS)
+
+    def _queue_request(self, request: Request, cached: bool, deadline: float) -> bool:
+        """Runs on the event loop, so must never wait. See RECEIVE_QUEUE_SHED_SIZE."""
+        if cached:  # No need to involve the downloaders.
+            self._downloaded_queue.put(request)
+            return True
+        if request[0] != PLAY_NEXT and len(self._scheduler) >= RECEIVE_QUEUE_SHED_SIZE:
+            return False
+        self._scheduler.add(request)
+        if not self._scheduler.has_room() and self._socket is not None and not self._reading_paused:
+            self._loop.remove_reader(self._socket)
+            self._reading_paused = True
+        return True
+
+    def _resume_reading_if_caught_up(self) -> None:
+        if self._reading_paused and self._socket is not None and self._scheduler.has_room():
+            self._loop.add_reader(self._socket, self._client.loop_read)
+            self._reading_paused = False
+
+    def _download_forever(self, dl_logger: Logger) -> None:
+        """Runs on a thread of the pool until the service is stopped."""
+        downloader = self._new_downloader()
+        try:
+            downloader.warm_up()
+        except Exception as e:  # Tried again by the first download, which fails (and is retried) if it still can't.
+            dl_logger.warning(f"Could not warm up the downloader: {e}")
+        while True:
+            request = self._scheduler.take()
+            if request is None:
+                return
+            self._loop.call_soon_threadsafe(self._resume_reading_if_caught_up)
+            try:
+                succeeded = self._download(request, downloader, dl_logger, self._peer_holders(request[1]))
+            except Exception as e:
+                # Unlike a downloader process, nothing would replace this worker if it died.
+                dl_logger.warning(f"Unknown exception: {e}")
+                self._report_lost(request, f"Unknown exception: {e}")
+                succeeded = False
+            finally:
+                self._scheduler.done(request)
+            if not succeeded:
+                self._loop.call_soon_threadsafe(self._intake.forget, request[1])
+
+    def _stop_workers(self) -> None:
+        async def stop() -> None:
+            for task in self._tasks:
+                task.cancel()
+            if self._client is not None:
+                self._client.disconnect()
+                self._client.loop_write()  # Sends the disconnect, since nothing will be watching the socket anymore.
+
+        self._scheduler.close()
+        if self._loop_thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result(LOOP_STOP_TIMEOUT_SECS)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join(LOOP_STOP_TIMEOUT_SECS)
+        self._executor.shutdown(wait=True)  # Nothing may be writing songs once the service is terminated.
@@ -0,0 +1,51 @@
+import json
+import sys
+from argparse import ArgumentParser
+
+from bench.benchmarks import BenchParameters, BENCHMARKS, run_benchmarks, compare
+
+DEFAULTS = BenchParameters()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="python -m bench",
+                            description="Benchmarks the player and service against a fake broker, downloader and "
+                                        "mpg123. Nothing leaves the machine.")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help=f"Which benchmarks to run. Defaults to all of them: {', '.join(BENCHMARKS)}.")
+    parser.add_argument("-o", "--output", help="Where to write the results as JSON. Defaults to STDOUT.")
+    parser.add_argument("--baseline", help="Results from an earlier run to compare against.")
+    parser.add_argument("--max-regression", type=float,
+                        help="With --baseline, exits with an error if any median got worse by more than this many "
+                             "percent.")
+    parser.add_argument("-s", "--samples", type=int, default=DEFAULTS.samples,
+                        help="How many times each latency is measured.")
+    parser.add_argument("-l", "--download-latency", type=float, default=DEFAULTS.download_latency_secs,
+                        help="How many seconds each fake download takes.")
+    parser.add_argument("-w", "--download-workers", type=int, default=DEFAULTS.download_workers)
+    parser.add_argument("-b", "--burst-size", type=int, default=DEFAULTS.burst_size,
+                        help="How many songs are requested at once when measuring throughput.")
+    parser.add_argument("-a", "--async-service", action="store_true",
+                        help="Benchmarks the asyncio based service instead of the multiprocess one.")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+
+    parameters = BenchParameters(args.samples, args.download_latency, args.download_workers, args.burst_size,
+                                 args.async_service)
+    results = run_benchmarks(parameters, args.benchmarks)
+
+    serialized = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(serialized + "\n")
+    else:
+        print(serialized)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            changes = compare(results, json.load(file))
+        for name, change in changes.items():
+            print(f"{name}: {change:+.1%}", file=sys.stderr)
+        if args.max_regression is not None and any(change * 100 > args.max_regression for change in changes.values()):
+            sys.exit("Performance regressed past the allowed amount.")
@@ -0,0 +1,521 @@
+from __future__ import annotations
+
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import count
+from pathlib import Path
+from threading import Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Iterator, NamedTuple, Optional, Any, Tuple
+
+from bench.fake_broker import FakeBroker
+from bench.fake_downloader import make_fake_downloader, FAKE_SONG_CONTENTS
+from logging_util import LOG_BATCH_WINDOW_SECS
+
+REPO_PATH = Path(__file__).parent.parent.absolute()
+FAKE_MPG123_PATH = Path(__file__).parent / "fake_mpg123.py"
+
+# Bumped whenever the layout of the results changes, so that results from different versions aren't compared blindly.
+RESULTS_SCHEMA_VERSION = 1
+
+# How often conditions are polled while timing. Low enough to not dominate the millisecond scale latencies measured.
+POLL_SECS = 0.001
+# How long anything is waited on before the run is considered broken.
+WAIT_TIMEOUT_SECS = 30
+# Long enough that no song finishes by itself while it's being skipped or paused.
+LONG_SONG_SECS = 600
+# How far into a song to get before skipping it, so that the new song is recognizable by its lower frame number.
+SKIP_AFTER_FRAMES = 5
+# The background input that controls are timed under: this many threads, each posting a volume change this often.
+#  Far more than any knob or buttons produce.
+LOAD_THREADS = 4
+LOAD_COMMAND_INTERVAL_SECS = 0.005
+# How many songs are queued up when timing edits to the play queue. A long party's worth.
+PARTY_BACKLOG_SIZE = 50_000
+
+
+class BenchParameters(NamedTuple):
+    samples: int = 20
+    download_latency_secs: float = 0.2
+    download_workers: int = 2
+    burst_size: int = 50
+    async_service: bool = False
+
+
+Summary = Dict[str, float]
+Metrics = Dict[str, Summary]
+
+
+def summarize(samples: List[float]) -> Summary:
+    ordered = sorted(samples)
+    return {"count": len(ordered),
+            "min": ordered[0],
+            "mean": statistics.mean(ordered),
+            "median": statistics.median(ordered),
+            "p95": ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))],
+            "max": ordered[-1]}
+
+
+def wait_until(condition: Callable[[], bool], timeout: float = WAIT_TIMEOUT_SECS) -> None:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            raise TimeoutError("Gave up waiting while benchmarking.")
+        sleep(POLL_SECS)
+
+
+class BenchSession:
+    """Runs the real service and player against local stand-ins: the fake broker, the fake downloader and the fake
+    mpg123. Everything happens in a temporary directory, which is also where the service's logs go."""
+    def __init__(self, parameters: BenchParameters):
+        self.parameters = parameters
+        self.broker = FakeBroker()
+        self._scenario_numbers = count()
+        self._workdir = Path(tempfile.mkdtemp(prefix="music_pi_bench_"))
+
+    @contextmanager
+    def running(self) -> Iterator[BenchSession]:
+        original_cwd, original_path = os.getcwd(), os.environ.get("PATH", "")
+        shim_directory = self._workdir / "bin"
+        shim_directory.mkdir()
+        shim = shim_directory / "mpg123"
+        shim.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_MPG123_PATH}" "$@"\n')
+        shim.chmod(0o755)
+
+        self.broker.start()
+        try:
+            os.environ["PATH"] = f"{shim_directory}{os.pathsep}{original_path}"
+            os.chdir(self._workdir)  # Where the logs go.
+            yield self
+        finally:
+            os.chdir(original_cwd)
+            os.environ["PATH"] = original_path
+            self.broker.stop()
+            sleep(LOG_BATCH_WINDOW_SECS * 2)  # Lets the last of the service's logs be written before they're deleted.
+            shutil.rmtree(self._workdir, ignore_errors=True)
+
+    @contextmanager
+    def scenario(self, song_secs: float = LONG_SONG_SECS) -> Iterator[str]:
+        """Points the service at a fresh download directory, history and topic. Yields the topic."""
+        import song_service
+        from broker_config import Config
+        number = next(self._scenario_numbers)
+        directory = self._workdir / f"scenario_{number}"
+        directory.mkdir()
+        topic = f"bench/{number}"
+
+        patches = {"CONFIG": Config(self.broker.host, self.broker.port, "bench", "bench", topic, tls=False,
+                                    persistent_session=False),
+                   "DOWNLOAD_DIRECTORY": directory / "download",
+                   "HISTORY_PATH": directory / "song_history.idx",
+                   "YoutubeDownloader": make_fake_downloader(self.parameters.download_latency_secs)}
+        originals = {name: getattr(song_service, name) for name in patches}
+        os.environ["FAKE_MPG123_SONG_SECS"] = str(song_secs)
+        for name, value in patches.items():
+            setattr(song_service, name, value)
+        try:
+            yield topic
+        finally:
+            for name, value in originals.items():
+                setattr(song_service, name, value)
+
+    def new_service(self, **options):
+        from song_service import SongService
+        from async_song_service import AsyncSongService
+        service_type = AsyncSongService if self.parameters.async_service else SongService
+        return service_type(self.parameters.download_workers, **options)
+
+    def fake_song(self) -> str:
+        path = self._workdir / "fake_song.mp3"
+        path.write_bytes(FAKE_SONG_CONTENTS)
+        return str(path)
+
+
+def fake_youtube_id(n: int) -> str:
+    return f"bench{n:06d}"
+
+
+def _bench_startups(session: BenchSession, fast_start: bool,
+                    transcode: bool = True) -> Tuple[List[float], List[float]]:
+    from managed_audio_player import ManagedAudioPlayer
+    from decoder_backends import CodecSwitchingDecoder
+    from simple_audio_player import Mpg123Decoder
+    # Set up like main does, since untranscoded songs need a backend that can play their original container.
+    decoder_factory = Mpg123Decoder if transcode else CodecSwitchingDecoder
+    ready, subscribed = [], []
+    for _ in range(max(1, session.parameters.samples // 4)):  # Each sample starts every process, so is slow.
+        with session.scenario() as topic:
+            start = monotonic()
+            player = ManagedAudioPlayer(session.new_service(transcode=transcode), decoder_factory=decoder_factory,
+                                        fast_start=fast_start)
+            ready.append(monotonic() - start)
+            if not session.broker.wait_for_subscriber(topic, WAIT_TIMEOUT_SECS):
+                raise TimeoutError("The service never subscribed.")
+            subscribed.append(monotonic() - start)
+            player.terminate()
+    return ready, subscribed
+
+
+def bench_startup(session: BenchSession) -> Metrics:
+    """How long until the player is ready, and until the service is receiving requests. With a fast start, the player
+    is ready (to play downloaded songs) before the service has finished starting. Untranscoded, the player starts with
+    the decoder that switches between backends by container."""
+    ready, subscribed = _bench_startups(session, fast_start=False)
+    fast_ready, fast_subscribed = _bench_startups(session, fast_start=True)
+    untranscoded_ready, _ = _bench_startups(session, fast_start=False, transcode=False)
+    return {"startup_ready_secs": summarize(ready), "startup_subscribed_secs": summarize(subscribed),
+            "fast_startup_ready_secs": summarize(fast_ready),
+            "fast_startup_subscribed_secs": summarize(fast_subscribed),
+            "untranscoded_startup_ready_secs": summarize(untranscoded_ready)}
+
+
+def bench_request_to_playable(session: BenchSession) -> Metrics:
+    """How long from a request being published until the song can be played, and until it is playing."""
+    from simple_audio_player import SimpleAudioPlayer, PlaybackStatus
+    playable, playing = [], []
+    with session.scenario() as topic:
+        service = session.new_service()
+        service.start_service()
+        player = SimpleAudioPlayer()
+        try:
+            session.broker.wait_for_subscriber(topic, WAIT_TIMEOUT_SECS)
+            for song_id in range(session.parameters.samples):
+                start = monotonic()
+                session.broker.publish(topic, fake_youtube_id(song_id).encode())
+                if not service.wait_for_song(song_id - 1, WAIT_TIMEOUT_SECS):
+                    raise TimeoutError("The requested song never became available.")
+                path = service.get_song_path_by_song_id(song_id)
+                playable.append(monotonic() - start)
+
+                player.play_from_path(path)
+                wait_until(lambda: player.state.status is PlaybackStatus.PLAYING and player.state.seconds > 0)
+                playing.append(monotonic() - start)
+                player.stop()
+        finally:
+            player.terminate()
+            service.terminate_service()
+    return {"request_to_playable_secs": summarize(playable), "request_to_playing_secs": summarize(playing)}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_peer_copy(session: BenchSession) -> Metrics:
+    """How long from a request being published until the song can be played, when a peer already has it. Compare to
+    request_to_playable_secs. Two nodes run side by side, each with its own topic and download directory: the peer
+    downloads the songs first (announcing each one), then the node being measured is asked for the same songs."""
+    samples = session.parameters.samples
+    port, peer_port = _free_port(), _free_port()
+    durations = []
+    with session.scenario() as topic:
+        service = session.new_service(peers=[f"127.0.0.1:{peer_port}"], peer_port=port)
+        service.start_service()
+        peer = None
+        try:
+            with session.scenario() as peer_topic:
+                # Started within its own scenario, so that it downloads into its own directory.
+                peer = session.new_service(peers=[f"127.0.0.1:{port}"], peer_port=peer_port)
+                peer.start_service()
+                session.broker.wait_for_subscriber(peer_topic, WAIT_TIMEOUT_SECS)
+                session.broker.publish(peer_topic, json.dumps([fake_youtube_id(n) for n in range(samples)]).encode())
+                if not peer.wait_for_song(samples - 2, WAIT_TIMEOUT_SECS + samples):
+                    raise TimeoutError("The peer never downloaded the songs.")
+
+            session.broker.wait_for_subscriber(topic, WAIT_TIMEOUT_SECS)
+            for song_id in range(samples):
+                start = monotonic()
+                session.broker.publish(topic, fake_youtube_id(song_id).encode())
+                if not service.wait_for_song(song_id - 1, WAIT_TIMEOUT_SECS):
+                    raise TimeoutError("The requested song never became available.")
+                durations.append(monotonic() - start)
+            if service.peer_copies != samples:
+                raise RuntimeError(f"Only {service.peer_copies} of {samples} songs were copied from the peer.")
+        finally:
+            service.terminate_service()
+            if peer is not None:
+                peer.terminate_service()
+    return {"peer_copy_to_playable_secs": summarize(durations)}
+
+
+def bench_ingest_burst(session: BenchSession) -> Metrics:
+    """How quickly a burst of requests (with duplicates mixed in) gets downloaded and registered."""
+    burst_size = session.parameters.burst_size
+    throughputs, durations = [], []
+    for burst in range(max(1, session.parameters.samples // 10)):
+        with session.scenario() as topic:
+            service = session.new_service()
+            service.start_service()
+            try:
+                session.broker.wait_for_subscriber(topic, WAIT_TIMEOUT_SECS)
+                start = monotonic()
+                for n in range(burst_size):
+                    session.broker.publish(topic, fake_youtube_id(n).encode())
+                    if n % 5 == 0:  # Someone pressing the button twice.
+                        session.broker.publish(topic, fake_youtube_id(n).encode())
+                if not service.wait_for_song(burst_size - 2, WAIT_TIMEOUT_SECS + burst_size):
+                    raise TimeoutError("The burst was never fully registered.")
+                elapsed = monotonic() - start
+            finally:
+                service.terminate_service()
+        durations.append(elapsed)
+        throughputs.append(burst_size / elapsed)
+    return {"ingest_burst_secs": summarize(durations), "ingest_songs_per_sec": summarize(throughputs)}
+
+
+def bench_download_overhead(session: BenchSession) -> Metrics:
+    """The time each download spends on more than the network: setting up youtube_dl and picking a format. With a
+    new downloader for every song (the cost of every download before downloaders were reused), with one reused
+    downloader, and for a song that was already extracted (a retry, or the song being requested again)."""
+    fresh, reused, repeated = [], [], []
+    downloader_type = make_fake_downloader(0)
+    downloader = downloader_type()
+    downloader.warm_up()
+    for n in range(session.parameters.samples):
+        for timings, extract in ((fresh, lambda: downloader_type().extract_info(fake_youtube_id(n))),
+                                 (reused, lambda: downloader.extract_info(fake_youtube_id(n))),
+                                 (repeated, lambda: downloader.extract_info(fake_youtube_id(n)))):
+            start = monotonic()
+            extract()
+            timings.append(monotonic() - start)
+    return {"download_overhead_fresh_secs": summarize(fresh), "download_overhead_reused_secs": summarize(reused),
+            "download_overhead_repeated_secs": summarize(repeated)}
+
+
+def bench_play_next(session: BenchSession) -> Metrics:
+    """How long a request to play a song next takes to become playable, while a burst of other requests is still
+    being downloaded."""
+    burst_size = session.parameters.burst_size
+    durations = []
+    for burst in range(max(1, session.parameters.samples // 10)):
+        with session.scenario() as topic:
+            service = session.new_service()
+            service.start_service()
+            try:
+                session.broker.wait_for_subscriber(topic, WAIT_TIMEOUT_SECS)
+                session.broker.publish(topic, json.dumps([fake_youtube_id(n) for n in range(burst_size)]).encode())
+                # Once the downloaders are warmed up and busy with the burst.
+                if not service.wait_for_song(0, WAIT_TIMEOUT_SECS):
+                    raise TimeoutError("The burst never started being registered.")
+                next_before = service.play_queue.peek_next()
+                start = monotonic()
+                session.broker.publish(topic, json.dumps({"play_next": fake_youtube_id(burst_size)}).encode())
+                wait_until(lambda: service.play_queue.peek_next() != next_before, WAIT_TIMEOUT_SECS)
+                durations.append(monotonic() - start)
+            finally:
+                service.terminate_service()
+    return {"play_next_under_backlog_secs": summarize(durations)}
+
+
+def bench_control_round_trip(session: BenchSession) -> Metrics:
+    """How long from a pause/resume being requested until the player reports it."""
+    from simple_audio_player import SimpleAudioPlayer, PlaybackStatus
+    round_trips = []
+    with session.scenario(), SimpleAudioPlayer() as player:
+        player.play_from_path(session.fake_song())
+        wait_until(lambda: player.state.status is PlaybackStatus.PLAYING)
+        for _ in range(session.parameters.samples):
+            for expected in (PlaybackStatus.PAUSED, PlaybackStatus.PLAYING):
+                start = monotonic()
+                player.toggle_pause()
+                wait_until(lambda: player.state.status is expected)
+                round_trips.append(monotonic() - start)
+    return {"control_round_trip_secs": summarize(round_trips)}
+
+
+def _bench_skips(session: BenchSession, preload_next: bool) -> List[float]:
+    from managed_audio_player import ManagedAudioPlayer
+    from simple_audio_player import PlaybackStatus
+    samples = session.parameters.samples
+    skip_times = []
+    with session.scenario() as topic:
+        service = session.new_service()
+        player = ManagedAudioPlayer(service, preload_next)
+        running = True
+
+        def play_loop() -> None:
+            while running:
+                finished = player.play_current_song()
+                if not running:
+                    return
+                elif finished:
+                    player.next_song()
+                else:
+                    player.wait_for_next_song(POLL_SECS * 100)
+
+        try:
+            session.broker.wait_for_subscriber(topic, WAIT_TIMEOUT_SECS)
+            for n in range(samples + 1):
+                session.broker.publish(topic, fake_youtube_id(n).encode())
+            if not player.wait_for_next_song(WAIT_TIMEOUT_SECS) or not player.next_song():
+                raise TimeoutError("The songs to skip through never became available.")
+            wait_until(lambda: len(service) == samples + 1)
+            play_thread = Thread(target=play_loop, daemon=True)
+            play_thread.start()
+
+            for _ in range(samples):
+                wait_until(lambda: player.state.status is PlaybackStatus.PLAYING
+                           and player.state.frame >= SKIP_AFTER_FRAMES)
+                frame_before = player.state.frame
+                start = monotonic()
+                player.next_song()
+                player.stop()
+                wait_until(lambda: player.state.status is PlaybackStatus.PLAYING
+                           and player.state.seconds > 0 and player.state.frame < frame_before)
+                skip_times.append(monotonic() - start)
+            running = False
+            player.stop()
+            play_thread.join(WAIT_TIMEOUT_SECS)
+        finally:
+            running = False
+            player.terminate()
+    return skip_times
+
+
+def bench_skip(session: BenchSession) -> Metrics:
+    """How long from skipping a song until the next song is playing, with and without it being preloaded."""
+    return {"skip_preloaded_secs": summarize(_bench_skips(session, preload_next=True)),
+            "skip_cold_secs": summarize(_bench_skips(session, preload_next=False))}
+
+
+def bench_control_under_load(session: BenchSession) -> Metrics:
+    """How long commands posted to the player actor take to be run, and how long a skip through it takes, while other
+    threads flood it with volume changes."""
+    from managed_audio_player import ManagedAudioPlayer
+    from player_actor import PlayerActor
+    from simple_audio_player import PlaybackStatus
+    samples = session.parameters.samples
+    command_latencies = []
+    skip_times = []
+    with session.scenario() as topic:
+        service = session.new_service()
+        player = ManagedAudioPlayer(service)
+        actor = PlayerActor(player, song_break_delay=0)
+        loading = True
+
+        def add_load(direction: int) -> None:
+            while loading:
+                actor.adjust_volume(direction)
+                sleep(LOAD_COMMAND_INTERVAL_SECS)
+
+        try:
+            session.broker.wait_for_subscriber(topic, WAIT_TIMEOUT_SECS)
+            for n in range(samples + 1):
+                session.broker.publish(topic, fake_youtube_id(n).encode())
+            wait_until(lambda: len(service) == samples + 1)
+            actor_thread = Thread(target=actor.run, daemon=True)
+            actor_thread.start()
+            for n in range(LOAD_THREADS):
+                Thread(target=add_load, args=(1 if n % 2 else -1,), daemon=True).start()
+
+            for _ in range(samples):
+                wait_until(lambda: player.state.status is PlaybackStatus.PLAYING
+                           and player.state.frame >= SKIP_AFTER_FRAMES)
+                start = monotonic()
+                actor.submit(lambda _: None).result(WAIT_TIMEOUT_SECS)
+                command_latencies.append(monotonic() - start)
+
+                frame_before = player.state.frame
+                start = monotonic()
+                actor.next_song()
+                wait_until(lambda: player.state.status is PlaybackStatus.PLAYING
+                           and player.state.seconds > 0 and player.state.frame < frame_before)
+                skip_times.append(monotonic() - start)
+            loading = False
+            actor.close()
+            actor_thread.join(WAIT_TIMEOUT_SECS)
+        finally:
+            loading = False
+            player.terminate()
+    return {"command_latency_under_load_secs": summarize(command_latencies),
+            "skip_under_load_secs": summarize(skip_times)}
+
+
+def bench_play_queue(session: BenchSession) -> Metrics:
+    """How long editing and shuffling the play queue takes, with a party's worth of songs queued up."""
+    from random import randrange
+    from play_queue import PlayQueue
+    edits, shuffles = [], []
+    play_queue = PlayQueue(range(PARTY_BACKLOG_SIZE), PARTY_BACKLOG_SIZE // 2)
+    new_song_ids = count(PARTY_BACKLOG_SIZE)
+    for _ in range(session.parameters.samples):
+        start = monotonic()
+        play_queue.play_next(next(new_song_ids))
+        play_queue.move(randrange(len(play_queue)), randrange(len(play_queue)))
+        removed = randrange(len(play_queue))
+        if removed != play_queue.cursor:
+            play_queue.remove(removed)
+        edits.append(monotonic() - start)
+
+        start = monotonic()
+        play_queue.shuffle()
+        play_queue.advance()
+        shuffles.append(monotonic() - start)
+        play_queue.stop_shuffling()
+    return {"play_queue_edit_secs": summarize(edits), "play_queue_shuffle_secs": summarize(shuffles)}
+
+
+BENCHMARKS: Dict[str, Callable[[BenchSession], Metrics]] = {
+    "startup": bench_startup,
+    "request_to_playable": bench_request_to_playable,
+    "peer_copy": bench_peer_copy,
+    "ingest_burst": bench_ingest_burst,
+    "download_overhead": bench_download_overhead,
+    "play_next": bench_play_next,
+    "control_round_trip": bench_control_round_trip,
+    "skip": bench_skip,
+    "control_under_load": bench_control_under_load,
+    "play_queue": bench_play_queue,
+}
+
+
+def _current_commit() -> Optional[str]:
+    try:
+        return sp.run(["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True,
+                      check=True).stdout.strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def run_benchmarks(parameters: BenchParameters, names: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Runs the named benchmarks (or all of them), and returns the results in a JSON serializable form."""
+    metrics: Metrics = {}
+    session = BenchSession(parameters)
+    with session.running():
+        for name in names or BENCHMARKS:
+            metrics.update(BENCHMARKS[name](session))
+
+    return {"schema_version": RESULTS_SCHEMA_VERSION,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": _current_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": parameters._asdict(),
+            "metrics": metrics}
+
+
+def is_higher_better(metric_name: str) -> bool:
+    return metric_name.endswith("_per_sec")
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, float]:
+    """The relative change in each metric's median compared to the baseline. Positive is worse."""
+    changes = {}
+    for name, summary in results["metrics"].items():
+        baseline_summary = baseline.get("metrics", {}).get(name)
+        if baseline_summary is None or not baseline_summary["median"]:
+            continue
+        change = summary["median"] / baseline_summary["median"] - 1
+        changes[name] = -change if is_higher_better(name) else change
+    return changes
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import socket
+import socketserver
+import struct
+from itertools import count
+from threading import Thread, Lock, Condition
+from typing import List, Tuple, Optional
+
+# Control packet types from the MQTT 3.1.1 specification.
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+# Quality of service levels above 1 aren't needed by anything here.
+MAX_QOS = 1
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Whether a topic matches a subscription filter, including the "+" and "#" wildcards."""
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_string(string: str) -> bytes:
+    encoded = string.encode("utf-8")
+    return struct.pack("!H", len(encoded)) + encoded
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+class _Connection(socketserver.BaseRequestHandler):
+    """One client. Reads its packets until it disconnects."""
+    server: _BrokerServer
+
+    def setup(self) -> None:
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._send_lock = Lock()
+        self._packet_ids = count(1)
+        self.subscriptions: List[Tuple[str, int]] = []
+
+    def handle(self) -> None:
+        try:
+            while True:
+                header = self._read_exactly(1)[0]
+                body = self._read_exactly(self._read_length())
+                if not self._handle_packet(header >> 4, header & 0x0F, body):
+                    return
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.broker.remove_connection(self)
+
+    def _read_exactly(self, n: int) -> bytes:
+        data = b""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionResetError("Client disconnected.")
+            data += chunk
+        return data
+
+    def _read_length(self) -> int:
+        length, multiplier = 0, 1
+        while True:
+            digit = self._read_exactly(1)[0]
+            length += (digit & 0x7F) * multiplier
+            if not digit & 0x80:
+                return length
+            multiplier *= 128
+
+    def _handle_packet(self, packet_type: int, flags: int, body: bytes) -> bool:
+        """Returns whether the connection should stay open."""
+        if packet_type == CONNECT:
+            self.send(_packet(CONNACK, 0, b"\x00\x00"))
+        elif packet_type == SUBSCRIBE:
+            packet_id, position = body[:2], 2
+            granted = bytearray()
+            while position < len(body):
+                topic_length, = struct.unpack_from("!H", body, position)
+                topic_filter = body[position + 2:position + 2 + topic_length].decode("utf-8")
+                qos = min(body[position + 2 + topic_length], MAX_QOS)
+                position += 3 + topic_length
+                self.server.broker.add_subscription(self, topic_filter, qos)
+                granted.append(qos)
+            self.send(_packet(SUBACK, 0, packet_id + bytes(granted)))
+        elif packet_type == UNSUBSCRIBE:
+            self.send(_packet(UNSUBACK, 0, body[:2]))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic_length, = struct.unpack_from("!H", body)
+            topic = body[2:2 + topic_length].decode("utf-8")
+            payload_start = 2 + topic_length + (2 if qos else 0)
+            if qos:
+                self.send(_packet(PUBACK, 0, body[2 + topic_length:payload_start]))
+            self.server.broker.publish(topic, body[payload_start:], qos)
+        elif packet_type == PINGREQ:
+            self.send(_packet(PINGRESP, 0, b""))
+        elif packet_type == DISCONNECT:
+            return False
+        return True  # Anything else (e.g. acknowledgements of what was delivered) needs no reply.
+
+    def send(self, data: bytes) -> None:
+        with self._send_lock:
+            self.request.sendall(data)
+
+    def deliver(self, topic: str, payload: bytes, qos: int) -> None:
+        body = _encode_string(topic)
+        if qos:
+            body += struct.pack("!H", next(self._packet_ids) % 0x10000 or 1)
+        try:
+            self.send(_packet(PUBLISH, qos << 1, body + payload))
+        except OSError:
+            pass  # Disconnected. Will be removed by its own thread.
+
+
+class _BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, broker: FakeBroker, address: Tuple[str, int]):
+        self.broker = broker
+        super().__init__(address, _Connection)
+
+
+class FakeBroker:
+    """A minimal MQTT 3.1.1 broker without TLS or authentication, for running the service against locally.
+    Keeps no sessions and retains nothing. Messages can be published through a real client or directly with publish."""
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = _BrokerServer(self, (host, port))
+        self._connections: List[_Connection] = []
+        self._changed = Condition()
+        self.messages_published = 0
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> FakeBroker:
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        with self._changed:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.request.close()
+
+    def add_subscription(self, connection: _Connection, topic_filter: str, qos: int) -> None:
+        with self._changed:
+            connection.subscriptions.append((topic_filter, qos))
+            if connection not in self._connections:
+                self._connections.append(connection)
+            self._changed.notify_all()
+
+    def remove_connection(self, connection: _Connection) -> None:
+        with self._changed:
+            if connection in self._connections:
+                self._connections.remove(connection)
+            self._changed.notify_all()
+
+    def wait_for_subscriber(self, topic: str, timeout: Optional[float] = None) -> bool:
+        """Blocks until a client is subscribed to the topic. Returns whether one is."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._subscribers(topic), timeout)
+
+    def _subscribers(self, topic: str) -> List[Tuple[_Connection, int]]:
+        return [(connection, qos) for connection in self._connections
+                for topic_filter, qos in connection.subscriptions if topic_matches(topic_filter, topic)]
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0) -> None:
+        """Sends a message to every subscriber of the topic."""
+        with self._changed:
+            subscribers = self._subscribers(topic)
+            self.messages_published += 1
+        for connection, subscribed_qos in subscribers:
+            connection.deliver(topic, payload, min(qos, subscribed_qos))
@@ -0,0 +1,44 @@
+import os
+from time import sleep
+from typing import Type
+
+from youtube_downloader import YoutubeDownloader, Info, BASE_URL
+
+# Enough bytes to look like the start of an MP3 to anything that checks. The fake mpg123 never reads it.
+FAKE_SONG_CONTENTS = b"ID3" + bytes(1021)
+
+# How much of a download's latency is spent extracting the video's info, rather than fetching its audio.
+EXTRACTION_SHARE = 0.5
+
+
+def fake_info(video_id: str) -> Info:
+    """Enough of what youtube_dl extracts from YouTube for it to pick a format."""
+    def audio_format(format_id: str, bitrate: int) -> Info:
+        return {"format_id": format_id, "url": f"http://127.0.0.1/{video_id}/{format_id}", "ext": "webm",
+                "acodec": "opus", "vcodec": "none", "abr": bitrate}
+
+    return {"id": video_id, "title": video_id, "extractor": "youtube", "extractor_key": "Youtube",
+            "webpage_url": BASE_URL + video_id, "webpage_url_basename": video_id,
+            "formats": [audio_format("249", 50), audio_format("251", 160)]}
+
+
+def make_fake_downloader(latency_secs: float) -> Type[YoutubeDownloader]:
+    """Returns a stand-in for youtube_downloader.YoutubeDownloader that takes latency_secs to "download" a placeholder
+    song, instead of contacting YouTube. Everything else (youtube_dl itself, picking the format, and caching what was
+    extracted) is real."""
+    class FakeYoutubeDownloader(YoutubeDownloader):
+        def _extract(self, video_id: str) -> Info:
+            sleep(latency_secs * EXTRACTION_SHARE)
+            return fake_info(video_id)
+
+        def download_audio(self, video_id: str, directory: str) -> None:
+            self.extract_info(video_id)
+            sleep(latency_secs * (1 - EXTRACTION_SHARE))
+            extension = "mp3" if self._transcode else "webm"
+            path = os.path.join(directory, f"{video_id}.{extension}")
+            temporary_path = path + ".part"
+            with open(temporary_path, "wb") as file:
+                file.write(FAKE_SONG_CONTENTS)
+            os.replace(temporary_path, path)  # Like the real download, the song only appears once it's complete.
+
+    return FakeYoutubeDownloader
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Stands in for "mpg123 -R". Speaks enough of the remote control protocol for the player to drive it, and pretends
+that every song it's given is FAKE_MPG123_SONG_SECS long. Nothing is decoded and nothing is played."""
+import os
+import select
+import sys
+from time import monotonic
+
+SONG_SECS = float(os.environ.get("FAKE_MPG123_SONG_SECS", "3"))
+# MP3 frames hold 1152 samples.
+SAMPLES_PER_FRAME = 1152
+SAMPLE_RATE = 44100
+FRAMES_PER_SEC = SAMPLE_RATE / SAMPLES_PER_FRAME
+STREAM_INFO = "@S 1.0 3 44100 Joint-Stereo 0 1044 2 0 0 0 192 0 1"
+
+
+class FakeMpg123:
+    def __init__(self):
+        self.loaded = False
+        self.paused = False
+        self.silent = False
+        self.frame = 0
+        self.total_frames = max(1, round(SONG_SECS * FRAMES_PER_SEC))
+        self.next_frame_at = 0.0
+
+    @property
+    def playing(self) -> bool:
+        return self.loaded and not self.paused
+
+    def handle(self, line: str) -> bool:
+        """Returns whether to keep running."""
+        command, _, argument = line.strip().partition(" ")
+        command = command.lower()
+        if command in ("load", "l", "loadpaused", "lp"):
+            self.load(argument, paused=command in ("loadpaused", "lp"))
+        elif command in ("pause", "p"):
+            if self.loaded:
+                self.paused = not self.paused
+                self.next_frame_at = monotonic()
+                emit(f"@P {1 if self.paused else 2}")
+        elif command in ("stop", "s"):
+            if self.loaded:
+                self.loaded = False
+                emit("@P 0")
+        elif command in ("volume", "v"):
+            emit(f"@V {float(argument):f}%")
+        elif command in ("seek", "k", "jump", "j"):
+            self.seek(argument, jump=command in ("jump", "j"))
+        elif command == "silence":
+            self.silent = True
+        elif command == "progress":
+            self.silent = False
+        elif command == "sample":
+            if self.loaded:
+                emit(f"@SAMPLE {self.frame * SAMPLES_PER_FRAME} {self.total_frames * SAMPLES_PER_FRAME}")
+            else:
+                emit("@E No stream opened.")
+        elif command in ("pitch", "pi"):
+            pass
+        elif command in ("quit", "q"):
+            return False
+        elif command:
+            emit(f"@E Unknown command or no arguments: {command}")
+        return True
+
+    def seek(self, argument: str, jump: bool) -> None:
+        """seek takes samples. jump takes frames, or seconds if suffixed with "s"."""
+        if argument.endswith("s"):
+            frames = float(argument[:-1]) * FRAMES_PER_SEC
+        elif jump:
+            frames = float(argument)
+        else:
+            frames = float(argument) / SAMPLES_PER_FRAME
+        self.frame = int(frames) + (self.frame if argument[:1] in "+-" else 0)
+        self.frame = min(max(self.frame, 0), self.total_frames)
+
+    def load(self, path: str, paused: bool) -> None:
+        if not os.path.exists(path):
+            emit(f"@E Error opening stream: {path}")
+            return
+        self.loaded = True
+        self.paused = paused
+        self.frame = 0
+        self.next_frame_at = monotonic()
+        emit(f"@I {os.path.splitext(os.path.basename(path))[0]}")
+        emit(STREAM_INFO)
+        emit(f"@P {1 if paused else 2}")
+
+    def advance(self) -> None:
+        """Plays every frame that's due."""
+        now = monotonic()
+        while self.playing and self.next_frame_at <= now:
+            self.frame += 1
+            self.next_frame_at += 1 / FRAMES_PER_SEC
+            if not self.silent:
+                frames_left = self.total_frames - self.frame
+                emit(f"@F {self.frame} {frames_left} {self.frame / FRAMES_PER_SEC:.2f} "
+                     f"{frames_left / FRAMES_PER_SEC:.2f}")
+            if self.frame >= self.total_frames:
+                self.loaded = False
+                emit("@P 0")
+
+
+def emit(line: str) -> None:
+    sys.stdout.write(line + "\n")
+
+
+def main() -> None:
+    player = FakeMpg123()
+    stdin = sys.stdin.fileno()
+    buffered = b""
+    emit("@R MPG123 (fake)")
+    sys.stdout.flush()
+    while True:
+        timeout = max(0.0, player.next_frame_at - monotonic()) if player.playing else None
+        readable, _, _ = select.select([stdin], [], [], timeout)
+        if readable:
+            chunk = os.read(stdin, 4096)
+            if not chunk:
+                return
+            buffered += chunk
+            *lines, buffered = buffered.split(b"\n")
+            for line in lines:
+                if not player.handle(line.decode("ascii", errors="replace")):
+                    return
+        player.advance()
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
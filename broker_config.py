@@ -12,6 +12,14 @@ class Config(NamedTuple):
     username: str
     password: str
     topic: str
+    # The defaults are what the player always connected with, so that existing configuration files keep working.
+    # Only worth turning off for a broker on the local machine, such as the one used for benchmarking.
+    tls: bool = True
+    # 1 means requests sent while the connection is briefly down still arrive (possibly twice). 0 is fire-and-forget.
+    qos: int = 0
+    # Whether the broker keeps the subscription, and any requests sent while disconnected, between runs. Only keeps
+    #  the requests with a qos of 1.
+    persistent_session: bool = False
 
     @staticmethod
     def from_file(path: str = DEFAULT_CONFIG_PATH) -> Config:
@@ -1,7 +1,10 @@
 from time import sleep
 from functools import partial
+from threading import Thread, Event, Lock
+from typing import Sequence
 
 from managed_audio_player import ManagedAudioPlayer
+from player_actor import PlayerActor
 from logging_util import setup_logger
 
 try:
@@ -13,10 +16,15 @@ except ImportError as e:
 
 SONG_BREAK_DELAY_SECS = 2
 
-SEEK_STEP = 400000
+SEEK_STEP_SECS = 10
 VOLUME_STEP = 5
 PITCH_STEP = 0.01
 
+# How long encoder detents are added up for before being sent to the player as one change. Long enough to gather
+#  a fast spin into a single command, short enough to still feel immediate.
+ENCODER_FRAME_SECS = 0.05
+LED_SWEEP_STEP_SECS = 0.025
+
 mod_but = Button(18)
 prev_but = Button(23)
 next_but = Button(25)
@@ -32,66 +40,100 @@ mod_led = LED(21)
 player_logger = setup_logger("player", "player.log")
 
 
-def rotor_clockwise(player: ManagedAudioPlayer) -> None:
+class EncoderCoalescer:
+    """Adds up rotary encoder detents over a short frame, then applies them to the player as a single volume or
+    pitch change. Keeps the gpiozero callback thread free, and stops fast spins from queueing up behind the knob."""
+    def __init__(self, player: PlayerActor):
+        self._player = player
+        self._lock = Lock()
+        self._volume_steps = 0
+        self._pitch_steps = 0
+        self._steps_pending = Event()
+        self._sweeping = Lock()  # Held while an LED sweep is animating, so that sweeps don't pile up.
+        Thread(target=self._apply_steps_forever, daemon=True).start()
+
+    def add_step(self, direction: int) -> None:
+        """Records a detent in the given direction (1 for clockwise, -1 for counter-clockwise). Returns immediately."""
+        with self._lock:
+            if mod_but.is_pressed:
+                self._pitch_steps += direction
+            else:
+                self._volume_steps += direction
+        self._steps_pending.set()
+
+    def _apply_steps_forever(self) -> None:
+        while True:
+            self._steps_pending.wait()
+            sleep(ENCODER_FRAME_SECS)  # Let the rest of the spin accumulate.
+            with self._lock:
+                self._steps_pending.clear()
+                volume_steps, self._volume_steps = self._volume_steps, 0
+                pitch_steps, self._pitch_steps = self._pitch_steps, 0
+
+            if pitch_steps:
+                player_logger.info(f"Song Pitch {pitch_steps * PITCH_STEP:+.0%}")
+                self._player.adjust_pitch(pitch_steps * PITCH_STEP)
+            if volume_steps:
+                player_logger.info(f"Volume {volume_steps * VOLUME_STEP:+}%")
+                self._player.adjust_volume(volume_steps * VOLUME_STEP)
+
+            net_steps = volume_steps + pitch_steps
+            if net_steps:
+                leds = [mod_led, prev_led, play_led, next_led]
+                self._sweep_leds(leds if net_steps > 0 else leds[::-1])
+
+    def _sweep_leds(self, leds: Sequence[LED]) -> None:
+        """Blinks the LEDs one after another in the background. Skipped if a sweep is already running."""
+        if self._sweeping.acquire(blocking=False):
+            def sweep():
+                try:
+                    for led in leds:
+                        led.blink(LED_SWEEP_STEP_SECS, 0, 1, background=False)
+                finally:
+                    self._sweeping.release()
+            Thread(target=sweep, daemon=True).start()
+
+
+def rotor_clockwise(coalescer: EncoderCoalescer) -> None:
     """Callback for volume/pitch control associated with the clockwise rotation of the rotary encoder"""
-    if mod_but.is_pressed:
-        player_logger.info("Song Pitch Up 1%")
-        player.adjust_pitch(PITCH_STEP)
-    else:
-        player_logger.info("Volume Up 5%")
-        player.adjust_volume(VOLUME_STEP)
-    mod_led.blink(0.025, 0, 1, background=False)
-    prev_led.blink(0.025, 0, 1, background=False)
-    play_led.blink(0.025, 0, 1, background=False)
-    next_led.blink(0.025, 0, 1, background=False)
+    coalescer.add_step(1)
 
 
-def rotor_counter_clock(player: ManagedAudioPlayer) -> None:
+def rotor_counter_clock(coalescer: EncoderCoalescer) -> None:
     """Callback for volume/pitch control associated with the counter-clockwise rotation of the rotary encoder"""
-    if mod_but.is_pressed:
-        player_logger.info("Song Pitch Down 1%")
-        player.adjust_pitch(-PITCH_STEP)
-    else:
-        player_logger.info("Volume Down 5%")
-        player.adjust_volume(-VOLUME_STEP)
-    next_led.blink(0.025, 0, 1, background=False)
-    play_led.blink(0.025, 0, 1, background=False)
-    prev_led.blink(0.025, 0, 1, background=False)
-    mod_led.blink(0.025, 0, 1, background=False)
+    coalescer.add_step(-1)
 
 
-def previous_button(player: ManagedAudioPlayer) -> None:
+def previous_button(player: PlayerActor) -> None:
     """Callback to control the previous song/seek back features associated with the previous button  """
     if mod_but.is_pressed:
         player_logger.info("Seek Back")
-        player.seek_by(-SEEK_STEP)
+        player.seek_by_seconds(-SEEK_STEP_SECS)
     else:
         player_logger.info("Previous Song")
         player.previous_song()
-        player.stop()
     prev_led.on()
 
 
-def next_button(player: ManagedAudioPlayer) -> None:
+def next_button(player: PlayerActor) -> None:
     """Callback to control the next song/seek forwards features associated with the next button."""
     if mod_but.is_pressed:
         player_logger.info("Seek Forwards")
-        player.seek_by(SEEK_STEP)
+        player.seek_by_seconds(SEEK_STEP_SECS)
     else:
         player_logger.info("Next Song")
         player.next_song()
-        player.stop()
     next_led.on()
 
 
-def play_button(player: ManagedAudioPlayer) -> None:
+def play_button(player: PlayerActor) -> None:
     """Callback to control play/pause features associated with the play button."""
     player_logger.info("Toggle Pause")
     player.toggle_pause()
     play_led.on()
 
 
-def rotor_button(player: ManagedAudioPlayer) -> None:
+def rotor_button(player: PlayerActor) -> None:
     """Callback to control mute/pitch reset features associated with the rotary encoder button."""
     if mod_but.is_pressed:
         player_logger.info("Reset Pitch")
@@ -113,15 +155,18 @@ def leds_off() -> None:
     next_led.off()
 
 
-def main_control_loop(player: ManagedAudioPlayer, loop_try_delay: int) -> None:
-    """Main playback loop for the controls.
+def main_control_loop(player: ManagedAudioPlayer, song_break_delay: float = SONG_BREAK_DELAY_SECS) -> None:
+    """Main playback loop for the controls. The player is driven from this thread, and the controls' callbacks only
+    post commands to it.
     Blocks forever."""
-    rotor_enc.when_rotated_clockwise = partial(rotor_clockwise, player)
-    rotor_enc.when_rotated_counter_clockwise = partial(rotor_counter_clock, player)
-    prev_but.when_pressed = partial(previous_button, player)
-    next_but.when_pressed = partial(next_button, player)
-    play_but.when_pressed = partial(play_button, player)
-    rotor_but.when_pressed = partial(rotor_button, player)
+    actor = PlayerActor(player, song_break_delay)
+    encoder_coalescer = EncoderCoalescer(actor)
+    rotor_enc.when_rotated_clockwise = partial(rotor_clockwise, encoder_coalescer)
+    rotor_enc.when_rotated_counter_clockwise = partial(rotor_counter_clock, encoder_coalescer)
+    prev_but.when_pressed = partial(previous_button, actor)
+    next_but.when_pressed = partial(next_button, actor)
+    play_but.when_pressed = partial(play_button, actor)
+    rotor_but.when_pressed = partial(rotor_button, actor)
     mod_but.when_pressed = mod_led.on
 
     mod_but.when_released = mod_led.off
@@ -131,11 +176,7 @@ def main_control_loop(player: ManagedAudioPlayer, loop_try_delay: int) -> None:
     rotor_but.when_released = leds_off
 
     try:
-        while True:
-            song_finished = player.play_current_song()  # Will block during playback
-            if song_finished:
-                player.next_song()
-            sleep(loop_try_delay)
+        actor.run()
     finally:
         leds_off()
 
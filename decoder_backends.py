@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import socket
+import subprocess as sp
+import tempfile
+from time import sleep, monotonic
+from typing import Callable, Dict, Optional, Type
+
+from seek_index import SeekIndex
+from simple_audio_player import Decoder, ProcessDecoder, Mpg123Decoder, CommandChannel, PlaybackStatus, PlayerState, \
+    player_logger
+
+MPV_COMMAND = ["mpv", "--idle=yes", "--no-video", "--no-terminal", "--audio-display=no",
+               # mpg123's pitch changes the speed and pitch together, so mpv is told to do the same.
+               "--audio-pitch-correction=no"]
+SOCKET_CONNECT_TIMEOUT_SECS = 5
+SOCKET_CONNECT_POLL_SECS = 0.05
+
+# seek_by takes samples, like mpg123's seek does. mpv seeks by time.
+ASSUMED_SAMPLE_RATE = 44100
+
+# Observed mpv properties, by the ID they're reported with.
+PAUSE_PROPERTY_ID = 1
+TIME_POS_PROPERTY_ID = 2
+TIME_REMAINING_PROPERTY_ID = 3
+
+# The containers that mpg123 can play. Everything else goes to mpv, which can play almost anything, including the
+#  Opus and AAC audio that YouTube serves.
+MPG123_EXTENSIONS = {"mp3"}
+
+
+class MpvDecoder(ProcessDecoder):
+    """A single idle mpv process, controlled over its JSON IPC socket."""
+    def __init__(self):
+        super().__init__()
+        self._socket_directory = tempfile.mkdtemp(prefix="music_pi_mpv_")
+        socket_path = os.path.join(self._socket_directory, "mpv.sock")
+        self._process = sp.Popen([*MPV_COMMAND, f"--input-ipc-server={socket_path}"],
+                                 stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        self._socket = self._connect(socket_path)
+        self._commands = CommandChannel(self._socket.makefile("wb"), collapse=False)
+        self._paused = False
+
+        self._start_reader()
+        self._send(["observe_property", PAUSE_PROPERTY_ID, "pause"],
+                   ["observe_property", TIME_POS_PROPERTY_ID, "time-pos"],
+                   ["observe_property", TIME_REMAINING_PROPERTY_ID, "time-remaining"])
+
+    def _connect(self, socket_path: str) -> socket.socket:
+        """mpv creates the socket shortly after starting, so connecting is retried until it shows up."""
+        deadline = monotonic() + SOCKET_CONNECT_TIMEOUT_SECS
+        while True:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                client.connect(socket_path)
+                return client
+            except (FileNotFoundError, ConnectionRefusedError):
+                client.close()
+                if monotonic() > deadline or self._process.poll() is not None:
+                    self.terminate()
+                    raise RuntimeError("Could not connect to mpv. Is it installed?")
+                sleep(SOCKET_CONNECT_POLL_SECS)
+
+    def _send(self, *commands: list) -> None:
+        self._commands.send(*(json.dumps({"command": command}) for command in commands))
+
+    def _read_output(self) -> None:
+        for line in self._socket.makefile("rb"):
+            try:
+                message = json.loads(line)
+            except ValueError:
+                player_logger.warning(f"Unexpected message from mpv: {line!r}")
+                continue
+            event = message.get("event")
+            if event == "file-loaded":
+                self._report_status(PlaybackStatus.PAUSED if self._paused else PlaybackStatus.PLAYING)
+            elif event == "end-file":
+                if message.get("reason") == "error":
+                    self._report_error(message.get("file_error", "Unknown error"))
+                self._report_status(PlaybackStatus.STOPPED)
+            elif event == "property-change":
+                self._handle_property_change(message.get("id"), message.get("data"))
+        self._report_exited()
+
+    def _handle_property_change(self, property_id: int, value) -> None:
+        if property_id == PAUSE_PROPERTY_ID:
+            self._paused = bool(value)
+            if self.state.status is not PlaybackStatus.STOPPED:
+                self._report_status(PlaybackStatus.PAUSED if self._paused else PlaybackStatus.PLAYING)
+        elif property_id == TIME_POS_PROPERTY_ID and value is not None:
+            self._report_position(seconds=float(value))
+        elif property_id == TIME_REMAINING_PROPERTY_ID and value is not None:
+            self._report_position(seconds_left=float(value))
+
+    def _send_load(self, song_path: str, paused: bool) -> None:
+        self._send(["set_property", "pause", paused], ["loadfile", song_path, "replace"])
+
+    def _send_stop(self) -> None:
+        self._send(["stop"])
+
+    def toggle_pause(self) -> None:
+        self._send(["cycle", "pause"])
+
+    def set_volume(self, volume: int) -> None:
+        self._send(["set_property", "volume", volume])
+
+    def set_pitch(self, pitch: float) -> None:
+        self._send(["set_property", "speed", 1 + pitch])
+
+    def seek_by(self, samples: int) -> None:
+        self._send(["seek", samples / ASSUMED_SAMPLE_RATE, "relative"])
+
+    def _send_seek_to(self, seconds: float) -> None:
+        self._send(["seek", seconds, "absolute"])
+
+    def apply_settings(self, volume: int, pitch: float) -> None:
+        self._send(["set_property", "speed", 1 + pitch], ["set_property", "volume", volume])
+
+    def terminate(self) -> None:
+        if hasattr(self, "_commands"):
+            self._commands.close()
+        self._process.kill()
+        self._process.wait()
+        shutil.rmtree(self._socket_directory, ignore_errors=True)
+
+
+class CodecSwitchingDecoder(Decoder):
+    """Picks the backend for each song by its container. mpg123 plays MP3s, and mpv plays everything else, so songs
+    can be played in whatever container they were downloaded in. Each backend is only started once it's first
+    needed."""
+    def __init__(self):
+        # Remembered so that a backend can be brought in line when it takes over.
+        self._volume: Optional[int] = None
+        self._pitch: Optional[float] = None
+        self._finish_listener: Optional[Callable[[], None]] = None
+        self._backends: Dict[Type[ProcessDecoder], ProcessDecoder] = {}
+        self._active: ProcessDecoder = self._backend(Mpg123Decoder)
+
+    def _backend(self, backend_type: Type[ProcessDecoder]) -> ProcessDecoder:
+        backend = self._backends.get(backend_type)
+        if backend is None:
+            backend = self._backends[backend_type] = backend_type()
+            backend.set_finish_listener(self._finish_listener)
+        return backend
+
+    def load(self, song_path: str, paused: bool = False) -> None:
+        extension = os.path.splitext(song_path)[1].lstrip(".").lower()
+        backend = self._backend(Mpg123Decoder if extension in MPG123_EXTENSIONS else MpvDecoder)
+        if backend is not self._active:
+            if self._active.is_loaded and self._active.state.status is not PlaybackStatus.STOPPED:
+                self._active.stop()
+            if self._volume is not None and self._pitch is not None:
+                backend.apply_settings(self._volume, self._pitch)
+            self._active = backend
+        backend.load(song_path, paused)
+
+    def stop(self) -> None:
+        self._active.stop()
+
+    def toggle_pause(self) -> None:
+        self._active.toggle_pause()
+
+    def set_volume(self, volume: int) -> None:
+        self._volume = volume
+        self._active.set_volume(volume)
+
+    def set_pitch(self, pitch: float) -> None:
+        self._pitch = pitch
+        self._active.set_pitch(pitch)
+
+    def seek_by(self, samples: int) -> None:
+        self._active.seek_by(samples)
+
+    def seek_to(self, seconds: float) -> None:
+        self._active.seek_to(seconds)
+
+    @property
+    def seek_index(self) -> Optional[SeekIndex]:
+        return self._active.seek_index
+
+    def apply_settings(self, volume: int, pitch: float) -> None:
+        self._volume = volume
+        self._pitch = pitch
+        self._active.apply_settings(volume, pitch)
+
+    @property
+    def state(self) -> PlayerState:
+        return self._active.state
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._active.is_loaded
+
+    def wait_for_song_finish(self, timeout: Optional[float] = None) -> bool:
+        return self._active.wait_for_song_finish(timeout)
+
+    def set_finish_listener(self, listener: Optional[Callable[[], None]]) -> None:
+        # Each backend calls it, including one that was just switched away from. That's only a spurious call.
+        self._finish_listener = listener
+        for backend in self._backends.values():
+            backend.set_finish_listener(listener)
+
+    def terminate(self) -> None:
+        for backend in self._backends.values():
+            backend.terminate()
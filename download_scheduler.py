@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from itertools import count
+from threading import Condition
+from typing import Callable, Dict, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from song_service import Request
+
+# A download is urgent if at most this many songs will play before it's needed (i.e. it's the current or next song).
+URGENT_SONGS_UNTIL_NEEDED = 1
+# How many non-urgent downloads (prefetching songs further ahead) may run while an urgent one is running, so that the
+#  urgent one gets most of the bandwidth and CPU.
+PREFETCH_CONCURRENCY_WHILE_URGENT = 1
+
+
+class DownloadScheduler:
+    """Holds the requests waiting for a downloader, and hands out whichever will be needed soonest.
+    songs_until_needed gives how many songs will play before the requested song does. Since that changes as playback
+    moves, requests are ranked when they're taken rather than when they're added. Thread-safe."""
+    def __init__(self, songs_until_needed: Callable[[Request], int], max_size: int):
+        self._songs_until_needed = songs_until_needed
+        self._max_size = max_size
+        # Keyed by arrival order, which breaks ties.
+        self._pending: Dict[int, Request] = {}
+        self._arrivals = count()
+        # Whether each running download was urgent when it was taken, by id().
+        self._running: Dict[int, bool] = {}
+        self._closed = False
+        self._changed = Condition()
+
+    def add(self, request: Request) -> None:
+        with self._changed:
+            self._pending[next(self._arrivals)] = request
+            self._changed.notify_all()
+
+    def wait_for_room(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until fewer than max_size requests are waiting. Returns whether there's room."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._closed or len(self._pending) < self._max_size, timeout) \
+                and not self._closed
+
+    def has_room(self) -> bool:
+        return len(self._pending) < self._max_size
+
+    def take(self) -> Optional[Request]:
+        """Blocks until a request may start, and returns it. Call done once it has finished.
+        Returns None once the scheduler is closed."""
+        with self._changed:
+            while not self._closed:
+                choice = self._choose()
+                if choice is not None:
+                    arrival, urgent = choice
+                    request = self._pending.pop(arrival)
+                    self._running[id(request)] = urgent
+                    self._changed.notify_all()  # There's room now.
+                    return request
+                self._changed.wait()
+            return None
+
+    def _choose(self) -> Optional[Tuple[int, bool]]:
+        """The arrival number of the request that should start next, and whether it's urgent. None if nothing should
+        start yet."""
+        if not self._pending:
+            return None
+        arrival = min(self._pending, key=lambda arrival: (self._songs_until_needed(self._pending[arrival]), arrival))
+        urgent = self._songs_until_needed(self._pending[arrival]) <= URGENT_SONGS_UNTIL_NEEDED
+        running_urgent = sum(self._running.values())
+        if not urgent and running_urgent and len(self._running) - running_urgent >= PREFETCH_CONCURRENCY_WHILE_URGENT:
+            return None
+        return arrival, urgent
+
+    def done(self, request: Request) -> None:
+        with self._changed:
+            self._running.pop(id(request), None)
+            self._changed.notify_all()
+
+    def reprioritize(self) -> None:
+        """Wakes anything waiting to take a request, since what's needed soonest may have changed (e.g. the playback
+        position moved)."""
+        with self._changed:
+            self._changed.notify_all()
+
+    def close(self) -> None:
+        """Wakes everything waiting on the scheduler, and stops it from handing out any more requests."""
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    def __len__(self) -> int:
+        return len(self._pending)
@@ -1,18 +1,179 @@
+import atexit
 import logging
+import multiprocessing
+import os
+from logging.handlers import QueueHandler, RotatingFileHandler
+from queue import SimpleQueue, Empty
+from threading import Thread, Lock
+from time import sleep
+from typing import Dict, Optional
 
 MINIMUM_LOGGING_LEVEL = logging.INFO
 
+# Logs live on the SD card, so they're capped and rotated instead of being allowed to grow forever.
+LOG_MAX_BYTES = 1024 ** 2
+LOG_BACKUP_COUNT = 2
+
+# After the first record of a burst arrives, how long to wait for the rest before writing them all at once.
+#  Warnings and errors are written straight away, since they're often followed by the process dying.
+LOG_BATCH_WINDOW_SECS = 1
+IMMEDIATE_WRITE_LEVEL = logging.WARNING
+
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 
-# Credit: eos87 from https://stackoverflow.com/a/11233293/3000206
-def setup_logger(name, log_file, level=MINIMUM_LOGGING_LEVEL):
-    """Allows logging to multiple different files by different loggers."""
 
-    handler = logging.FileHandler(log_file)
-    handler.setFormatter(formatter)
+class _BatchedRotatingFileHandler(RotatingFileHandler):
+    """Only flushes when explicitly told to, so a batch of records costs a single write."""
+    def flush(self) -> None:
+        pass
+
+    def flush_batch(self) -> None:
+        super().flush()
+
+
+class _ParentQueue:
+    """Stands in for a writer's queue in a forked child process, sending its records on to the parent's writer for
+    the same file. Only the process that started everything writes (and rotates) the log files, since rotation isn't
+    safe with several processes appending to the same file."""
+    def __init__(self, log_file: str):
+        self._log_file = log_file
+
+    def put_nowait(self, record: logging.LogRecord) -> None:
+        _child_records.put((self._log_file, record))
+
+
+class _LogWriter:
+    """Owns a single log file. Every logger writing to the file puts records into one queue, and a single background
+    thread writes them, so logging never blocks the caller on disk IO. In forked child processes, records are sent to
+    the parent's writer instead. See _ParentQueue."""
+    def __init__(self, log_file: str):
+        self._log_file = log_file
+        self._file_handler = _BatchedRotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES,
+                                                         backupCount=LOG_BACKUP_COUNT, delay=True)
+        self._file_handler.setFormatter(formatter)
+        # Held while writing, so that a fork never happens with half a batch sitting in the file buffer.
+        self.write_lock = Lock()
+        self.queue_handler = QueueHandler(SimpleQueue())
+        self._thread: Optional[Thread] = None
+        if os.getpid() == _owner_pid:
+            self._thread = self._start_thread()
+        else:
+            self.queue_handler.queue = _ParentQueue(log_file)
+
+    def _start_thread(self) -> Thread:
+        thread = Thread(target=self._write_forever, args=(self.queue_handler.queue,), daemon=True)
+        thread.start()
+        return thread
+
+    def _write_forever(self, queue: SimpleQueue) -> None:
+        while True:
+            records = [queue.get()]
+            if records[0] is not None and records[0].levelno < IMMEDIATE_WRITE_LEVEL:
+                sleep(LOG_BATCH_WINDOW_SECS)
+            try:
+                while True:
+                    records.append(queue.get_nowait())
+            except Empty:
+                pass
+
+            with self.write_lock:
+                for record in records:
+                    if record is not None:
+                        self._file_handler.handle(record)
+                self._file_handler.flush_batch()
+            if None in records:
+                return
+
+    def flush_before_fork(self) -> None:
+        self.write_lock.acquire()
+        self._file_handler.flush_batch()
+
+    def send_to_parent_after_fork(self) -> None:
+        """The writer thread doesn't survive a fork, and the queue holds the parent's records. The child's records are
+        sent to the parent's writer from then on."""
+        self.write_lock.release()
+        self.queue_handler.queue = _ParentQueue(self._log_file)
+        self._thread = None
+
+    def stop(self) -> None:
+        """Writes everything queued so far, then stops the writer thread."""
+        if self._thread is not None:
+            self.queue_handler.queue.put(None)
+            self._thread.join(LOG_BATCH_WINDOW_SECS * 2)
+
+
+_writers: Dict[str, _LogWriter] = {}
+_writers_lock = Lock()
+# The process whose writers own the log files. Forked children send their records to it through _child_records, which
+#  is created before the first fork.
+_owner_pid = os.getpid()
+_child_records: Optional[multiprocessing.Queue] = None
+_child_records_thread: Optional[Thread] = None
 
+
+def _writer_for(path: str) -> _LogWriter:
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = _writers[path] = _LogWriter(path)
+        return writer
+
+
+def _receive_child_records_forever(child_records: multiprocessing.Queue) -> None:
+    while True:
+        sent = child_records.get()
+        if sent is None:
+            return
+        log_file, record = sent
+        _writer_for(log_file).queue_handler.queue.put(record)
+
+
+# Credit: eos87 from https://stackoverflow.com/a/11233293/3000206
+def setup_logger(name, log_file, level=MINIMUM_LOGGING_LEVEL):
+    """Allows logging to multiple different files by different loggers.
+    Safe to call repeatedly. Each file only ever gets one writer, however many loggers or calls share it."""
+    writer = _writer_for(os.path.abspath(log_file))
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(handler)
+    if writer.queue_handler not in logger.handlers:
+        logger.addHandler(writer.queue_handler)
+
+    return logger
+
+
+def _flush_writers_before_fork() -> None:
+    global _child_records, _child_records_thread
+    if _child_records is None and os.getpid() == _owner_pid:
+        _child_records = multiprocessing.Queue()
+        _child_records_thread = Thread(target=_receive_child_records_forever, args=(_child_records,), daemon=True)
+        _child_records_thread.start()
+    _writers_lock.acquire()
+    for writer in _writers.values():
+        writer.flush_before_fork()
+
+
+def _release_writers_in_parent() -> None:
+    for writer in _writers.values():
+        writer.write_lock.release()
+    _writers_lock.release()
+
+
+def _send_to_parent_in_child() -> None:
+    for writer in _writers.values():
+        writer.send_to_parent_after_fork()
+    _writers_lock.release()
+
+
+def _stop_writers() -> None:
+    if _child_records_thread is not None and os.getpid() == _owner_pid:
+        # Whatever the children sent before exiting is written too.
+        _child_records.put(None)
+        _child_records_thread.join(LOG_BATCH_WINDOW_SECS * 2)
+    for writer in list(_writers.values()):
+        writer.stop()
+
 
-    return logger
\ No newline at end of file
+os.register_at_fork(before=_flush_writers_before_fork,
+                    after_in_parent=_release_writers_in_parent,
+                    after_in_child=_send_to_parent_in_child)
+atexit.register(_stop_writers)
@@ -1,41 +1,85 @@
 #!/usr/bin/env python3
+from startup_timing import startup_timer  # First, so that the time spent on the other imports is counted.
 from time import sleep
+from typing import Optional, Sequence
 from argparse import ArgumentParser
 
 from managed_audio_player import ManagedAudioPlayer
+from simple_audio_player import Mpg123Decoder
+from decoder_backends import CodecSwitchingDecoder
+from song_service import SongService, DEFAULT_DOWNLOAD_WORKERS
 from logging_util import setup_logger
+from metrics import MetricsExporter
 
 # To avoid aggressive restarting
 RESTART_DELAY_SECS = 3
 SONG_BREAK_DELAY_SECS = 2
+# The play loop is woken as soon as a song is downloaded. This only bounds how long it waits before trying again
+#  anyway, in case the current song became playable some other way (e.g. it was downloaded again after eviction).
+NO_SONG_WAIT_TIMEOUT_SECS = 30
 
 main_logger = setup_logger("main", "main.log")
+startup_timer.mark("imports")
 
 
-def controlless_play_loop(player: ManagedAudioPlayer):
+def controlless_play_loop(player: ManagedAudioPlayer, song_break_delay: float):
     """Simply plays songs as they're received."""
     while True:
         song_finished = player.play_current_song()  # Will block during playback
         if song_finished:
             player.next_song()
-        sleep(SONG_BREAK_DELAY_SECS)
+            sleep(song_break_delay)
+        else:
+            player.wait_for_current_song(NO_SONG_WAIT_TIMEOUT_SECS)
 
 
-def main(use_controls: bool = True) -> None:
-    with ManagedAudioPlayer() as player:
+def main(use_controls: bool = True,
+         download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+         song_break_delay: float = SONG_BREAK_DELAY_SECS,
+         preload_next: bool = True,
+         progressive: bool = False,
+         transcode: bool = True,
+         async_service: bool = False,
+         metrics_exporter: Optional[MetricsExporter] = None,
+         fast_start: bool = True,
+         peers: Sequence[str] = (),
+         peer_port: Optional[int] = None) -> None:
+    service_options = dict(progressive=progressive, transcode=transcode, peers=peers, peer_port=peer_port)
+    if async_service:
+        from async_song_service import AsyncSongService
+        song_service = AsyncSongService(download_workers, **service_options)
+    else:
+        song_service = SongService(download_workers, **service_options)
+    if metrics_exporter is not None:
+        metrics_exporter.export(song_service.metrics)
+    # Untranscoded songs need a backend that can play their original container.
+    decoder_factory = Mpg123Decoder if transcode else CodecSwitchingDecoder
+    with ManagedAudioPlayer(song_service, preload_next, decoder_factory, fast_start) as player:
+        startup_timer.mark("player ready")
         if use_controls:
             import controls
-            controls.main_control_loop(player, SONG_BREAK_DELAY_SECS)
+            controls.main_control_loop(player, song_break_delay)
         else:
-            controlless_play_loop(player)
+            controlless_play_loop(player, song_break_delay)
 
 
-def resilient_main(use_controls: bool = True) -> None:
+def resilient_main(use_controls: bool = True,
+                   download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+                   song_break_delay: float = SONG_BREAK_DELAY_SECS,
+                   preload_next: bool = True,
+                   progressive: bool = False,
+                   transcode: bool = True,
+                   async_service: bool = False,
+                   metrics_exporter: Optional[MetricsExporter] = None,
+                   fast_start: bool = True,
+                   peers: Sequence[str] = (),
+                   peer_port: Optional[int] = None) -> None:
     """Will attempt to recover from failure to maintain uptime.
     Allow for exiting via keyboard interrupts."""
     while True:
         try:
-            main(use_controls)
+            main(use_controls, download_workers, song_break_delay, preload_next, progressive, transcode,
+                 async_service, metrics_exporter, fast_start, peers, peer_port)
         except Exception as e:
             main_logger.warning(f"Music Pi service died with error: {e}. Restarting...")
         except KeyboardInterrupt:
@@ -49,13 +93,53 @@ if __name__ == "__main__":
                         help="Will restart itself on failure until a keyboard interrupt is received.")
     parser.add_argument("-n", "--no-controls", action="store_false",
                         help="Disables controls. Without controls, it will just queue and play songs as them come in.")
+    parser.add_argument("-w", "--download-workers", type=int, default=DEFAULT_DOWNLOAD_WORKERS,
+                        help="How many songs can be downloaded at once. Defaults to the number of CPU cores.")
+    parser.add_argument("-b", "--song-break", type=float, default=SONG_BREAK_DELAY_SECS,
+                        help="Seconds of silence between songs. 0 for gapless playback.")
+    parser.add_argument("--no-preload", action="store_false",
+                        help="Disables preloading the next song in a second mpg123 instance. "
+                             "Needed if the audio output can't be opened by two processes at once.")
+    parser.add_argument("-p", "--progressive", action="store_true",
+                        help="Starts playing songs while they're still downloading, instead of waiting for them to "
+                             "finish. Seeking isn't possible until the download finishes.")
+    parser.add_argument("-t", "--no-transcode", action="store_false",
+                        help="Keeps downloaded songs in their original container instead of converting them to MP3, "
+                             "and plays them with mpv. Requires mpv to be installed.")
+    parser.add_argument("-a", "--async-service", action="store_true",
+                        help="Receives and downloads songs on an event loop and a thread pool in this process, instead "
+                             "of in separate processes. Uses less memory.")
+    parser.add_argument("--no-fast-start", action="store_false",
+                        help="Waits for the receiver and downloaders to start before playing anything, instead of "
+                             "playing already downloaded songs while they start.")
+    parser.add_argument("--metrics-file",
+                        help="Periodically writes pipeline latency and queue metrics to this file, in the Prometheus "
+                             "text format (e.g. for node_exporter's textfile collector).")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serves the same metrics over HTTP on this port, on every interface, for Prometheus to "
+                             "scrape.")
+    parser.add_argument("--peer", action="append", default=[], dest="peers", metavar="HOST:PORT",
+                        help="Another node playing from the same topic, to copy songs from instead of downloading them "
+                             "again. Can be given more than once.")
+    parser.add_argument("--peer-port", type=int,
+                        help="Serves downloaded songs to peers on this port, on every interface, and announces each "
+                             "song downloaded to them.")
     args = parser.parse_args()
+    for peer in args.peers:
+        host, _, port = peer.rpartition(":")
+        if not host or not port.isdigit():
+            parser.error(f"Peers must be given as HOST:PORT, not {peer}")
 
+    exporter = None
+    if args.metrics_file is not None or args.metrics_port is not None:
+        exporter = MetricsExporter(args.metrics_file, args.metrics_port)
+    options = (args.no_controls, args.download_workers, args.song_break, args.no_preload, args.progressive,
+               args.no_transcode, args.async_service, exporter, args.no_fast_start, args.peers, args.peer_port)
     if args.resilient:
-        resilient_main(args.no_controls)
+        resilient_main(*options)
     else:
         try:
-            main(args.no_controls)
+            main(*options)
         except KeyboardInterrupt:
             pass
 
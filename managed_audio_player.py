@@ -1,67 +1,155 @@
 from __future__ import annotations
 
-from simple_audio_player import SimpleAudioPlayer
+from typing import Optional, Callable
+
+from simple_audio_player import SimpleAudioPlayer, Decoder, Mpg123Decoder, PlaybackStatus
 from song_service import SongService
+from play_queue import PlayQueue
+from startup_timing import startup_timer
 
 INITIAL_SONG_ID = -1
 
-# TODO: Needs to accept a SongService, or a member of a interface that SongService can implement.
+# How often to check if the next song has become available to preload while the current song plays.
+PRELOAD_CHECK_INTERVAL_SECS = 1
+
+# TODO: Should accept a member of a interface that SongService can implement, instead of a SongService itself.
 #        Very hard to test as-is.
-# TODO: Also need to made thread-safe.
 
 class ManagedAudioPlayer(SimpleAudioPlayer):
-    """An audio player that supports getting the next/previous song from an underlying song service.
-    Use the next_song/previous_song"""
-    def __init__(self):
-        super().__init__()
-        self._current_song_id: int = INITIAL_SONG_ID
-        self._song_service: SongService = SongService()
+    """An audio player that plays the songs of an underlying song service, in the order of its play queue.
+    Use the next_song/previous_song
+    Not thread-safe. To control it from several threads (e.g. button callbacks), wrap it in a PlayerActor."""
+    def __init__(self, song_service: Optional[SongService] = None, preload_next: bool = True,
+                 decoder_factory: Callable[[], Decoder] = Mpg123Decoder, fast_start: bool = False):
+        """With fast_start, songs that were already downloaded can be played straight away, while the song service
+        finishes starting in the background."""
+        super().__init__(decoder_factory)
+        # Its play queue picks up where the last run left off, replaying the song that was interrupted.
+        self._song_service: SongService = SongService() if song_service is None else song_service
+
+        # A second decoder that holds the next song loaded but paused, so that moving on to it is a switch-over
+        #  instead of a cold load. Both decoders hold the audio device, so the output must allow sharing (dmix/Pulse).
+        self._standby: Optional[Decoder] = decoder_factory() if preload_next else None
+        self._standby_song_id: Optional[int] = None
+        self._played_any = False
 
-        self._song_service.start_service()
+        self._song_service.start_service(in_background=fast_start)
 
     def play_current_song(self) -> bool:
         """Will attempt to play the current song. Returns whether or not playing succeeded.
         Will fail if there are no available songs to play.
-        Blocks until playback finishes."""
-        if self._current_song_id == INITIAL_SONG_ID:
-            if self._song_service.song_available():
-                self.next_song()
-            else:
+        Blocks until playback finishes. If the current song is changed during playback (next_song/previous_song
+        followed by a stop), the new current song is played instead, and this continues blocking."""
+        while True:
+            if not self.start_current_song():
+                return False
+            playing_song_id = self.current_song_id
+            while not self.wait_for_song_finish(PRELOAD_CHECK_INTERVAL_SECS):
+                self.preload_next_song()
+            if self.current_song_id == playing_song_id:
+                return True
+
+    @property
+    def play_queue(self) -> PlayQueue:
+        """The order songs are played in. Songs can be queued, removed, moved and shuffled through it, and the current
+        song is kept playing while they are."""
+        return self._song_service.play_queue
+
+    @property
+    def current_song_id(self) -> int:
+        current = self._song_service.play_queue.current
+        return INITIAL_SONG_ID if current is None else current
+
+    def start_current_song(self) -> bool:
+        """Starts playing the current song, and returns immediately. Returns whether or not starting succeeded.
+        Will fail if there are no available songs to play."""
+        if self.current_song_id == INITIAL_SONG_ID:
+            if not self.next_song():
                 return False
+        return self._start_song(self.current_song_id)
+
+    def _start_song(self, song_id: int) -> bool:
+        if self._standby is not None and self._standby_song_id == song_id:
+            self._switch_to_standby()
         else:
-            song_path = self._song_service.get_song_path_by_song_id(self._current_song_id)
+            song_path = self._song_service.get_song_path_by_song_id(song_id)
             if song_path is None:  # Should never be None since we checked for songs above.
                 return False
-            else:
-                # Blocking
-                self.play_from_path(song_path)
-                return True
+            self.play_from_path(song_path)
+        self._song_service.report_song_started(song_id)
+        if not self._played_any:
+            self._played_any = True
+            startup_timer.mark("first song started")
+        self.preload_next_song()
+        return True
+
+    def _switch_to_standby(self) -> None:
+        """Makes the preloaded decoder the active one, and starts it playing."""
+        previous_decoder = self._decoder
+        self._decoder, self._standby = self._standby, previous_decoder
+        self._standby_song_id = None
+
+        self._apply_settings(self._decoder)
+        self._decoder.toggle_pause()  # Unpauses the preloaded song.
+        if previous_decoder.is_loaded and previous_decoder.state.status is not PlaybackStatus.STOPPED:
+            previous_decoder.stop()
+
+    def preload_next_song(self) -> None:
+        """Loads the next song into the standby decoder, if it has become available since the last call."""
+        if self._standby is None:
+            return
+        next_song_id = self._song_service.play_queue.peek_next()
+        if next_song_id is None or self._standby_song_id == next_song_id:
+            return
+        song_path = self._song_service.get_song_path_by_song_id(next_song_id)
+        if song_path is not None:
+            self._standby.load(song_path, paused=True)
+            self._standby_song_id = next_song_id
 
     def next_song(self) -> bool:
-        """Advances to the next song. Returns whether or not advancing succeeded.
+        """Advances to the next song in the play queue. Returns whether or not advancing succeeded.
         Will fail if there are no available songs to play in the song service.
         Does not affect playback of the current song. Call play_current_song after to play the song."""
-        available_songs = len(self._song_service)
-        next_song_id = self._current_song_id + 1
-
-        if next_song_id < available_songs:
-            self._current_song_id = next_song_id
-            return True
-        else:
+        play_queue = self._song_service.play_queue
+        if not play_queue.advance():
             return False
+        self._song_service.set_playback_position(play_queue.current)
+        return True
+
+    def wait_for_next_song(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until there's a song to advance to, or until the timeout elapses.
+        Returns whether there's a song to advance to."""
+        return self._song_service.wait_for_next_song(timeout)
+
+    def wait_for_current_song(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until the current song can be started, or until the timeout elapses. Returns whether it can be.
+        Before anything has been played, waits for a first song instead."""
+        return self._song_service.wait_for_current_song(timeout)
+
+    def current_song_waiter(self) -> Callable[[Optional[float]], bool]:
+        """Returns a function that does what wait_for_current_song does, but that can be called from another thread."""
+        return self._song_service.wait_for_current_song
+
+    def set_finish_listener(self, listener: Optional[Callable[[], None]]) -> None:
+        # The standby decoder becomes the active one when the next song starts, so it needs the listener too.
+        super().set_finish_listener(listener)
+        if self._standby is not None:
+            self._standby.set_finish_listener(listener)
 
     def previous_song(self) -> bool:
-        """Goes back to the previous song. Returns whether or not retreating succeeded.
+        """Goes back to the previous song in the play queue. Returns whether or not retreating succeeded.
         Will fail if there are no available songs to go back to.
         Does not affect playback of the current song. Call play_current_song after to play the song."""
-        if self._current_song_id < 1:
+        play_queue = self._song_service.play_queue
+        if not play_queue.retreat():
             return False
-        else:
-            self._current_song_id -= 1
-            return True
+        self._song_service.set_playback_position(play_queue.current)
+        return True
 
     def terminate(self) -> None:
         self._song_service.terminate_service()
+        if self._standby is not None:
+            self._standby.terminate()
         super().terminate()
 
     def __enter__(self) -> ManagedAudioPlayer:
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import os
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from time import sleep
+from typing import Callable, List, Sequence, Optional, Union
+
+from logging_util import setup_logger
+
+METRIC_PREFIX = "music_pi_"
+
+# Wide enough to cover both a cache hit (milliseconds) and a long download on a bad connection (minutes).
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# How often the metrics file is rewritten. Prometheus' textfile collector only reads it when scraped anyway.
+METRICS_FILE_INTERVAL_SECS = 15
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+metrics_logger = setup_logger("metrics", "song_service.log")
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, the same way a Prometheus histogram does."""
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.name = METRIC_PREFIX + name
+        self.description = description
+        self._buckets = sorted(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)  # The last is for everything over the highest bucket.
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._counts[bisect_left(self._buckets, value)] += 1
+            self._sum += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip([*map(_format_value, self._buckets), "+Inf"], counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f"{self.name}_sum {_format_value(total)}", f"{self.name}_count {cumulative}"]
+        return lines
+
+
+class Gauge:
+    """A value that's read when the metrics are exported, such as the length of a queue. A gauge of something that
+    only ever goes up is reported as a counter."""
+    def __init__(self, name: str, description: str, read: Callable[[], Union[int, float]], is_counter: bool = False):
+        self.name = METRIC_PREFIX + name
+        self.description = description
+        self._read = read
+        self._type = "counter" if is_counter else "gauge"
+
+    def render(self) -> List[str]:
+        try:
+            value = _format_value(self._read())
+        except (NotImplementedError, OSError, ValueError, AttributeError):
+            # E.g. the size of a queue that's closed, unsupported, or not created yet.
+            return []
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self._type}", f"{self.name} {value}"]
+
+
+class MetricsRegistry:
+    """The set of metrics that get exported together."""
+    def __init__(self):
+        self._metrics: List[Union[Histogram, Gauge]] = []
+
+    def histogram(self, name: str, description: str,
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, description, buckets)
+        self._metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, description: str, read: Callable[[], Union[int, float]],
+              is_counter: bool = False) -> Gauge:
+        gauge = Gauge(name, description, read, is_counter)
+        self._metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        return "".join(line + "\n" for metric in self._metrics for line in metric.render())
+
+
+def write_metrics_file(registry: MetricsRegistry, path: str) -> None:
+    """Replaces the file atomically, so whatever reads it never sees half of it."""
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as file:
+        file.write(registry.render())
+    os.replace(temporary_path, path)
+
+
+class MetricsExporter:
+    """Exports metrics in the background: periodically to a file, and/or over HTTP on every interface at the given
+    port, for Prometheus to scrape. Outlives the registry it exports, so that a restarted service can take over the
+    same port."""
+    def __init__(self, file_path: Optional[str] = None, port: Optional[int] = None):
+        self._registry = MetricsRegistry()
+        if file_path is not None:
+            Thread(target=self._write_forever, args=(file_path,), daemon=True).start()
+        if port is not None:
+            server = ThreadingHTTPServer(("", port), self._new_request_handler())
+            server.daemon_threads = True
+            Thread(target=server.serve_forever, daemon=True).start()
+
+    def export(self, registry: MetricsRegistry) -> None:
+        """Replaces what's being exported."""
+        self._registry = registry
+
+    def _write_forever(self, file_path: str) -> None:
+        while True:
+            try:
+                write_metrics_file(self._registry, file_path)
+            except OSError as e:
+                metrics_logger.warning(f"Could not write metrics to {file_path}: {e}")
+            sleep(METRICS_FILE_INTERVAL_SECS)
+
+    def _new_request_handler(self):
+        exporter = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = exporter._registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_) -> None:
+                pass  # Scrapes every few seconds would drown out everything else.
+
+        return MetricsRequestHandler
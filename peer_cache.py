@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from collections import OrderedDict
+from http.client import HTTPConnection, HTTPException
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import monotonic
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from logging_util import setup_logger
+
+# Nodes playing from the same topic can copy each other's downloads over the LAN instead of each downloading and
+#  transcoding the same song from YouTube. Each node serves its download directory at SONGS_PATH, and tells its peers
+#  about every song it downloads by posting to ANNOUNCE_PATH.
+#
+#  HEAD/GET /songs/<youtube ID>?extensions=mp3,webm
+#      404 if the song isn't downloaded in any of the extensions. Otherwise 200, with the song's extension in the
+#      EXTENSION_HEADER (the first of the extensions that the song is in), and the song as the body of a GET.
+#  POST /announce  {"youtube_id": ..., "port": ...}
+#      The sender has downloaded the song, and serves it on the port.
+SONGS_PATH = "/songs/"
+ANNOUNCE_PATH = "/announce"
+EXTENSION_HEADER = "X-Song-Extension"
+JSON_CONTENT_TYPE = "application/json"
+
+# How long a peer gets to answer whether it has a song, or to accept an announcement. Peers are on the same LAN, so
+#  one that takes longer is as good as down.
+PEER_QUERY_TIMEOUT_SECS = 0.5
+# How long a copy from a peer may stall before giving up on it, and downloading the song from YouTube instead.
+PEER_TRANSFER_TIMEOUT_SECS = 10
+COPY_CHUNK_SIZE = 64 * 1024
+# A song being copied from a peer is written here first, so that it never appears half finished. The song cache deletes
+#  any that are left behind.
+PEER_COPY_SUFFIX = ".peer"
+# How many songs' announcements are remembered. Older ones are still found by asking every peer.
+MAX_ANNOUNCED_SONGS = 4096
+
+peer_logger = setup_logger("peer_cache", "download.log")
+
+# "host:port"
+Peer = str
+
+
+def _split_peer(peer: Peer) -> Tuple[str, int]:
+    host, _, port = peer.rpartition(":")
+    return host, int(port)
+
+
+def _song_url(youtube_id: str, extensions: Sequence[str]) -> str:
+    return f"{SONGS_PATH}{youtube_id}?extensions={','.join(extensions)}"
+
+
+class PeerCacheServer:
+    """Serves the songs downloaded into a directory to this node's peers, and remembers which peers announced having
+    which songs. is_valid_id guards against requests for anything other than a song.
+    Requests are answered on background threads, and a port of 0 picks any free port."""
+    def __init__(self, directory: Path, port: int, is_valid_id: Callable[[str], bool]):
+        self._directory = directory
+        self._is_valid_id = is_valid_id
+        # The peers that announced having each song, most recent last. Oldest songs first.
+        self._holders: OrderedDict[str, List[Peer]] = OrderedDict()
+        self._holders_lock = Lock()
+        self._server = ThreadingHTTPServer(("", port), self._new_request_handler())
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def holders_of(self, youtube_id: str) -> List[Peer]:
+        """The peers that announced having the song, most recent first."""
+        with self._holders_lock:
+            return list(reversed(self._holders.get(youtube_id, [])))
+
+    def _record_holder(self, youtube_id: str, peer: Peer) -> None:
+        with self._holders_lock:
+            holders = self._holders.pop(youtube_id, [])
+            self._holders[youtube_id] = [*(holder for holder in holders if holder != peer), peer]
+            if len(self._holders) > MAX_ANNOUNCED_SONGS:
+                self._holders.popitem(last=False)
+
+    def _find_song(self, youtube_id: str, extensions: Sequence[str]) -> Optional[Path]:
+        for extension in extensions:
+            path = self._directory / f"{youtube_id}.{extension}"
+            if path.is_file():
+                return path
+        return None
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _new_request_handler(self):
+        cache = self
+
+        class PeerRequestHandler(BaseHTTPRequestHandler):
+            def do_HEAD(self) -> None:
+                self._send_song(with_body=False)
+
+            def do_GET(self) -> None:
+                self._send_song(with_body=True)
+
+            def _send_song(self, with_body: bool) -> None:
+                url = urlsplit(self.path)
+                youtube_id = url.path[len(SONGS_PATH):]
+                extensions = [extension for value in parse_qs(url.query).get("extensions", [])
+                              for extension in value.split(",") if extension.isalnum()]
+                if not url.path.startswith(SONGS_PATH) or not cache._is_valid_id(youtube_id):
+                    self.send_error(400)
+                    return
+                path = cache._find_song(youtube_id, extensions)
+                try:
+                    song = None if path is None else open(path, "rb")
+                except OSError:  # E.g. it was evicted just now.
+                    song = None
+                if song is None:
+                    self.send_error(404)
+                    return
+                with song:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(os.fstat(song.fileno()).st_size))
+                    self.send_header(EXTENSION_HEADER, path.suffix[1:])
+                    self.end_headers()
+                    if with_body:
+                        try:
+                            shutil.copyfileobj(song, self.wfile, COPY_CHUNK_SIZE)
+                        except OSError:  # The peer gave up on it.
+                            pass
+
+            def do_POST(self) -> None:
+                if self.path != ANNOUNCE_PATH:
+                    self.send_error(404)
+                    return
+                try:
+                    announcement = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    youtube_id, port = announcement["youtube_id"], int(announcement["port"])
+                except (ValueError, TypeError, KeyError):
+                    self.send_error(400)
+                    return
+                if not cache._is_valid_id(youtube_id):
+                    self.send_error(400)
+                    return
+                cache._record_holder(youtube_id, f"{self.client_address[0]}:{port}")
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *_) -> None:
+                pass  # Every song requested by every peer would drown out everything else.
+
+        return PeerRequestHandler
+
+
+def _has_song(peer: Peer, youtube_id: str, extensions: Sequence[str]) -> bool:
+    connection = HTTPConnection(*_split_peer(peer), timeout=PEER_QUERY_TIMEOUT_SECS)
+    try:
+        connection.request("HEAD", _song_url(youtube_id, extensions))
+        return connection.getresponse().status == 200
+    except (OSError, HTTPException):
+        return False
+    finally:
+        connection.close()
+
+
+def _peers_with_song(peers: Sequence[Peer], youtube_id: str, extensions: Sequence[str]) -> Iterator[Peer]:
+    """Asks every peer at once, and yields those that have the song as they answer. Waits at most about
+    PEER_QUERY_TIMEOUT_SECS for answers."""
+    answers: Queue = Queue()
+    for peer in peers:
+        Thread(target=lambda peer=peer: answers.put((peer, _has_song(peer, youtube_id, extensions))),
+               daemon=True).start()
+    deadline = monotonic() + PEER_QUERY_TIMEOUT_SECS
+    for _ in peers:
+        try:
+            peer, has_song = answers.get(timeout=max(0.0, deadline - monotonic()))
+        except Empty:  # The rest are too slow to be worth copying from anyway.
+            return
+        if has_song:
+            yield peer
+
+
+def _copy_from_peer(peer: Peer, youtube_id: str, extensions: Sequence[str], directory: Path) -> Optional[str]:
+    connection = HTTPConnection(*_split_peer(peer), timeout=PEER_TRANSFER_TIMEOUT_SECS)
+    copy_path = None
+    try:
+        connection.request("GET", _song_url(youtube_id, extensions))
+        response = connection.getresponse()
+        extension = response.getheader(EXTENSION_HEADER)
+        if response.status != 200 or extension not in extensions:
+            return None
+        path = str(directory / f"{youtube_id}.{extension}")
+        copy_path = path + PEER_COPY_SUFFIX
+        with open(copy_path, "wb") as file:
+            shutil.copyfileobj(response, file, COPY_CHUNK_SIZE)  # Raises IncompleteRead if the peer hangs up early.
+        os.replace(copy_path, path)
+        return path
+    except (OSError, HTTPException) as e:
+        peer_logger.warning(f"Could not copy video ID {youtube_id} from peer {peer}: {e!r}")
+        if copy_path is not None and os.path.isfile(copy_path):
+            os.remove(copy_path)
+        return None
+    finally:
+        connection.close()
+
+
+def copy_from_peers(youtube_id: str, extensions: Sequence[str], directory: Path, peers: Sequence[Peer],
+                    holders: Sequence[Peer] = ()) -> Optional[str]:
+    """Copies the song into the directory from a peer that has it in one of the extensions (most preferred first).
+    The holders (the peers known to have it) are tried first, and the other peers are only asked if none of them
+    could provide it. Returns the path of the copy, or None if no peer could provide the song."""
+    for peer in holders:
+        path = _copy_from_peer(peer, youtube_id, extensions, directory)
+        if path is not None:
+            return path
+    others = [peer for peer in peers if peer not in holders]
+    for peer in _peers_with_song(others, youtube_id, extensions):
+        path = _copy_from_peer(peer, youtube_id, extensions, directory)
+        if path is not None:
+            return path
+    return None
+
+
+def _announce(peer: Peer, youtube_id: str, port: int) -> None:
+    body = json.dumps({"youtube_id": youtube_id, "port": port}).encode("utf-8")
+    connection = HTTPConnection(*_split_peer(peer), timeout=PEER_QUERY_TIMEOUT_SECS)
+    try:
+        connection.request("POST", ANNOUNCE_PATH, body, {"Content-Type": JSON_CONTENT_TYPE})
+        connection.getresponse().read()
+    except (OSError, HTTPException):
+        pass  # The peer will ask for the song instead, if it ever wants it.
+    finally:
+        connection.close()
+
+
+def announce(youtube_id: str, port: int, peers: Sequence[Peer]) -> None:
+    """Tells every peer that this node serves the song on the port. Done in the background, so that a slow or absent
+    peer doesn't hold anything up."""
+    for peer in peers:
+        Thread(target=_announce, args=(peer, youtube_id, port), daemon=True).start()
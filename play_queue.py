@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+from random import random, randrange
+from threading import RLock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# While shuffling, how many of the songs after the current one have their place decided ahead of time, so that they
+#  can be preloaded, downloaded and kept cached before they're reached. The rest are only drawn once they're needed.
+SHUFFLE_LOOKAHEAD = 5
+
+
+class _Node:
+    """An entry in the queue. Nodes are kept in a treap ordered by position, where each node's subtree size gives the
+    positions, and the random priorities keep the tree balanced."""
+    __slots__ = ("song_id", "priority", "size", "left", "right", "parent")
+
+    def __init__(self, song_id: int):
+        self.song_id = song_id
+        self.priority = random()
+        self.size = 1
+        self.left: Optional[_Node] = None
+        self.right: Optional[_Node] = None
+        self.parent: Optional[_Node] = None
+
+    def update(self) -> None:
+        """Recalculates the size, and reclaims the children, after the children changed."""
+        self.size = 1
+        for child in (self.left, self.right):
+            if child is not None:
+                self.size += child.size
+                child.parent = self
+
+
+def _size(node: Optional[_Node]) -> int:
+    return 0 if node is None else node.size
+
+
+def _split(node: Optional[_Node], position: int) -> Tuple[Optional[_Node], Optional[_Node]]:
+    """Splits the tree into the nodes before the position, and the nodes from it on."""
+    if node is None:
+        return None, None
+    if _size(node.left) < position:
+        node.right, right = _split(node.right, position - _size(node.left) - 1)
+        node.update()
+        node.parent = None
+        return node, right
+    left, node.left = _split(node.left, position)
+    node.update()
+    node.parent = None
+    return left, node
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """Joins two trees, with every node of left coming before every node of right."""
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    right.left = _merge(left, right.left)
+    right.update()
+    return right
+
+
+def _build(nodes: List[_Node]) -> Optional[_Node]:
+    """Builds a treap out of nodes already in order, in linear time."""
+    spine: List[_Node] = []  # The rightmost path down from the root.
+    for node in nodes:
+        last = None
+        while spine and spine[-1].priority < node.priority:
+            last = spine.pop()
+        node.left = last
+        if spine:
+            spine[-1].right = node
+        spine.append(node)
+    # Sizes are only right once the children are, so they're calculated bottom-up.
+    for node in _postorder(spine[0] if spine else None):
+        node.update()
+    return spine[0] if spine else None
+
+
+def _postorder(root: Optional[_Node]) -> Iterator[_Node]:
+    stack, visited = [root] if root is not None else [], []
+    while stack:
+        node = stack.pop()
+        visited.append(node)
+        stack.extend(child for child in (node.left, node.right) if child is not None)
+    return reversed(visited)
+
+
+class PlayQueue:
+    """The order songs are played in, as a list of song IDs with a cursor on the current song. Each song is in it at
+    most once. Inserting, removing and moving songs by position, and finding a song's position, take O(log n) time, so
+    it stays responsive with tens of thousands of songs queued up.
+    The cursor stays on the current song as songs are added, removed and moved around it. It's at -1 before anything
+    has been played. Thread-safe."""
+    def __init__(self, song_ids: Iterable[int] = (), cursor: int = -1):
+        self._lock = RLock()
+        nodes = [_Node(song_id) for song_id in song_ids]
+        self._nodes: Dict[int, _Node] = {node.song_id: node for node in nodes}
+        if len(self._nodes) != len(nodes):
+            raise ValueError("Each song can only be queued once.")
+        self._root = _build(nodes)
+        if not -1 <= cursor < len(nodes):
+            raise IndexError(f"The cursor must be on one of the {len(nodes)} songs, not at {cursor}.")
+        self._cursor = cursor
+        # Songs requested to be played next go after the current song, and after any other songs requested to be
+        #  played next that haven't been reached yet. They end here.
+        self._up_next_end = cursor + 1
+        # While shuffling, the songs from here on haven't been drawn yet. See SHUFFLE_LOOKAHEAD.
+        self._undrawn_start: Optional[int] = None
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __getitem__(self, position: int) -> int:
+        with self._lock:
+            return self._node_at(position).song_id
+
+    def __contains__(self, song_id: int) -> bool:
+        return song_id in self._nodes
+
+    def __iter__(self) -> Iterator[int]:
+        """The songs in the order they're queued. Songs that haven't been drawn yet while shuffling come last, in no
+        particular order."""
+        with self._lock:
+            song_ids = []
+            self._collect(self._root, song_ids)
+        return iter(song_ids)
+
+    @property
+    def cursor(self) -> int:
+        """The position of the current song."""
+        return self._cursor
+
+    @property
+    def current(self) -> Optional[int]:
+        """The current song, or None if nothing has been played yet."""
+        with self._lock:
+            return None if self._cursor < 0 else self._node_at(self._cursor).song_id
+
+    def position_of(self, song_id: int) -> Optional[int]:
+        """Where the song is queued, or None if it isn't."""
+        with self._lock:
+            node = self._nodes.get(song_id)
+            if node is None:
+                return None
+            position = _size(node.left)
+            while node.parent is not None:
+                if node is node.parent.right:
+                    position += _size(node.parent.left) + 1
+                node = node.parent
+            return position
+
+    def upcoming(self, count: int) -> List[int]:
+        """The songs that will be played after the current one, up to count of them, soonest first."""
+        with self._lock:
+            end = min(len(self), self._cursor + 1 + count)
+            self._draw_through(end - 1)
+            return [self._node_at(position).song_id for position in range(self._cursor + 1, end)]
+
+    def around_cursor(self, count: int) -> List[int]:
+        """The current song, and up to count songs on either side of it."""
+        with self._lock:
+            end = min(len(self), self._cursor + 1 + count)
+            self._draw_through(end - 1)
+            return [self._node_at(position).song_id for position in range(max(0, self._cursor - count), end)]
+
+    def peek_next(self) -> Optional[int]:
+        """The song that advance would move to, or None if there isn't one yet."""
+        upcoming = self.upcoming(1)
+        return upcoming[0] if upcoming else None
+
+    def advance(self) -> bool:
+        """Moves the cursor on to the next song. Returns whether there was one to move to."""
+        with self._lock:
+            if self._cursor + 1 >= len(self):
+                return False
+            self._cursor += 1
+            self._draw_through(self._cursor + SHUFFLE_LOOKAHEAD)
+            return True
+
+    def retreat(self) -> bool:
+        """Moves the cursor back to the previous song. Returns whether there was one to move to."""
+        with self._lock:
+            if self._cursor < 1:
+                return False
+            self._cursor -= 1
+            return True
+
+    def append(self, song_id: int) -> None:
+        """Queues the song at the end. While shuffling, it's shuffled in with the songs that haven't been drawn yet."""
+        with self._lock:
+            self._insert(len(self), song_id)
+
+    def insert(self, position: int, song_id: int) -> None:
+        """Queues the song at the position, moving the song there (and every song after it) back by one."""
+        with self._lock:
+            if not 0 <= position <= len(self):
+                raise IndexError(f"Can't insert at {position} in a queue of {len(self)} songs.")
+            self._insert(position, song_id)
+
+    def remove(self, position: int) -> int:
+        """Removes the song at the position from the queue, and returns it. The current song can't be removed."""
+        with self._lock:
+            if not 0 <= position < len(self):
+                raise IndexError(f"There's no song at {position} in a queue of {len(self)} songs.")
+            if position == self._cursor:
+                raise ValueError("The current song can't be removed from the queue.")
+            return self._remove(position)
+
+    def move(self, from_position: int, to_position: int) -> None:
+        """Moves the song at from_position so that it ends up at to_position. If it's the current song, the cursor
+        moves with it."""
+        with self._lock:
+            if not 0 <= from_position < len(self) or not 0 <= to_position < len(self):
+                raise IndexError(f"Can't move from {from_position} to {to_position} in a queue of {len(self)} songs.")
+            is_current = from_position == self._cursor
+            self._insert(to_position, self._remove(from_position))
+            if is_current:
+                self._cursor = to_position
+                self._settle(to_position)  # Drawing swaps songs between positions, which mustn't happen to it.
+
+    def play_next(self, song_id: int) -> None:
+        """Has the song played after the current one, and after any other songs that were requested to be played
+        next before it. A song that's already queued is moved there."""
+        with self._lock:
+            if song_id == self.current:
+                return
+            target = max(self._cursor + 1, self._up_next_end)
+            position = self.position_of(song_id)
+            if position is None:
+                self.insert(target, song_id)
+            else:
+                self.move(position, target - 1 if position < target else target)
+                target = self.position_of(song_id)
+            self._up_next_end = target + 1
+            self._settle(target)
+
+    @property
+    def shuffling(self) -> bool:
+        return self._undrawn_start is not None
+
+    def shuffle(self) -> None:
+        """Plays the songs after the current one (and after those requested to be played next) in a random order,
+        along with any songs queued while shuffling. Nothing is copied: each song's place is drawn at random as it
+        comes up, which is as good as shuffling them all at once."""
+        with self._lock:
+            if self._undrawn_start is None:
+                self._undrawn_start = max(self._cursor + 1, self._up_next_end)
+            self._draw_through(self._cursor + SHUFFLE_LOOKAHEAD)
+
+    def stop_shuffling(self) -> None:
+        """Plays the songs that haven't been drawn yet, and those queued from now on, in the order they're in."""
+        with self._lock:
+            self._undrawn_start = None
+
+    def _draw_through(self, position: int) -> None:
+        """While shuffling, decides which songs go at every position up to this one. Each is drawn at random from the
+        songs that haven't been drawn yet."""
+        if self._undrawn_start is None:
+            return
+        while self._undrawn_start <= min(position, len(self) - 1):
+            drawn = randrange(self._undrawn_start, len(self))
+            if drawn != self._undrawn_start:
+                self._swap(self._undrawn_start, drawn)
+            self._undrawn_start += 1
+
+    def _settle(self, position: int) -> None:
+        """Keeps the song at the position in its place, rather than it being shuffled in with the undrawn songs."""
+        if self._undrawn_start is not None and self._undrawn_start <= position:
+            self._undrawn_start = position + 1
+
+    def _swap(self, first: int, second: int) -> None:
+        first_node, second_node = self._node_at(first), self._node_at(second)
+        first_node.song_id, second_node.song_id = second_node.song_id, first_node.song_id
+        self._nodes[first_node.song_id] = first_node
+        self._nodes[second_node.song_id] = second_node
+
+    def _node_at(self, position: int) -> _Node:
+        if not 0 <= position < len(self):
+            raise IndexError(f"There's no song at {position} in a queue of {len(self)} songs.")
+        node = self._root
+        while True:
+            left_size = _size(node.left)
+            if position < left_size:
+                node = node.left
+            elif position == left_size:
+                return node
+            else:
+                position -= left_size + 1
+                node = node.right
+
+    def _insert(self, position: int, song_id: int) -> None:
+        if song_id in self._nodes:
+            raise ValueError(f"Song {song_id} is already queued.")
+        node = _Node(song_id)
+        self._nodes[song_id] = node
+        left, right = _split(self._root, position)
+        self._root = _merge(_merge(left, node), right)
+        self._root.parent = None
+        self._shift(position, 1)
+
+    def _remove(self, position: int) -> int:
+        left, rest = _split(self._root, position)
+        node, right = _split(rest, 1)
+        self._root = _merge(left, right)
+        if self._root is not None:
+            self._root.parent = None
+        del self._nodes[node.song_id]
+        self._shift(position, -1)
+        return node.song_id
+
+    def _shift(self, position: int, change: int) -> None:
+        """Keeps the cursor and boundaries on the same songs, after a song was inserted (change of 1) or removed
+        (change of -1) at the position. A song inserted right at a boundary ends up after it."""
+        if self._cursor > position or (change > 0 and self._cursor == position):
+            self._cursor += change
+        if self._up_next_end > position:
+            self._up_next_end += change
+        if self._undrawn_start is not None and self._undrawn_start > position:
+            self._undrawn_start += change
+
+    def _collect(self, node: Optional[_Node], song_ids: List[int]) -> None:
+        stack = []
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            song_ids.append(node.song_id)
+            node = node.right
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+from concurrent.futures import Future
+from enum import Enum
+from queue import SimpleQueue, Empty
+from threading import Thread
+from time import monotonic
+from typing import Any, Callable, Optional, Tuple, TypeVar
+
+from managed_audio_player import ManagedAudioPlayer, PRELOAD_CHECK_INTERVAL_SECS
+from logging_util import setup_logger
+
+# The actor is woken as soon as a song is downloaded. This only bounds how long it waits before trying again anyway,
+#  in case the current song became playable some other way (e.g. it was downloaded again after eviction).
+NO_SONG_WAIT_TIMEOUT_SECS = 30
+
+player_logger = setup_logger("player", "player.log")
+
+T = TypeVar("T")
+Command = Callable[[ManagedAudioPlayer], Any]
+
+
+class Phase(Enum):
+    STARTING = 0  # The current song needs to be started.
+    PLAYING = 1
+    BREAK = 2  # Silence between songs.
+    WAITING = 3  # The current song couldn't be played, so waiting for it to be downloaded.
+
+
+def _wake(_: ManagedAudioPlayer) -> None:
+    """Does nothing. Posted to have the actor check on playback."""
+
+
+class PlayerActor:
+    """Owns a ManagedAudioPlayer, and plays songs as they're received like controlless_play_loop does. Other threads
+    (e.g. button callbacks) control the player by submitting commands, which are run one at a time on the thread that
+    called run, between playback steps. Nothing else may touch the player while the actor is running.
+    Changing the current song starts the new one straight away, without having to stop the old one first."""
+    def __init__(self, player: ManagedAudioPlayer, song_break_delay: float):
+        self._player = player
+        self._song_break_delay = song_break_delay
+        # Commands, each with the future for its result (or None if nobody is waiting for it).
+        self._mailbox: SimpleQueue[Tuple[Command, Optional[Future]]] = SimpleQueue()
+        self._running = False
+
+        self._phase = Phase.STARTING
+        self._playing_song_id: Optional[int] = None
+        self._break_end = 0.0
+        self._waiting_for_song = False  # Whether a thread is blocked on the song service, waiting for the current song.
+
+    def submit(self, command: Callable[[ManagedAudioPlayer], T]) -> Future:
+        """Has the actor run the command with the player, and returns immediately. The returned future holds whatever
+        the command returns (or raises)."""
+        future: Future = Future()
+        self._mailbox.put((command, future))
+        return future
+
+    def next_song(self) -> Future:
+        return self.submit(ManagedAudioPlayer.next_song)
+
+    def previous_song(self) -> Future:
+        return self.submit(ManagedAudioPlayer.previous_song)
+
+    def toggle_pause(self) -> Future:
+        return self.submit(ManagedAudioPlayer.toggle_pause)
+
+    def toggle_mute(self) -> Future:
+        return self.submit(ManagedAudioPlayer.toggle_mute)
+
+    def adjust_volume(self, adjust_amount: int) -> Future:
+        return self.submit(lambda player: player.adjust_volume(adjust_amount))
+
+    def adjust_pitch(self, adjust_amount: float) -> Future:
+        return self.submit(lambda player: player.adjust_pitch(adjust_amount))
+
+    def set_pitch(self, new_pitch: float) -> Future:
+        return self.submit(lambda player: player.set_pitch(new_pitch))
+
+    def seek_by_seconds(self, seconds: float) -> Future:
+        return self.submit(lambda player: player.seek_by_seconds(seconds))
+
+    def _post(self, command: Command) -> None:
+        self._mailbox.put((command, None))
+
+    def run(self) -> None:
+        """Plays songs and runs submitted commands until close is called. Blocks."""
+        self._running = True
+        self._player.set_finish_listener(lambda: self._post(_wake))
+        try:
+            while self._running:
+                self._drive()
+                try:
+                    message = self._mailbox.get(timeout=self._time_until_next_step())
+                except Empty:
+                    continue
+                # Everything that has piled up is run before playback is looked at again, so that a burst of input
+                #  is handled in one go.
+                while message is not None and self._running:
+                    self._run_command(*message)
+                    try:
+                        message = self._mailbox.get_nowait()
+                    except Empty:
+                        message = None
+        finally:
+            self._player.set_finish_listener(None)
+
+    def close(self) -> None:
+        """Stops run once the commands submitted before this have been run. Doesn't stop playback."""
+        self._post(self._stop_running)
+
+    def _stop_running(self, _: ManagedAudioPlayer) -> None:
+        self._running = False
+
+    def _run_command(self, command: Command, future: Optional[Future]) -> None:
+        if future is not None and not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = command(self._player)
+        except Exception as e:
+            if future is None:
+                player_logger.exception(f"Player command failed: {e}")
+            else:
+                future.set_exception(e)
+        else:
+            if future is not None:
+                future.set_result(result)
+
+    def _time_until_next_step(self) -> Optional[float]:
+        if self._phase is Phase.PLAYING:
+            return PRELOAD_CHECK_INTERVAL_SECS
+        elif self._phase is Phase.BREAK:
+            return max(0.0, self._break_end - monotonic())
+        return None  # Woken by the thread waiting for the current song.
+
+    def _drive(self) -> None:
+        """Moves playback along, as far as it can go without blocking."""
+        player = self._player
+        if self._phase is Phase.PLAYING:
+            if player.current_song_id != self._playing_song_id:
+                self._phase = Phase.STARTING
+            elif player.wait_for_song_finish(0):
+                player.next_song()
+                self._playing_song_id = player.current_song_id  # So that the break isn't taken as a song change.
+                self._phase = Phase.BREAK
+                self._break_end = monotonic() + self._song_break_delay
+            else:
+                player.preload_next_song()
+
+        if self._phase is Phase.BREAK and (monotonic() >= self._break_end
+                                           or player.current_song_id != self._playing_song_id):
+            self._phase = Phase.STARTING
+
+        if self._phase in (Phase.STARTING, Phase.WAITING):
+            if player.start_current_song():
+                self._phase = Phase.PLAYING
+                self._playing_song_id = player.current_song_id
+            else:
+                self._phase = Phase.WAITING
+                self._wait_for_current_song()
+
+    def _wait_for_current_song(self) -> None:
+        if self._waiting_for_song:
+            return
+        self._waiting_for_song = True
+        waiter = self._player.current_song_waiter()
+
+        def wait() -> None:
+            waiter(NO_SONG_WAIT_TIMEOUT_SECS)
+            self._post(self._stop_waiting)
+        Thread(target=wait, daemon=True).start()
+
+    def _stop_waiting(self, _: ManagedAudioPlayer) -> None:
+        self._waiting_for_song = False
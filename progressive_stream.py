@@ -0,0 +1,76 @@
+import errno
+import os
+import shutil
+import tempfile
+from threading import Thread
+from time import sleep, monotonic
+
+from logging_util import setup_logger
+
+# How long to wait for more of the song to be written once playback has caught up with the download.
+FOLLOW_POLL_SECS = 0.2
+# How long the FIFO waits for a player to open it before the stream is abandoned.
+READER_OPEN_TIMEOUT_SECS = 60
+CHUNK_SIZE = 64 * 1024
+
+stream_logger = setup_logger("stream", "song_service.log")
+
+
+def stream_while_growing(growing_path: str, final_path: str) -> str:
+    """Returns the path of a FIFO that a player can load to play a song that is still being written to growing_path.
+    A background thread copies the song into the FIFO from the start, following the file as it grows, and ends the
+    stream once the song has been moved to final_path (finished) or deleted (failed)."""
+    fifo_directory = tempfile.mkdtemp(prefix="music_pi_stream_")
+    fifo_path = os.path.join(fifo_directory, os.path.basename(final_path))
+    os.mkfifo(fifo_path)
+    Thread(target=_feed_fifo, args=(growing_path, final_path, fifo_path), daemon=True).start()
+    return fifo_path
+
+
+def _open_fifo_for_writing(fifo_path: str) -> int:
+    """Opening a FIFO blocks until a reader opens it too, which may never happen (e.g. a preloaded song that gets
+    replaced). Retries a non-blocking open instead, so that the wait can be given up on."""
+    deadline = monotonic() + READER_OPEN_TIMEOUT_SECS
+    while True:
+        try:
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            os.set_blocking(fd, True)  # From here on, writes should wait for the player to catch up.
+            return fd
+        except OSError as e:
+            if e.errno != errno.ENXIO or monotonic() > deadline:  # ENXIO: No reader yet.
+                raise
+            sleep(FOLLOW_POLL_SECS)
+
+
+def _feed_fifo(growing_path: str, final_path: str, fifo_path: str) -> None:
+    try:
+        try:
+            # Moving the file once it's finished doesn't affect an already open handle.
+            source = open(growing_path, "rb")
+        except FileNotFoundError:  # Finished in the meantime.
+            source = open(final_path, "rb")
+
+        with source:
+            fifo_fd = _open_fifo_for_writing(fifo_path)
+            try:
+                writer_finished = False
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if chunk:
+                        os.write(fifo_fd, chunk)
+                    elif writer_finished:
+                        break
+                    elif os.path.exists(growing_path):
+                        sleep(FOLLOW_POLL_SECS)  # Caught up with the download.
+                    else:
+                        # The file was moved (finished) or deleted (failed), so nothing else will be written. One more
+                        #  pass picks up anything written just before then.
+                        writer_finished = True
+            finally:
+                os.close(fifo_fd)
+    except BrokenPipeError:
+        pass  # The player stopped reading (skipped or replaced). Not an error.
+    except OSError as e:
+        stream_logger.warning(f"Streaming {growing_path} stopped: {e}")
+    finally:
+        shutil.rmtree(os.path.dirname(fifo_path), ignore_errors=True)
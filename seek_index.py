@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import os
+import struct
+from typing import NamedTuple, Optional
+
+from logging_util import setup_logger
+
+# Kept in a subdirectory of the song's directory, where the song cache doesn't mistake them for leftover files.
+SEEK_INDEX_DIRECTORY_NAME = ".seek"
+SEEK_INDEX_EXTENSION = "seek"
+
+# magic, sample rate, samples per frame, frame count, song size.
+HEADER_FORMAT = "<4sIIIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Indexes written by earlier versions, which also held frame offsets, have a different magic, so they're rebuilt.
+MAGIC = b"MSK2"
+
+ID3V2_HEADER_SIZE = 10
+# The first frame of an MP3 made by LAME (which is what FFmpeg uses) or a Fraunhofer encoder holds these tags instead
+#  of audio. mpg123 doesn't count it as a frame.
+INFO_FRAME_TAGS = (b"Xing", b"Info", b"VBRI")
+
+MPEG1, MPEG2, MPEG25 = 3, 2, 0
+LAYER1, LAYER2, LAYER3 = 3, 2, 1
+# Kilobits per second, by (is MPEG1, layer) and the header's bitrate index.
+BITRATES = {
+    (True, LAYER1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, LAYER2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, LAYER3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, LAYER1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, LAYER2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, LAYER3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {MPEG1: (44100, 48000, 32000), MPEG2: (22050, 24000, 16000), MPEG25: (11025, 12000, 8000)}
+
+index_logger = setup_logger("seek_index", "download.log")
+
+
+class FrameHeader(NamedTuple):
+    version: int
+    layer: int
+    sample_rate: int
+    samples_per_frame: int
+    length: int
+
+
+def parse_frame_header(header: bytes) -> Optional[FrameHeader]:
+    """Returns None if the four bytes aren't the header of an MPEG audio frame."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (header[1] >> 3) & 3, (header[1] >> 1) & 3
+    bitrate_index, sample_rate_index, padding = header[2] >> 4, (header[2] >> 2) & 3, (header[2] >> 1) & 1
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None  # Reserved values, or a free format bitrate, which can't be indexed without decoding.
+    bitrate = BITRATES[version == MPEG1, layer][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if layer == LAYER1:
+        return FrameHeader(version, layer, sample_rate, 384, (12 * bitrate // sample_rate + padding) * 4)
+    samples_per_frame = 576 if layer == LAYER3 and version != MPEG1 else 1152
+    return FrameHeader(version, layer, sample_rate, samples_per_frame,
+                       samples_per_frame // 8 * bitrate // sample_rate + padding)
+
+
+class SeekIndex(NamedTuple):
+    """How many frames an MP3 has, and how long they are. MPEG audio frames all hold the same number of samples, so
+    times and frames convert exactly, even in VBR files."""
+    sample_rate: int
+    samples_per_frame: int
+    frame_count: int
+    # So that an index can be told apart from one for an earlier download of the same song.
+    song_size: int
+
+    @property
+    def seconds_per_frame(self) -> float:
+        return self.samples_per_frame / self.sample_rate
+
+    @property
+    def duration(self) -> float:
+        return self.frame_count * self.seconds_per_frame
+
+    def frame_at(self, seconds: float) -> int:
+        """The frame playing at the given time, clamped to the song."""
+        return min(max(int(seconds / self.seconds_per_frame), 0), self.frame_count)
+
+    def seconds_at(self, frame: int) -> float:
+        return frame * self.seconds_per_frame
+
+
+def build_seek_index(song_path: str) -> Optional[SeekIndex]:
+    """Scans the MP3's frame headers. Returns None if no frames were found (e.g. it isn't an MP3)."""
+    with open(song_path, "rb") as file:
+        data = file.read()
+
+    position = 0
+    if data[:3] == b"ID3" and len(data) >= ID3V2_HEADER_SIZE:  # Skipped, since it can contain false frame syncs.
+        tag_size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | data[9] & 0x7F
+        footer_size = ID3V2_HEADER_SIZE if data[5] & 0x10 else 0
+        position = ID3V2_HEADER_SIZE + tag_size + footer_size
+
+    first: Optional[FrameHeader] = None
+    frame_count = 0
+    while position + 4 <= len(data):
+        header = parse_frame_header(data[position:position + 4])
+        # Anything that doesn't match the first frame's format is a false sync (e.g. in a trailing tag).
+        if header is None or first is not None and header[:3] != first[:3]:
+            position += 1
+            continue
+        if first is None:
+            first = header
+            if any(tag in data[position:position + header.length] for tag in INFO_FRAME_TAGS):
+                position += header.length
+                continue
+        frame_count += 1
+        position += header.length
+
+    if first is None or frame_count == 0:
+        return None
+    return SeekIndex(first.sample_rate, first.samples_per_frame, frame_count, len(data))
+
+
+def seek_index_path(song_path: str) -> str:
+    directory, file_name = os.path.split(song_path)
+    return os.path.join(directory, SEEK_INDEX_DIRECTORY_NAME, f"{file_name}.{SEEK_INDEX_EXTENSION}")
+
+
+def save_seek_index(index: SeekIndex, song_path: str) -> None:
+    """Replaces any earlier index atomically, so that a reader never sees half of one."""
+    path = seek_index_path(song_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(struct.pack(HEADER_FORMAT, MAGIC, index.sample_rate, index.samples_per_frame, index.frame_count,
+                               index.song_size))
+    os.replace(temporary_path, path)
+
+
+def load_seek_index(song_path: str) -> Optional[SeekIndex]:
+    """Returns None if the song has no index, or its index doesn't match it (e.g. it was downloaded again since)."""
+    try:
+        with open(seek_index_path(song_path), "rb") as file:
+            magic, sample_rate, samples_per_frame, frame_count, song_size = \
+                struct.unpack(HEADER_FORMAT, file.read(HEADER_SIZE))
+        if magic != MAGIC or song_size != os.path.getsize(song_path):
+            return None
+    except (OSError, struct.error, ValueError):
+        return None
+    return SeekIndex(sample_rate, samples_per_frame, frame_count, song_size)
+
+
+def index_song(song_path: str) -> Optional[SeekIndex]:
+    """Builds and saves the song's index. Failing to is logged rather than raised, since the song still plays (and
+    seeks, less precisely) without one."""
+    try:
+        index = build_seek_index(song_path)
+        if index is not None:
+            save_seek_index(index, song_path)
+        return index
+    except OSError as e:
+        index_logger.warning(f"Could not index {song_path}: {e}")
+        return None
+
+
+def remove_seek_index(song_path: str) -> None:
+    try:
+        os.remove(seek_index_path(song_path))
+    except FileNotFoundError:
+        pass
@@ -1,6 +1,15 @@
 from __future__ import annotations
+import os
 import subprocess as sp
+from abc import ABC, abstractmethod
+from enum import Enum
+from queue import SimpleQueue, Empty
+from threading import Thread, Event, Lock
+from time import monotonic
+from typing import NamedTuple, Optional, IO, List, Sequence, Dict, Callable
+
 from logging_util import setup_logger
+from seek_index import SeekIndex, load_seek_index
 
 player_logger = setup_logger("player", "player.log")
 
@@ -9,19 +18,489 @@ COMMAND = "mpg123 -R"
 # Commands are only characters in the ASCII set.
 STDIN_ENCODING = "ascii"
 
-END_PLAYBACK_SENTINEL = b"@P 0"
 ERROR_SENTINEL = b"@E"
+STATUS_PREFIX = b"@P "
+FRAME_PREFIX = b"@F "
+SAMPLE_PREFIX = b"@SAMPLE "
+STREAM_INFO_PREFIX = b"@S"
+
+# How often mpg123 is asked where playback is. In between, the position is worked out from the time that has passed
+#  since, so this only corrects drift. 0 has mpg123 report every frame itself instead (dozens of lines a second), and
+#  None never asks.
+DEFAULT_PROGRESS_INTERVAL_SECS = 5
+# mpg123's output is read in chunks of up to this many bytes, rather than a line at a time.
+READ_CHUNK_SIZE = 64 * 1024
+
+# Commands that set an absolute value, so only the last of them in a batch has any effect.
+COLLAPSIBLE_COMMANDS = {"volume", "pitch"}
+
+
+class PlaybackStatus(Enum):
+    # Matches the numbers that mpg123 -R reports in its "@P" lines.
+    STOPPED = 0
+    PAUSED = 1
+    PLAYING = 2
+
+
+class PlayerState(NamedTuple):
+    """A snapshot of what the decoder last reported. While playing, mpg123's position is extrapolated from its last
+    report."""
+    status: PlaybackStatus
+    frame: int
+    frames_left: int
+    seconds: float
+    seconds_left: float
+    last_error: Optional[str]
 
 
 def clamp(n: int, min_n: int, max_n: int) -> int:
     return min(max_n, max(min_n, n))
 
 
-# TODO: Make play_from_path non-blocking, and provide a wait_for_song_finish() method that relies on an Event?
-class SimpleAudioPlayer:
-    """An audio player wrapper over mpg123 that allows for control of playback."""
+def collapse_redundant(commands: Sequence[str]) -> List[str]:
+    """Drops commands that are overridden by a later command of the same kind. Relative changes (a "+" or "-"
+    argument) are always kept since they depend on what came before them."""
+    last_absolute_index: Dict[str, int] = {}
+    for i, command in enumerate(commands):
+        name, _, argument = command.partition(" ")
+        if name in COLLAPSIBLE_COMMANDS and not argument.startswith(("+", "-")):
+            last_absolute_index[name] = i
+
+    kept = []
+    for i, command in enumerate(commands):
+        name, _, argument = command.partition(" ")
+        is_absolute = name in COLLAPSIBLE_COMMANDS and not argument.startswith(("+", "-"))
+        if not is_absolute or last_absolute_index[name] == i:
+            kept.append(command)
+    return kept
+
+
+class CommandChannel:
+    """The only writer to a mpg123 process's STDIN.
+    Callers queue commands and return immediately. A single writer thread sends everything that has queued up since
+    its last write in one write, so concurrent callers can't interleave partial commands and bursts of commands
+    cost a single syscall."""
+    def __init__(self, pipe: IO[bytes], collapse: bool = True):
+        self._pipe = pipe
+        self._collapse = collapse
+        self._pending: SimpleQueue = SimpleQueue()  # Tuples of commands to be sent together, or None to close.
+        self._writer_thread = Thread(target=self._write_forever, daemon=True)
+        self._writer_thread.start()
+
+    def send(self, *commands: str) -> None:
+        """Queues the commands to be written together, in order."""
+        self._pending.put(commands)
+
+    def close(self) -> None:
+        """Stops the writer once everything already queued has been written."""
+        self._pending.put(None)
+
+    def _write_forever(self) -> None:
+        while True:
+            batches = [self._pending.get()]
+            try:
+                while True:
+                    batches.append(self._pending.get_nowait())
+            except Empty:
+                pass
+
+            closing = None in batches
+            commands = [command for batch in batches if batch is not None for command in batch]
+            if self._collapse:
+                commands = collapse_redundant(commands)
+            try:
+                if commands:
+                    # Apparently, writing directly to the STDIN can cause dead-locks, according to the Python
+                    #  documentation. The alternative though (.communicate) don't work when sending commands without
+                    #  wanting to wait for the process to terminate.
+                    self._pipe.write(b"".join(command.encode(STDIN_ENCODING) + b"\n" for command in commands))
+                    self._pipe.flush()
+            except (BrokenPipeError, ValueError) as e:  # The process has exited, or the pipe was closed.
+                player_logger.warning(f"Could not send {commands} to mpg123: {e}")
+                return
+            if closing:
+                return
+
+
+class Decoder(ABC):
+    """Something that can decode and play songs on behalf of SimpleAudioPlayer."""
+    @abstractmethod
+    def load(self, song_path: str, paused: bool = False) -> None:
+        """Starts playing the given song. If paused, the song is loaded and held at its start until resumed with
+        toggle_pause, so that it can start playing without any loading delay."""
+
+    @abstractmethod
+    def stop(self) -> None: ...
+
+    @abstractmethod
+    def toggle_pause(self) -> None: ...
+
+    @abstractmethod
+    def set_volume(self, volume: int) -> None: ...
+
+    @abstractmethod
+    def set_pitch(self, pitch: float) -> None:
+        """The pitch is a relative speed change. 0.01 plays 1% faster."""
+
+    @abstractmethod
+    def seek_by(self, samples: int) -> None: ...
+
+    @abstractmethod
+    def seek_to(self, seconds: float) -> None:
+        """Jumps to the given time in the current song."""
+
+    @property
+    def seek_index(self) -> Optional[SeekIndex]:
+        """The current song's seek index, if it has one."""
+        return None
+
+    def apply_settings(self, volume: int, pitch: float) -> None:
+        """Brings the decoder's volume and pitch in line with the player's, for when it's about to take over
+        playback."""
+        self.set_pitch(pitch)
+        self.set_volume(volume)
+
+    @property
+    @abstractmethod
+    def state(self) -> PlayerState: ...
+
+    @property
+    @abstractmethod
+    def is_loaded(self) -> bool: ...
+
+    @abstractmethod
+    def wait_for_song_finish(self, timeout: Optional[float] = None) -> bool: ...
+
+    @abstractmethod
+    def set_finish_listener(self, listener: Optional[Callable[[], None]]) -> None:
+        """Has the listener called, from another thread, whenever wait_for_song_finish stops blocking. It may also be
+        called when nothing finished, so it should only be used as a cue to check."""
+
+    @abstractmethod
+    def terminate(self) -> None: ...
+
+
+class ProcessDecoder(Decoder, ABC):
+    """A decoder backed by a player process. Keeps track of what the process reports on a background thread, so that
+    nothing else ever has to block on reading its output. Subclasses translate the process's output into calls to the
+    _report_* methods."""
     def __init__(self):
-        self._player_process: sp.Popen = sp.Popen(COMMAND.split(), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.DEVNULL)
+        self._state_lock = Lock()
+        self._state = PlayerState(PlaybackStatus.STOPPED, 0, 0, 0.0, 0.0, None)
+        self._song_finished = Event()
+        self._song_finished.set()  # Nothing is playing yet.
+        self._finish_listener: Optional[Callable[[], None]] = None
+        # Set between sending a load and the process acknowledging it. A stop reported during that time belongs to
+        #  the previous song, and must not be mistaken for the new song finishing.
+        self._awaiting_start = False
+
+        # Needed because if you send a "stop" to mpg123 before a "load", it breaks it in odd ways. It makes the output
+        #  violate the current assumptions; causing play_current_song to need to be called twice, and makes it
+        #  non-blocking. We need to prevent accidental stops from breaking things.
+        self._is_loaded = False
+
+        # Loaded when it's first needed, since most songs are never seeked in.
+        self._song_path: Optional[str] = None
+        self._seek_index: Optional[SeekIndex] = None
+
+    def _start_reader(self) -> None:
+        Thread(target=self._read_output, daemon=True).start()
+
+    @abstractmethod
+    def _read_output(self) -> None:
+        """Runs on the reader thread until the process exits."""
+
+    @abstractmethod
+    def _send_load(self, song_path: str, paused: bool) -> None: ...
+
+    @abstractmethod
+    def _send_stop(self) -> None: ...
+
+    @abstractmethod
+    def _send_seek_to(self, seconds: float) -> None: ...
+
+    def _report_started(self) -> None:
+        with self._state_lock:
+            self._awaiting_start = False
+
+    def _report_position(self, **positions) -> None:
+        with self._state_lock:
+            self._awaiting_start = False
+            self._state = self._state._replace(**positions)
+
+    def _report_status(self, status: PlaybackStatus) -> None:
+        with self._state_lock:
+            if status is PlaybackStatus.STOPPED and self._awaiting_start:
+                return  # The previous song stopping. See _awaiting_start.
+            self._awaiting_start = False
+            self._state = self._state._replace(status=status)
+        if status is PlaybackStatus.STOPPED:
+            self._finish_song()
+
+    def _report_error(self, error: str) -> None:
+        player_logger.error(error)
+        with self._state_lock:
+            failed_to_start = self._awaiting_start
+            self._awaiting_start = False
+            self._state = self._state._replace(last_error=error)
+            if failed_to_start:  # The song couldn't be loaded, so it's never going to report finishing.
+                self._state = self._state._replace(status=PlaybackStatus.STOPPED)
+        if failed_to_start:
+            self._finish_song()
+
+    def _report_exited(self) -> None:
+        # Nothing else is going to finish, so release anyone waiting.
+        with self._state_lock:
+            self._state = self._state._replace(status=PlaybackStatus.STOPPED)
+        self._finish_song()
+
+    def _finish_song(self) -> None:
+        self._song_finished.set()
+        listener = self._finish_listener
+        if listener is not None:
+            listener()
+
+    @property
+    def state(self) -> PlayerState:
+        with self._state_lock:
+            return self._state
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._is_loaded
+
+    def load(self, song_path: str, paused: bool = False) -> None:
+        with self._state_lock:
+            self._awaiting_start = True
+            # A preloaded song doesn't report its position until it's unpaused, so the old song's would linger.
+            self._state = self._state._replace(frame=0, frames_left=0, seconds=0.0, seconds_left=0.0)
+        self._song_path, self._seek_index = song_path, None
+        self._song_finished.clear()
+        self._send_load(song_path, paused)
+        self._is_loaded = True
+
+    @property
+    def seek_index(self) -> Optional[SeekIndex]:
+        if self._seek_index is None and self._song_path is not None:
+            # Not remembered if missing, since the song may still be being indexed after its download.
+            self._seek_index = load_seek_index(self._song_path)
+        return self._seek_index
+
+    def seek_to(self, seconds: float) -> None:
+        self._send_seek_to(seconds)
+        index = self.seek_index
+        if index is not None:
+            # Reported straight away, so that a seek relative to this one (before the process reports its new
+            #  position) starts from the right place.
+            frame = index.frame_at(seconds)
+            self._report_position(frame=frame, frames_left=index.frame_count - frame, seconds=index.seconds_at(frame),
+                                  seconds_left=index.duration - index.seconds_at(frame))
+
+    def stop(self) -> None:
+        if self._is_loaded:
+            self._send_stop()
+            self._is_loaded = False
+        else:
+            player_logger.warning("Attempted to stop a player that wasn't yet loaded.")
+
+    def wait_for_song_finish(self, timeout: Optional[float] = None) -> bool:
+        return self._song_finished.wait(timeout)
+
+    def set_finish_listener(self, listener: Optional[Callable[[], None]]) -> None:
+        self._finish_listener = listener
+
+
+class Mpg123Decoder(ProcessDecoder):
+    """A single mpg123 -R process. Only plays MP3s.
+    mpg123 is told to stop reporting every frame it plays, and is asked for its position every progress_interval
+    seconds instead (see DEFAULT_PROGRESS_INTERVAL_SECS), so that playback barely wakes this process up."""
+    def __init__(self, progress_interval: Optional[float] = DEFAULT_PROGRESS_INTERVAL_SECS):
+        super().__init__()
+        self._progress_interval = progress_interval
+        # From the current song's "@S" line, which is sent once it starts decoding. Needed to convert sample
+        #  positions, and extrapolation only starts once it's known.
+        self._sample_rate: Optional[int] = None
+        self._samples_per_frame = 1152
+        self._speed = 1.0
+        # When the position in the state was last known. See _extrapolated.
+        self._positioned_at = monotonic()
+        self._terminated = Event()
+
+        self._process: sp.Popen = sp.Popen(COMMAND.split(), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.DEVNULL)
+        self._commands = CommandChannel(self._process.stdin)
+        if progress_interval != 0:
+            self.send_command("silence")
+        self._start_reader()
+        if progress_interval:
+            Thread(target=self._poll_position_forever, daemon=True).start()
+
+    def send_command(self, *commands: str) -> None:
+        """Sends one or more commands. Multiple commands are sent together in a single write."""
+        self._commands.send(*commands)
+
+    def _read_output(self) -> None:
+        """Reads whatever output has built up in one go, instead of a line at a time."""
+        stdout = self._process.stdout.fileno()
+        unfinished_line = b""
+        while True:
+            try:
+                chunk = os.read(stdout, READ_CHUNK_SIZE)
+            except OSError:
+                break
+            if not chunk:
+                break
+            *lines, unfinished_line = (unfinished_line + chunk).split(b"\n")
+            for line in lines:
+                self._handle_line(line)
+        self._report_exited()
+
+    def _handle_line(self, line: bytes) -> None:
+        # mpg123 -R reports a "@P 0" status when playback has finished, and an "@E" line when an error happens.
+        #  Everything else that isn't handled here (e.g. ID3 tags and volume changes) is ignored.
+        if line.startswith(FRAME_PREFIX):
+            self._handle_frame_line(line)
+        elif line.startswith(STATUS_PREFIX):
+            self._handle_status_line(line)
+        elif line.startswith(ERROR_SENTINEL):
+            self._report_error(line[len(ERROR_SENTINEL):].decode(STDIN_ENCODING, errors="replace").strip())
+        elif line.startswith(SAMPLE_PREFIX):
+            self._handle_sample_line(line)
+        elif line.startswith(STREAM_INFO_PREFIX):
+            self._handle_stream_info_line(line)
+
+    def _poll_position_forever(self) -> None:
+        while not self._terminated.wait(self._progress_interval):
+            if self._is_loaded and self._state.status is PlaybackStatus.PLAYING:
+                self.send_command("sample")
+
+    def _extrapolated(self, state: PlayerState) -> PlayerState:
+        """The state, with the position moved on by however long has been played since it was last known. Must be
+        called with the state lock held."""
+        if state.status is not PlaybackStatus.PLAYING or self._sample_rate is None:
+            return state
+        elapsed = (monotonic() - self._positioned_at) * self._speed
+        if state.seconds_left:
+            elapsed = min(elapsed, state.seconds_left)
+        frames = int(elapsed * self._sample_rate / self._samples_per_frame)
+        return state._replace(frame=state.frame + frames, frames_left=max(0, state.frames_left - frames),
+                              seconds=state.seconds + elapsed, seconds_left=max(0.0, state.seconds_left - elapsed))
+
+    def _reposition(self, **positions) -> None:
+        """Settles the extrapolated position (with any new positions applied) as the last known one, from now."""
+        with self._state_lock:
+            self._state = self._extrapolated(self._state)._replace(**positions)
+            self._positioned_at = monotonic()
+
+    @property
+    def state(self) -> PlayerState:
+        with self._state_lock:
+            return self._extrapolated(self._state)
+
+    def _report_position(self, **positions) -> None:
+        with self._state_lock:
+            self._awaiting_start = False
+            self._state = self._state._replace(**positions)
+            self._positioned_at = monotonic()
+
+    def _report_status(self, status: PlaybackStatus) -> None:
+        self._reposition()  # Up to the moment the status changed, since a paused song's position stands still.
+        super()._report_status(status)
+
+    def _handle_stream_info_line(self, line: bytes) -> None:
+        try:
+            version, layer, sample_rate = line[len(STREAM_INFO_PREFIX):].split()[:3]
+            layer, sample_rate = int(layer), int(sample_rate)
+        except ValueError:
+            player_logger.warning(f"Unexpected stream info line from mpg123: {line!r}")
+            self._report_started()
+            return
+        with self._state_lock:
+            self._awaiting_start = False
+            self._sample_rate = sample_rate
+            self._samples_per_frame = 384 if layer == 1 else 1152 if layer == 2 or version == b"1.0" else 576
+            self._positioned_at = monotonic()
+
+    def _handle_sample_line(self, line: bytes) -> None:
+        try:
+            sample, total_samples = map(int, line[len(SAMPLE_PREFIX):].split()[:2])
+        except ValueError:
+            player_logger.warning(f"Unexpected sample line from mpg123: {line!r}")
+            return
+        sample_rate, samples_per_frame = self._sample_rate, self._samples_per_frame
+        if sample_rate is None:
+            return
+        samples_left = max(0, total_samples - sample)  # The total is negative if mpg123 doesn't know it.
+        self._report_position(frame=sample // samples_per_frame, frames_left=samples_left // samples_per_frame,
+                              seconds=sample / sample_rate, seconds_left=samples_left / sample_rate)
+
+    def _handle_frame_line(self, line: bytes) -> None:
+        try:
+            frame, frames_left, seconds, seconds_left = line[len(FRAME_PREFIX):].split()
+            self._report_position(frame=int(frame), frames_left=int(frames_left),
+                                  seconds=float(seconds), seconds_left=float(seconds_left))
+        except ValueError:
+            player_logger.warning(f"Unexpected frame line from mpg123: {line!r}")
+
+    def _handle_status_line(self, line: bytes) -> None:
+        try:
+            status = PlaybackStatus(int(line[len(STATUS_PREFIX):].split()[0]))
+        except (ValueError, IndexError):
+            player_logger.warning(f"Unexpected status line from mpg123: {line!r}")
+            return
+        self._report_status(status)
+
+    def load(self, song_path: str, paused: bool = False) -> None:
+        with self._state_lock:
+            self._sample_rate = None  # Until the new song starts decoding.
+        super().load(song_path, paused)
+
+    def _send_load(self, song_path: str, paused: bool) -> None:
+        self.send_command(f"{'loadpaused' if paused else 'load'} {song_path}")
+
+    def _send_stop(self) -> None:
+        self.send_command("stop")
+
+    def toggle_pause(self) -> None:
+        self.send_command("pause")
+
+    def set_volume(self, volume: int) -> None:
+        self.send_command(f"volume {volume}")
+
+    def set_pitch(self, pitch: float) -> None:
+        self._set_speed(pitch)
+        self.send_command(f"pitch {pitch:f}")
+
+    def _set_speed(self, pitch: float) -> None:
+        """mpg123's pitch changes the playback speed too, which the extrapolation has to keep up with."""
+        self._reposition()
+        self._speed = 1 + pitch
+
+    def seek_by(self, samples: int) -> None:
+        # Where it lands is asked for straight away, since it's the one thing that can't be extrapolated.
+        self.send_command(f"seek {samples:+f}", "sample")
+
+    def _send_seek_to(self, seconds: float) -> None:
+        index = self.seek_index
+        if index is not None:
+            self.send_command(f"jump {index.frame_at(seconds)}")
+        else:  # mpg123 works out the frame itself, scanning the song if it has to.
+            self.send_command(f"jump {seconds:f}s", "sample")
+
+    def apply_settings(self, volume: int, pitch: float) -> None:
+        self._set_speed(pitch)
+        self.send_command(f"pitch {pitch:f}", f"volume {volume}")
+
+    def terminate(self) -> None:
+        self._terminated.set()
+        self._commands.close()
+        self._process.kill()  # mpg123 doesn't respond to SIGTERMs for some reason unfortunately.
+        self._process.wait()
+
+
+class SimpleAudioPlayer:
+    """An audio player wrapper over mpg123 (or another Decoder) that allows for control of playback."""
+    def __init__(self, decoder_factory: Callable[[], Decoder] = Mpg123Decoder):
+        self._decoder = decoder_factory()
 
         # mpg123 does absolute volume setting. To avoid needing to do a lookup to set volume, we're maintaining
         #  an internal volume level. This value is relative to and independent of the system volume.
@@ -29,52 +508,43 @@ class SimpleAudioPlayer:
 
         # For the same reason as above
         self._pitch = 0
-        self.set_pitch(self._pitch)
 
         # To ensure that the real and "cached" volumes are in sync.
-        self.set_volume(self._volume)
+        self._apply_settings(self._decoder)
 
         # The MUTE command isn't available in some versions of MPG123. Manually saving/restoring volume instead.
         self._saved_mute_volume = None
 
-        # Needed because if you send a "stop" to mpg123 before a "load", it breaks it in odd ways. It makes the output
-        #  violate the current assumptions; causing play_current_song to need to be called twice, and makes it
-        #  non-blocking. We need to prevent accidental stops from breaking things.
-        self._is_loaded = False
+    def _apply_settings(self, decoder: Decoder) -> None:
+        """Brings a decoder's volume and pitch in line with the player's, for when it's about to take over playback."""
+        decoder.apply_settings(self._volume, self._pitch)
 
-    def _send_command(self, command: str) -> None:
-        # Apparently, writing directly to the STDIN can cause dead-locks, according to the Python documentation.
-        # The alternative though (.communicate) don't work when sending commands without wanting to wait for the
-        #  process to terminate.
-        self._player_process.stdin.write(command.encode(STDIN_ENCODING) + b"\n")
-        self._player_process.stdin.flush()
+    @property
+    def state(self) -> PlayerState:
+        return self._decoder.state
 
     def play_from_path(self, song_path: str) -> None:
-        """Starts playing the given song. Blocks until the song finishes."""
-        self._send_command(f"load {song_path}")
-        self._is_loaded = True
+        """Starts playing the given song. Returns immediately. Use wait_for_song_finish to wait for it to end."""
+        self._decoder.load(song_path)
 
-        # mpg123 -R outputs a certain sentinel line when playback has finished, or when an error happens.
-        while True:
-            line = self._player_process.stdout.readline()
-            if line.startswith(ERROR_SENTINEL):
-                player_logger.error(line[len(ERROR_SENTINEL):])  # Remove prefix and log error.
-            if line.startswith(END_PLAYBACK_SENTINEL) or not line:
-                break
+    def wait_for_song_finish(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until the current song finishes, is stopped, or fails to play.
+        Returns False if the timeout elapsed first."""
+        return self._decoder.wait_for_song_finish(timeout)
+
+    def set_finish_listener(self, listener: Optional[Callable[[], None]]) -> None:
+        """See Decoder.set_finish_listener."""
+        self._decoder.set_finish_listener(listener)
 
     def stop(self) -> None:
-        if self._is_loaded:
-            self._send_command("stop")
-            self._is_loaded = False
-        else:
-            player_logger.warning("Attempted to stop a player that wasn't yet loaded.")
+        self._decoder.stop()
 
     def toggle_pause(self) -> None:
-        self._send_command("pause")
+        self._decoder.toggle_pause()
 
     def set_volume(self, new_volume: int) -> None:
         self._volume = clamp(new_volume, 0, 100)
-        self._send_command(f"volume {self._volume}")
+        self._decoder.set_volume(self._volume)
 
     def adjust_volume(self, adjust_amount: int) -> None:
         """The provided adjustment should be an integer between -100 and 100 indicating how much to adjust the
@@ -92,19 +562,42 @@ class SimpleAudioPlayer:
             self._saved_mute_volume = None
 
     def seek_by(self, seek_by: int) -> None:
-        self._send_command(f"seek {seek_by:+f}")
+        self._decoder.seek_by(seek_by)
+
+    def seek_to(self, seconds: float) -> None:
+        """Jumps to the given time in the current song. Jumping past the end finishes the song."""
+        duration = self.duration
+        self._decoder.seek_to(max(0.0, seconds if duration is None else min(seconds, duration)))
+
+    def seek_by_seconds(self, seconds: float) -> None:
+        """Jumps forwards (or backwards, if negative) by the given number of seconds."""
+        self.seek_to(self.position + seconds)
+
+    @property
+    def position(self) -> float:
+        """How many seconds into the current song playback is."""
+        return self._decoder.state.seconds
+
+    @property
+    def duration(self) -> Optional[float]:
+        """How long the current song is in seconds, or None if that isn't known yet. Exact if the song has a seek
+        index. Otherwise it's the decoder's estimate, which is only known once the song is playing."""
+        index = self._decoder.seek_index
+        if index is not None:
+            return index.duration
+        state = self._decoder.state
+        return state.seconds + state.seconds_left if state.seconds_left else None
 
     def adjust_pitch(self, adjust_amount: float) -> None:
         self.set_pitch(self._pitch + adjust_amount)
 
     def set_pitch(self, new_pitch: float) -> None:
         self._pitch = new_pitch
-        self._send_command(f"pitch {new_pitch:f}")
+        self._decoder.set_pitch(new_pitch)
 
     def terminate(self):
         """Should be called either directly or via a context manager to terminate the player process."""
-        self._player_process.kill()  # mpg123 doesn't respond to SIGTERMs for some reason unfortunately.
-        self._player_process.wait()
+        self._decoder.terminate()
 
     def __enter__(self) -> SimpleAudioPlayer:
         return self
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from threading import RLock, Timer
+from time import time
+from typing import Dict, Iterable, List, Set, Sequence, Optional
+
+from logging_util import setup_logger
+
+INDEX_FILE_NAME = "cache_index.json"
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_MAX_FILES = 1000
+# Songs are touched on every registration and every play. Rewriting the index each time wears out SD cards, so changes
+#  are gathered and written at most this often. Losing them in a crash only loses use times, not songs.
+INDEX_FLUSH_INTERVAL_SECS = 60
+
+cache_logger = setup_logger("song_cache", "song_cache.log")
+
+
+class _Entry:
+    __slots__ = ("file_name", "size", "last_used")
+
+    def __init__(self, file_name: str, size: int, last_used: float):
+        self.file_name = file_name
+        self.size = size
+        self.last_used = last_used
+
+
+class SongCache:
+    """Tracks the downloaded songs kept in a directory across restarts, and evicts the least recently used ones once
+    the directory grows beyond its quota.
+    The index is only a record of sizes and use times. The files themselves are the source of truth. Call flush to write
+    out the last changes to it. Thread-safe."""
+    def __init__(self, directory: Path, extensions: Sequence[str],
+                 max_bytes: int = DEFAULT_MAX_BYTES, max_files: int = DEFAULT_MAX_FILES):
+        self._directory = directory
+        self._extensions = extensions
+        self._max_bytes = max_bytes
+        self._max_files = max_files
+
+        self._index_path = directory / INDEX_FILE_NAME
+        self._entries: Dict[str, _Entry] = {}
+        self._total_bytes = 0
+        self._lock = RLock()
+        # Set while there are changes that haven't been written to the index yet.
+        self._flush_timer: Optional[Timer] = None
+
+    def path_for(self, youtube_id: str) -> Optional[Path]:
+        """Returns the path of the song's file, or None if there isn't one."""
+        with self._lock:
+            entry = self._entries.get(youtube_id)
+        if entry is not None:
+            path = self._directory / entry.file_name
+            if path.is_file():
+                return path
+        # Not indexed yet. Songs keep the container they were downloaded in, so it could be any of the extensions.
+        for extension in self._extensions:
+            path = self._directory / f"{youtube_id}.{extension}"
+            if path.is_file():
+                return path
+        return None
+
+    def load(self) -> None:
+        """Reads the index, then reconciles it against what is actually on disk.
+        Leftovers of interrupted downloads are deleted, and finished songs missing from the index are adopted."""
+        self._directory.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(self._index_path, "r") as file:
+                raw_index = json.load(file)
+        except FileNotFoundError:
+            raw_index = {}
+        except (OSError, ValueError) as e:
+            cache_logger.warning(f"Discarding unreadable cache index: {e}")
+            raw_index = {}
+
+        with self._lock:
+            self._adopt_files(raw_index)
+            self._save()
+
+    def _adopt_files(self, raw_index: Dict[str, Dict]) -> None:
+        self._entries.clear()
+        for file_name in os.listdir(self._directory):
+            path = self._directory / file_name
+            if not path.is_file() or path == self._index_path:
+                continue
+            youtube_id, _, extension = file_name.rpartition(".")
+            if extension not in self._extensions or not youtube_id:
+                # A partial download, or a file the configured player can't play (e.g. the source left behind by an
+                #  interrupted transcode).
+                os.remove(path)
+                continue
+            stat = path.stat()
+            last_used = raw_index.get(youtube_id, {}).get("last_used", stat.st_mtime)
+            self._entries[youtube_id] = _Entry(file_name, stat.st_size, last_used)
+
+        self._total_bytes = sum(entry.size for entry in self._entries.values())
+
+    def __contains__(self, youtube_id: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(youtube_id)
+        return entry is not None and (self._directory / entry.file_name).is_file()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def touch(self, youtube_id: str) -> None:
+        """Records that the song was just used. Adds it to the index if it was just downloaded."""
+        with self._lock:
+            entry = self._entries.get(youtube_id)
+            if entry is None:
+                path = self.path_for(youtube_id)
+                if path is None:
+                    return
+                size = path.stat().st_size
+                self._entries[youtube_id] = _Entry(path.name, size, time())
+                self._total_bytes += size
+            else:
+                entry.last_used = time()
+            self._save_later()
+
+    def forget(self, youtube_id: str) -> None:
+        """Drops a song from the index whose file has gone missing."""
+        with self._lock:
+            entry = self._entries.pop(youtube_id, None)
+            if entry is not None:
+                self._total_bytes -= entry.size
+                self._save_later()
+
+    def evict(self, protected_ids: Iterable[str] = ()) -> List[str]:
+        """Deletes least recently used songs until the cache is within its quota. Songs in protected_ids are never
+        evicted, even if that leaves the cache over quota. Returns the IDs of the evicted songs."""
+        with self._lock:
+            return self._evict(set(protected_ids))
+
+    def _evict(self, protected: Set[str]) -> List[str]:
+        evicted = []
+        if not self._over_quota():
+            return evicted
+
+        candidates = sorted((entry.last_used, youtube_id)
+                            for youtube_id, entry in self._entries.items()
+                            if youtube_id not in protected)
+        for _, youtube_id in candidates:
+            if not self._over_quota():
+                break
+            entry = self._entries.pop(youtube_id)
+            self._total_bytes -= entry.size
+            try:
+                os.remove(self._directory / entry.file_name)
+            except FileNotFoundError:
+                pass
+            evicted.append(youtube_id)
+
+        if evicted:
+            cache_logger.info(f"Evicted {len(evicted)} songs. "
+                              f"{len(self._entries)} songs, {self._total_bytes} bytes remain.")
+            self._save()
+        return evicted
+
+    def _over_quota(self) -> bool:
+        return self._total_bytes > self._max_bytes or len(self._entries) > self._max_files
+
+    def _save_later(self) -> None:
+        if self._flush_timer is None:
+            self._flush_timer = Timer(INDEX_FLUSH_INTERVAL_SECS, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self) -> None:
+        """Writes any changes that haven't been written to the index yet."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._save()
+
+    def _save(self) -> None:
+        """Writes the index straight away, including any changes that were waiting to be written."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        # Written to the side then swapped in so that a power cut mid-write can't leave a truncated index.
+        serialized = {youtube_id: {"file_name": entry.file_name, "size": entry.size, "last_used": entry.last_used}
+                      for youtube_id, entry in self._entries.items()}
+        temp_path = self._index_path.with_suffix(".tmp")
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(serialized, file)
+            os.replace(temp_path, self._index_path)
+        except OSError as e:
+            cache_logger.warning(f"Could not write the cache index: {e}")
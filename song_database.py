@@ -1,34 +1,102 @@
-from typing import Dict, Optional, Iterator, Tuple
+import mmap
+import os
+import struct
+import tempfile
+from typing import Dict, Optional, Iterator, Tuple, Union
 
 # yid = "YouTube ID". The video ID in the URL.
 # sid = The local song ID, unrelated to the YouTube ID. Used for sequencing.
 
+# The index file is a header followed by fixed-width records. A song's ID is the position of its record, so only the
+#  YouTube ID needs to be stored. Each record ends in a newline, so that a record torn by a crash can be recognized.
+HEADER = struct.Struct("<4s4xq")  # Magic, then the saved playback position.
+MAGIC = b"MPH1"
+NO_SAVED_POSITION = -1
+RECORD_SIZE = 16
+RECORD_TERMINATOR = b"\n"
+MAX_YOUTUBE_ID_BYTES = RECORD_SIZE - len(RECORD_TERMINATOR)
+YOUTUBE_ID_ENCODING = "ascii"
+
+
 class IDCache:
-    """Maintains bidirectional associations between YouTube video IDs and song sequence IDs."""
-    def __init__(self):
-        self._next_id = 0
+    """Maintains bidirectional associations between YouTube video IDs and song sequence IDs.
+    The associations are kept in an append-only, memory-mapped index file, so they survive restarts. Only the
+    YouTube ID -> song ID direction is held in memory. Without an index path, a temporary file is used instead."""
+    def __init__(self, index_path: Union[str, os.PathLike, None] = None):
+        if index_path is None:
+            self._file = tempfile.TemporaryFile()
+            self._fd = self._file.fileno()
+        else:
+            self._file = None
+            self._fd = os.open(index_path, os.O_RDWR | os.O_CREAT, 0o644)
 
-        # Emulating a bidirectional dictionary
-        self._sid_to_yid: Dict[int, str] = {}
+        self._next_id = 0
+        self._map: Optional[mmap.mmap] = None
         self._yid_to_sid: Dict[str, int] = {}
+        self._recover()
+
+    def _recover(self) -> None:
+        """Loads the index, dropping anything after the last complete record (a write interrupted by a crash)."""
+        size = os.fstat(self._fd).st_size
+        if size < HEADER.size:
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, HEADER.pack(MAGIC, NO_SAVED_POSITION), 0)
+            os.fsync(self._fd)
+            size = HEADER.size
+        elif os.pread(self._fd, len(MAGIC), 0) != MAGIC:
+            raise RuntimeError("The song history index is not in a recognized format.")
+
+        self._remap()
+        record_count = (size - HEADER.size) // RECORD_SIZE
+        for song_id in range(record_count):
+            record = self._record(song_id)
+            youtube_id = record.rstrip(b"\0\n")
+            if not record.endswith(RECORD_TERMINATOR) or not youtube_id:
+                break
+            self._yid_to_sid[youtube_id.decode(YOUTUBE_ID_ENCODING)] = song_id
+            self._next_id = song_id + 1
+
+        valid_size = HEADER.size + self._next_id * RECORD_SIZE
+        if valid_size != size:
+            os.ftruncate(self._fd, valid_size)
+            self._remap()
 
-    def _associate(self, song_id: int, youtube_id: str) -> None:
-        self._sid_to_yid[song_id] = youtube_id
-        self._yid_to_sid[youtube_id] = song_id
+    def _remap(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+
+    def _record(self, song_id: int) -> bytes:
+        start = HEADER.size + song_id * RECORD_SIZE
+        if start + RECORD_SIZE > len(self._map):  # Appended since the last mapping.
+            self._remap()
+        return self._map[start:start + RECORD_SIZE]
+
+    def _append(self, youtube_id: str) -> None:
+        encoded = youtube_id.encode(YOUTUBE_ID_ENCODING)
+        if not encoded or len(encoded) > MAX_YOUTUBE_ID_BYTES or RECORD_TERMINATOR in encoded:
+            raise ValueError(f"Can't store the YouTube ID {youtube_id!r}.")
+        record = encoded.ljust(MAX_YOUTUBE_ID_BYTES, b"\0") + RECORD_TERMINATOR
+        # A single write of a small record, so a crash leaves either the whole record or a detectable partial one.
+        os.pwrite(self._fd, record, HEADER.size + self._next_id * RECORD_SIZE)
+        os.fdatasync(self._fd)
 
     def register_song(self, youtube_id: str) -> int:
         """Registers a song into the database. Returns the ID of the inserted song."""
         existing_id = self._yid_to_sid.get(youtube_id)
         if existing_id is None:
             song_id = self._next_id
+            self._append(youtube_id)
             self._next_id += 1
-            self._associate(song_id, youtube_id)
+            self._yid_to_sid[youtube_id] = song_id
             return song_id
         else:
             return existing_id
 
     def get_youtube_id_from_song_id(self, song_id: int) -> Optional[str]:
-        return self._sid_to_yid.get(song_id)
+        if 0 <= song_id < self._next_id:
+            return self._record(song_id).rstrip(b"\0\n").decode(YOUTUBE_ID_ENCODING)
+        return None
 
     def get_song_id_from_youtube_id(self, youtube_id: str) -> Optional[int]:
         return self._yid_to_sid.get(youtube_id)
@@ -36,9 +104,25 @@ class IDCache:
     def next_song_id(self) -> int:
         return self._next_id
 
+    @property
+    def saved_playback_position(self) -> Optional[int]:
+        """The song ID last saved by save_playback_position, so playback can resume after a restart."""
+        _, position = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+        return None if position == NO_SAVED_POSITION else position
+
+    def save_playback_position(self, song_id: int) -> None:
+        os.pwrite(self._fd, HEADER.pack(MAGIC, song_id), 0)
+
+    def close(self) -> None:
+        self._map.close()
+        if self._file is None:
+            os.close(self._fd)
+        else:
+            self._file.close()
+
     def __iter__(self) -> Iterator[Tuple[int, str]]:
         """Produces tuples of (song_id, youtube_id)."""
-        return iter((k, v) for k, v in self._sid_to_yid.items())
+        return iter((song_id, self.get_youtube_id_from_song_id(song_id)) for song_id in range(self._next_id))
 
     def __len__(self) -> int:
-        return len(self._sid_to_yid)
+        return self._next_id
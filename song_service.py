@@ -1,88 +1,514 @@
 from __future__ import annotations
 
+import json
 import os
-from multiprocessing import Process, Queue
+import re
+from collections import deque, OrderedDict
+from multiprocessing import Process, Queue, Value
 from pathlib import Path, PurePath
 from random import choices
 from string import ascii_letters
-from typing import Optional, Tuple, Iterator
+from typing import Optional, Tuple, Iterator, Dict, List, Set, NamedTuple, Callable, Deque, Sequence
 import ssl
-
-from paho.mqtt.subscribe import callback as subscribe_with_callback
-from youtube_dl.utils import YoutubeDLError
+from logging import Logger
+from queue import Empty, Full
+from threading import Lock, RLock, Thread, Event
+from time import monotonic, time, sleep
+from typing import TYPE_CHECKING
 
 from logging_util import setup_logger
 from song_database import IDCache
-from youtube_downloader import download_audio
+from song_cache import SongCache, DEFAULT_MAX_BYTES, DEFAULT_MAX_FILES
+from youtube_downloader import YoutubeDownloader, partial_path, is_permanent_error
+from progressive_stream import stream_while_growing
 from broker_config import Config
+from metrics import MetricsRegistry
+from download_scheduler import DownloadScheduler
+from play_queue import PlayQueue
+from seek_index import index_song, remove_seek_index
+from peer_cache import PeerCacheServer, Peer, copy_from_peers, announce
+from startup_timing import startup_timer
+
+# paho and youtube_dl are only imported once they're needed (in the receiver and downloaders), since importing them
+#  takes long enough on a Pi to noticeably delay the first song.
+if TYPE_CHECKING:
+    import paho.mqtt.client as mqtt
 
 PAYLOAD_ENCODING = "UTF-8"
 MUSIC_EXTENSION = "mp3"
+# The containers that songs are left in when they aren't transcoded.
+SOURCE_EXTENSIONS = ("webm", "m4a", "opus", "ogg", "mp4")
+MUSIC_EXTENSIONS = (MUSIC_EXTENSION, *SOURCE_EXTENSIONS)
+
+# How many of the most recently accepted IDs are remembered to drop duplicate requests. A duplicate of an older one is
+#  downloaded (or found in the cache) again, but it's only queued again if it was already played.
+MAX_ACCEPTED_IDS = 4096
 
 CLIENT_ID_BASE = "MusicPiClient"
 CLIENT_ID_POST_LENGTH = 5
+RECONNECT_MIN_DELAY_SECS = 1
+RECONNECT_MAX_DELAY_SECS = 60
+
+# Requests waiting for a downloader. Beyond this, the downloaders have fallen far enough behind that accepting more
+#  only uses memory.
+RECEIVE_QUEUE_MAX_SIZE = 100
+# How long a message waits for room in a full receive queue before the rest of its requests are shed. While it waits,
+#  nothing else is received, and a QoS 1 message isn't acknowledged, so the broker holds back too. Kept well under the
+#  keepalive interval so the connection survives the wait.
+RECEIVE_QUEUE_FULL_TIMEOUT_SECS = 10
+
+# Downloading is mostly network and FFmpeg bound, so one worker per core keeps the Pi busy without thrashing it.
+DEFAULT_DOWNLOAD_WORKERS = os.cpu_count() or 1
+
+# In progressive mode, how much of a song must be written before it's registered and can start playing.
+#  About 2.5 seconds at 192 kbps.
+PROGRESSIVE_PLAYABLE_BYTES = 64 * 1024
+
+# How many songs on either side of the current song in the play queue are kept safe from cache eviction.
+CACHE_PROTECTED_WINDOW = 5
 
 CONFIG_PATH = "broker.cfg"
-CONFIG = Config.from_file(CONFIG_PATH)
+# Read from CONFIG_PATH on first use (see get_config), unless set before then.
+CONFIG: Optional[Config] = None
 
 
 # The current folder. Prevents relying on the CWD, which may cause problems if the client
 #   is started from a different directory.
 PROJECT_PATH = Path(__file__).parent.absolute()
 DOWNLOAD_DIRECTORY = PROJECT_PATH / "download"
+# Every song ever registered, so that song IDs (and the playback position) carry over between runs.
+HISTORY_PATH = PROJECT_PATH / "song_history.idx"
+# A persistent session belongs to a client ID, so the ID is kept between runs.
+CLIENT_ID_PATH = PROJECT_PATH / "mqtt_client_id"
+
+# Anything else can't be downloaded, and wouldn't fit in the history index.
+YOUTUBE_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{11}")
+
+# A download that fails for a transient reason (see is_permanent_error) is retried in place, waiting twice as long
+#  before each attempt. Songs requested after it aren't registered until it's given up on, so the total wait is kept
+#  short.
+DOWNLOAD_MAX_ATTEMPTS = 4
+DOWNLOAD_RETRY_MIN_DELAY_SECS = 2
+DOWNLOAD_RETRY_MAX_DELAY_SECS = 30
+# How many of the most recent failed downloads are kept for inspection. See SongService.dead_letters.
+DEAD_LETTER_MAX_SIZE = 100
+
+# How often the supervisor checks whether the receiver and downloaders are still alive.
+SUPERVISOR_INTERVAL_SECS = 1
+# A child process that dies is restarted after this long, doubling each time it dies again soon after being started
+#  (e.g. while the broker is unreachable), so that it doesn't spin.
+WORKER_RESTART_MIN_DELAY_SECS = 1
+WORKER_RESTART_MAX_DELAY_SECS = 60
+# How long a child process must have run for its restart delay to start over from the minimum.
+WORKER_STABLE_SECS = 60
+
+# The sequence number of a request to play a song next. It's downloaded before anything else, and registered as soon as
+#  it's downloaded instead of in arrival order. See PlayQueue.play_next.
+PLAY_NEXT = -1
 
 service_logger = setup_logger("song_service", "song_service.log")
 
 
-def _song_path(youtube_id: str) -> str:
-    return f"{PurePath(DOWNLOAD_DIRECTORY) / youtube_id}.{MUSIC_EXTENSION}"
+class RequestTimes(NamedTuple):
+    """When a request reached each stage. Wall clock times, since they're compared between processes."""
+    received: float
+    download_started: Optional[float] = None
+    downloaded: Optional[float] = None
+
+
+def get_config() -> Config:
+    global CONFIG
+    if CONFIG is None:
+        CONFIG = Config.from_file(CONFIG_PATH)
+    return CONFIG
+
+
+def parse_request_payload(payload: bytes) -> Tuple[List[str], bool]:
+    """A message holds either a single video ID, or a JSON list of them (e.g. a whole playlist). Either can instead be
+    wrapped in a JSON object as {"play_next": ...} to play the songs right after the current one.
+    Returns the video IDs, and whether they should be played next. Raises ValueError if the message can't be
+    understood."""
+    text = payload.decode(PAYLOAD_ENCODING).strip()
+    if not text.startswith(("[", "{")):
+        return [text], False
+    parsed = json.loads(text)
+    play_next = isinstance(parsed, dict)
+    if play_next:
+        if "play_next" not in parsed:
+            raise ValueError("Expected a play_next key.")
+        parsed = parsed["play_next"]
+        if isinstance(parsed, str):
+            parsed = [parsed]
+    if not isinstance(parsed, list):
+        raise ValueError("Expected a list of video IDs.")
+    return [str(youtube_id).strip() for youtube_id in parsed], play_next
+
 
+# (sequence_number, youtube_id, times). See SongService.__init__.
+Request = Tuple[Optional[int], Optional[str], RequestTimes]
 
-def _clear_downloaded() -> None:
-    """Deletes all regular files in the download directory."""
-    if DOWNLOAD_DIRECTORY.is_dir():  # If the download directory exists
-        for file in os.listdir(DOWNLOAD_DIRECTORY):
-            path = Path(DOWNLOAD_DIRECTORY, file)
-            if path.is_file():
-                os.remove(path)
+
+class DeadLetter(NamedTuple):
+    """A request that couldn't be downloaded, and why."""
+    youtube_id: str
+    error: str
+    attempts: int
+    # Whether retrying would be pointless, e.g. because the video is private or was removed.
+    permanent: bool
+    failed_at: float
+
+
+class RequestIntake:
+    """Turns received messages into numbered requests, dropping invalid IDs and songs that were already accepted.
+    Lives wherever messages are received: the receiver process, or the event loop of an AsyncSongService.
+    queue_request is given each new request, whether the song is already cached (in one of the extensions), and the
+    time by which it must be queued; and returns whether it was queued, or had to be shed. The next sequence number is
+    shared, so that a restarted receiver carries on numbering where the one before it stopped."""
+    def __init__(self, queue_request: Callable[[Request, bool, float], bool], next_sequence_number: Value,
+                 duplicates_suppressed: Value, requests_shed: Value, logger: Logger, extensions: Sequence[str]):
+        self._queue_request = queue_request
+        self._extensions = extensions
+        self._next_sequence_number = next_sequence_number
+        self._duplicates_suppressed = duplicates_suppressed
+        self._requests_shed = requests_shed
+        self._logger = logger
+        # The IDs that have been queued or downloaded, including those still in flight. Oldest first.
+        self._accepted_ids: OrderedDict[str, None] = OrderedDict()
+
+    def forget(self, youtube_id: str) -> None:
+        """Allows the song to be requested again, since its download failed."""
+        self._accepted_ids.pop(youtube_id, None)
+
+    def _remember(self, youtube_id: str) -> None:
+        self._accepted_ids[youtube_id] = None
+        self._accepted_ids.move_to_end(youtube_id)
+        if len(self._accepted_ids) > MAX_ACCEPTED_IDS:
+            self._accepted_ids.popitem(last=False)
+
+    def handle_message(self, payload: bytes) -> None:
+        try:
+            youtube_ids, play_next = parse_request_payload(payload)
+        except ValueError as e:
+            self._logger.warning(f"Ignoring unreadable message {payload[:100]!r}: {e}")
+            return
+
+        deadline = monotonic() + RECEIVE_QUEUE_FULL_TIMEOUT_SECS
+        shed = 0
+        for youtube_id in youtube_ids:
+            if not YOUTUBE_ID_PATTERN.fullmatch(youtube_id):
+                self._logger.warning(f"Ignoring invalid video ID {youtube_id!r}.")
+            elif play_next:
+                self._accept_play_next(youtube_id)
+            elif not self._accept(youtube_id, deadline):
+                shed += 1
+        if shed:
+            with self._requests_shed.get_lock():
+                self._requests_shed.value += shed
+            self._logger.warning(f"The downloaders are too far behind. Shed {shed} requests.")
+
+    def _accept(self, youtube_id: str, deadline: float) -> bool:
+        """Returns whether the request was queued, or False if it had to be shed."""
+        if youtube_id in self._accepted_ids:
+            with self._duplicates_suppressed.get_lock():
+                self._duplicates_suppressed.value += 1
+            return True
+
+        request = (self._next_sequence_number.value, youtube_id, RequestTimes(time()))
+        if not self._queue_request(request, _find_song_path(youtube_id, self._extensions) is not None, deadline):
+            return False
+        # Only used up once the request is queued, so that shed requests don't leave gaps that would hold back the
+        #  registration of everything after them.
+        self._next_sequence_number.value += 1
+        self._remember(youtube_id)
+        return True
+
+    def _accept_play_next(self, youtube_id: str) -> None:
+        """Never dropped as a duplicate, since it's a request to hear the song again (or sooner), and never shed."""
+        cached = _find_song_path(youtube_id, self._extensions) is not None
+        self._queue_request((PLAY_NEXT, youtube_id, RequestTimes(time())), cached, 0)
+        self._remember(youtube_id)
+
+
+def new_mqtt_client(on_payload: Callable[[bytes], None], logger: Logger) -> mqtt.Client:
+    """Creates a client that subscribes to the requests topic whenever it connects, and passes every message's payload
+    to on_payload. The client isn't connected."""
+    import paho.mqtt.client as mqtt
+    config = get_config()
+    connected_before = False
+
+    def on_connect(client, user_data, flags, result_code):
+        nonlocal connected_before
+        if result_code == mqtt.CONNACK_ACCEPTED:
+            # Subscribing again on every reconnect is harmless with a persistent session, and needed without.
+            client.subscribe(config.topic, config.qos)
+            logger.info(f"Connected. Session resumed: {bool(flags.get('session present'))}")
+            if not connected_before:
+                connected_before = True
+                startup_timer.mark("receiver connected")
+        else:
+            logger.warning(f"Connection refused: {mqtt.connack_string(result_code)}")
+
+    def on_disconnect(client, user_data, result_code):
+        if result_code != mqtt.MQTT_ERR_SUCCESS:
+            logger.warning(f"Lost connection to the MQTT server ({mqtt.error_string(result_code)}). Reconnecting...")
+
+    # With a persistent session (and QoS 1), the broker keeps any messages sent while disconnected.
+    client = mqtt.Client(client_id=_client_id(), clean_session=not config.persistent_session)
+    client.username_pw_set(config.username, config.password)
+    if config.tls:
+        client.tls_set(tls_version=ssl.PROTOCOL_TLS)
+    client.reconnect_delay_set(RECONNECT_MIN_DELAY_SECS, RECONNECT_MAX_DELAY_SECS)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = lambda client, user_data, message: on_payload(message.payload)
+    return client
+
+
+def _client_id() -> str:
+    # If all instances have the same ID and this process gets stuck open somehow, it will cause problems as soon as
+    #  another client with the same client ID connects (reconnecting loop between two processes). Each installation
+    #  gets its own random ID, and without a persistent session, so does each run.
+    random_id = f"{CLIENT_ID_BASE}_{''.join(choices(ascii_letters, k=CLIENT_ID_POST_LENGTH))}"
+    if not get_config().persistent_session:
+        return random_id
+    try:
+        return CLIENT_ID_PATH.read_text().strip()
+    except FileNotFoundError:
+        CLIENT_ID_PATH.write_text(random_id)
+        return random_id
+
+
+def _song_path(youtube_id: str, extension: str = MUSIC_EXTENSION) -> str:
+    return f"{PurePath(DOWNLOAD_DIRECTORY) / youtube_id}.{extension}"
+
+
+def _find_song_path(youtube_id: str, extensions: Sequence[str]) -> Optional[str]:
+    """Returns the path of the downloaded song, whichever of the extensions it's in. None if it hasn't been
+    downloaded."""
+    for extension in extensions:
+        path = _song_path(youtube_id, extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+class SupervisedProcess:
+    """A child process that's replaced whenever it dies, so that one crashed worker doesn't take the rest of the
+    service down with it. on_death is called once for each death, before the replacement is started."""
+    def __init__(self, name: str, new_process: Callable[[], Process], on_death: Optional[Callable[[], None]] = None):
+        self.name = name
+        self._new_process = new_process
+        self._on_death = on_death
+        self.process = new_process()
+        self.restarts = 0
+        self._started_at = 0.0
+        self._restart_delay = WORKER_RESTART_MIN_DELAY_SECS
+        self._restart_at: Optional[float] = None
+
+    def start(self) -> None:
+        self.process.start()
+        self._started_at = monotonic()
+
+    def check(self) -> None:
+        """Restarts the process if it has died, once its restart delay has passed. Doesn't wait for the delay."""
+        if self.process.is_alive():
+            return
+        now = monotonic()
+        if self._restart_at is None:
+            if now - self._started_at >= WORKER_STABLE_SECS:
+                self._restart_delay = WORKER_RESTART_MIN_DELAY_SECS
+            service_logger.warning(f"The {self.name} died with exit code {self.process.exitcode}. "
+                                   f"Restarting it in {self._restart_delay}s.")
+            if self._on_death is not None:
+                self._on_death()
+            self._restart_at = now + self._restart_delay
+            self._restart_delay = min(self._restart_delay * 2, WORKER_RESTART_MAX_DELAY_SECS)
+        if now >= self._restart_at:
+            self.process.close()
+            self.process = self._new_process()
+            self.start()
+            self._restart_at = None
+            self.restarts += 1
+
+    def stop(self) -> None:
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def join(self) -> None:
+        try:
+            self.process.join()
+            self.process.close()
+        except (AssertionError, ValueError):  # Never started, or already closed after dying.
+            pass
 
 
 # Can have song_id (or get_next_song) requests given to it
 class SongService:
-    def __init__(self):
-        self._available_song_ids: IDCache = IDCache()
+    def __init__(self, download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+                 cache_max_bytes: int = DEFAULT_MAX_BYTES, cache_max_files: int = DEFAULT_MAX_FILES,
+                 progressive: bool = False, transcode: bool = True,
+                 peers: Sequence[Peer] = (), peer_port: Optional[int] = None):
+        """Songs are copied from any of the peers (other nodes, as "host:port") that already downloaded them, instead
+        of being downloaded again. With a peer_port, this node's songs are served to its peers on that port (0 for
+        any free port), and each song it downloads is announced to them."""
+        self._available_song_ids: IDCache = IDCache(HISTORY_PATH)
 
-        self._receive_queue: Queue = Queue()  # The queue of what requests have been received. Waiting to be downloaded.
-        self._downloaded_queue: Queue = Queue()  # The queue of what has finished downloading. Waiting to be acknowledged.
+        # Whether downloaded songs are converted to MP3. Without it, they need a player backend that can decode the
+        #  source container (see CodecSwitchingDecoder).
+        self._transcode = transcode
 
+        # In progressive mode, songs are registered as soon as the start of them has been downloaded, and are
+        #  streamed to the player while the rest downloads.
+        self._progressive = progressive
+
+        # See peer_cache. The server is started with the service.
+        self._peers = list(peers)
+        self._peer_port = peer_port
+        self._peer_server: Optional[PeerCacheServer] = None
+
+        # Downloaded songs are kept between runs so re-requests don't need to be downloaded again.
+        # Transcoded songs are played with mpg123, which can only play MP3s. Anything else is left over from a
+        #  transcode that was interrupted.
+        self._playable_extensions = (MUSIC_EXTENSION,) if transcode else MUSIC_EXTENSIONS
+        self._cache = SongCache(DOWNLOAD_DIRECTORY, self._playable_extensions, cache_max_bytes, cache_max_files)
+        # Registered songs are queued in the order they're registered, and the queue starts where the last run left
+        #  off. Reordering the queue isn't saved between runs.
+        saved_position = self.saved_playback_position
+        self._play_queue = PlayQueue(range(len(self._available_song_ids)),
+                                     -1 if saved_position is None else saved_position)
+
+        # The request queues carry (sequence_number, youtube_id, RequestTimes) tuples. The sequence number is the order
+        #  the request was received in, and is used to register songs in arrival order even if the downloads finish
+        #  out of order. Evicted songs that need to be downloaded again were already registered, so they're sent with
+        #  a sequence number of None. Progressively downloaded songs are sent once when they become playable, then
+        #  again with a sequence number of None once they've finished. Requests to play a song next are sent with a
+        #  sequence number of PLAY_NEXT.
+        # The queue of what has finished downloading. Waiting to be acknowledged.
+        self._downloaded_queue: Queue = self._new_queue()
+        # Requests waiting to be downloaded, handed to the downloaders in the order they'll be needed for playback.
+        self._scheduler = DownloadScheduler(self._songs_until_needed, RECEIVE_QUEUE_MAX_SIZE)
+
+        self._next_sequence_number = self._new_counter("q")
+        self._duplicates_suppressed = self._new_counter("i")
+        self._requests_shed = self._new_counter("i")
+        self._peer_copies = self._new_counter("i")
+
+        # Requests that failed for good, sent by the downloaders. Drained into dead_letters when it's read.
+        self._dead_letter_queue: Queue = self._new_queue()
+        self._dead_letters: Deque[DeadLetter] = deque(maxlen=DEAD_LETTER_MAX_SIZE)
+        self._dead_letter_count = 0
+
+        # Downloads that finished before an earlier request did. Held until all earlier requests are accounted for.
+        self._pending_registrations: Dict[int, Tuple[Optional[str], RequestTimes]] = {}
+        self._next_registration_number = 0
+        self._redownloading: Set[str] = set()
+        # Downloads are drained by whichever thread needs them, such as the player, and a thread waiting for a song to
+        #  be downloaded. Anything else that reads or changes what registering does (the song IDs, the cache, the
+        #  songs being downloaded again) holds it too.
+        self._registration_lock = RLock()
+
+        self._metrics = MetricsRegistry()
+        self._queue_wait_seconds = self._metrics.histogram(
+            "request_queue_wait_seconds", "Time from a request being received until a downloader started on it.")
+        self._download_seconds = self._metrics.histogram(
+            "download_seconds", "Time spent downloading a song, or until it was playable in progressive mode.")
+        self._registration_delay_seconds = self._metrics.histogram(
+            "registration_delay_seconds", "Time from a download finishing until the song was registered.")
+        self._registered_to_playing_seconds = self._metrics.histogram(
+            "registered_to_playing_seconds", "Time from a song being registered until it started playing.")
+        self._request_to_playing_seconds = self._metrics.histogram(
+            "request_to_playing_seconds", "Time from a request being received until the song started playing.")
+        self._metrics.gauge("receive_queue_depth", "Requests waiting for a downloader.",
+                            lambda: len(self._scheduler))
+        self._metrics.gauge("downloaded_queue_depth", "Downloads waiting to be registered.",
+                            lambda: self._downloaded_queue.qsize())
+        self._metrics.gauge("pending_registrations", "Downloads held back until earlier requests finish.",
+                            lambda: len(self._pending_registrations))
+        self._metrics.gauge("songs_registered", "Songs that have been registered.",
+                            lambda: len(self._available_song_ids), is_counter=True)
+        self._metrics.gauge("songs_cached", "Songs in the download cache.", lambda: len(self._cache))
+        self._metrics.gauge("duplicate_requests", "Requests dropped because the song was already requested.",
+                            lambda: self.duplicates_suppressed, is_counter=True)
+        self._metrics.gauge("shed_requests", "Requests dropped because the receive queue stayed full.",
+                            lambda: self.requests_shed, is_counter=True)
+        self._metrics.gauge("dead_letters", "Requests that failed to download, even after retrying.",
+                            lambda: self.dead_letter_count, is_counter=True)
+        self._metrics.gauge("peer_copies", "Songs copied from a peer instead of being downloaded.",
+                            lambda: self.peer_copies, is_counter=True)
+        self._metrics.gauge("worker_restarts", "Receiver and downloader processes restarted after dying.",
+                            lambda: self.worker_restarts, is_counter=True)
+        # The (received, registered) times of registered songs that haven't been played yet.
+        self._unplayed_times: Dict[int, Tuple[float, float]] = {}
+
+        self._download_workers = download_workers
         # So processing of receiving and downloading doesn't bog down the main process.
         # Since it's mostly IO, threads should work here as well, but multiprocessing will allow for more parallelism.
-        self._receive_process = self._new_receiver_process()
-        self._download_process = self._new_downloader_process()
+        #  AsyncSongService does it that way instead.
+        # Each is restarted by the supervisor thread if it dies, without disturbing the others or the player.
+        self._receive_process: Optional[SupervisedProcess] = None
+        self._download_processes: List[SupervisedProcess] = []
+        self._supervisor_thread: Optional[Thread] = None
+        self._stopping = Event()
+        self._warm_up_thread: Optional[Thread] = None
+        # The queues to and from the processes, made along with them in _start_workers.
+        self._receive_queue: Optional[Queue] = None
+        self._play_next_queue: Optional[Queue] = None
+        self._failed_downloads: Optional[Queue] = None
+        self._work_queues: List[Queue] = []
+        self._finished_queues: List[Queue] = []
+        # The request each downloader is working on, so that it can be reported as failed if the process dies, along
+        #  with its dispatch number. Requests are reported back as finished under their number, so that a report left
+        #  over from a process that died can't be taken for the current request's.
+        # Held while they, or the work queues, are changed, since a dead downloader's request is failed by the
+        #  supervisor thread while its dispatcher thread is waiting on it.
+        self._in_flight: List[Optional[Tuple[int, Request]]] = [None] * download_workers
+        self._dispatch_counts: List[int] = [0] * download_workers
+        self._in_flight_lock = Lock()
+        self._dispatch_threads: List[Thread] = []
+
+    def _new_queue(self) -> Queue:
+        """Makes a queue that the worker processes can use. AsyncSongService's workers are threads instead."""
+        return Queue()
+
+    def _new_counter(self, typecode: str) -> Value:
+        """Makes a counter that the worker processes can share, starting at 0."""
+        return Value(typecode, 0)
 
     def _new_receiver_process(self) -> Process:
         """Creates and returns a new process that will put messages (video IDs) into the passed queue as they come in.
         The process is not started."""
 
-        def callback(client, user_data, message):
-            # Can block if the queue is full.
-            self._receive_queue.put(message.payload.decode(PAYLOAD_ENCODING))
+        def queue_request(request: Request, cached: bool, deadline: float) -> bool:
+            if cached:  # No need to involve the downloaders.
+                self._downloaded_queue.put(request)
+                return True
+            if request[0] == PLAY_NEXT:
+                self._play_next_queue.put(request)
+                return True
+            try:
+                self._receive_queue.put(request, timeout=max(0.0, deadline - monotonic()))
+                return True
+            except Full:
+                return False
 
         def receive_incoming_messages():
             message_logger = setup_logger("messages", "messages.log")
+            intake = RequestIntake(queue_request, self._next_sequence_number, self._duplicates_suppressed,
+                                   self._requests_shed, message_logger, self._playable_extensions)
+
+            def on_payload(payload: bytes) -> None:
+                try:
+                    while True:
+                        intake.forget(self._failed_downloads.get_nowait())
+                except Empty:
+                    pass
+                intake.handle_message(payload)
+
             try:
-                # If all instances have the same ID and this process gets stuck open somehow, it will cause problems as
-                # soon as another client with the same client ID connects (reconnecting loop between two processes).
-                randomized_client_id = f"{CLIENT_ID_BASE}_{''.join(choices(ascii_letters, k=CLIENT_ID_POST_LENGTH))}"
-                auth = {"username": CONFIG.username, "password": CONFIG.password}
-                # Blocks forever.
-                subscribe_with_callback(callback=callback,
-                                        topics=[CONFIG.topic],
-                                        hostname=CONFIG.host,
-                                        port=CONFIG.port,
-                                        client_id=randomized_client_id,
-                                        auth=auth,
-                                        tls={"tls_version": ssl.PROTOCOL_TLS})
+                client = new_mqtt_client(on_payload, message_logger)
+                client.connect(get_config().host, get_config().port)
+                # Blocks forever, reconnecting whenever the connection drops.
+                client.loop_forever()
             except ConnectionRefusedError as e:
                 message_logger.warning("Could not contact the MQTT server.")
                 # Just to give a slightly cleaner message to the user.
@@ -95,17 +521,19 @@ class SongService:
 
         return Process(target=receive_incoming_messages, daemon=True)
 
-    def _new_downloader_process(self) -> Process:
+    def _new_downloader_process(self, worker: int) -> Process:
+        work_queue, finished_queue = self._work_queues[worker], self._finished_queues[worker]
+
         def process_video_requests():
             dl_logger = setup_logger("download", "download.log")
-            youtube_id = None  # To make the static analyzer happy in the except block.
             try:
+                downloader = self._new_downloader()
+                downloader.warm_up()
                 while True:
-                    youtube_id = self._receive_queue.get()
-                    download_audio(youtube_id, DOWNLOAD_DIRECTORY)  # A long, blocking call
-                    self._downloaded_queue.put(youtube_id)
-            except YoutubeDLError as e:
-                dl_logger.warning(f"Error downloading video ID {youtube_id}: {e}")
+                    dispatch_number, request, peer_holders = work_queue.get()
+                    if not self._download(request, downloader, dl_logger, peer_holders):
+                        self._failed_downloads.put(request[1])
+                    finished_queue.put(dispatch_number)
             except Exception as e:
                 dl_logger.warning(f"Unknown exception: {e}")
                 raise type(e)(f"Unknown Exception: {e}") from e
@@ -114,29 +542,350 @@ class SongService:
 
         return Process(target=process_video_requests, daemon=True)
 
+    def _dispatch_forever(self, worker: int) -> None:
+        """Hands the given downloader the most needed request whenever it's idle, until the service is stopped."""
+        while True:
+            request = self._scheduler.take()
+            if request is None:
+                return
+            # Who announced having the song is only known in this process, so it's sent along with the request.
+            peer_holders = self._peer_holders(request[1])
+            with self._in_flight_lock:
+                self._dispatch_counts[worker] += 1
+                dispatch_number = self._dispatch_counts[worker]
+                self._in_flight[worker] = (dispatch_number, request)
+                self._work_queues[worker].put((dispatch_number, request, peer_holders))
+            finished = self._finished_queues[worker].get()
+            while finished is not None and finished != dispatch_number:  # Left over from a dead downloader.
+                finished = self._finished_queues[worker].get()
+            with self._in_flight_lock:
+                self._in_flight[worker] = None
+            self._scheduler.done(request)
+            if finished is None:  # Stopping.
+                return
+
+    def _receive_forever(self, receive_queue: Queue, wait_for_room: bool) -> None:
+        """Moves received requests into the scheduler, until the service is stopped."""
+        while not self._stopping.is_set():
+            if wait_for_room and not self._scheduler.wait_for_room():
+                return
+            try:
+                request = receive_queue.get(timeout=SUPERVISOR_INTERVAL_SECS)
+            except Empty:
+                continue
+            if request is not None:  # None is only sent to wake this up when stopping.
+                self._scheduler.add(request)
+
+    def _fail_in_flight(self, worker: int) -> None:
+        """Reports the request that a dead downloader was working on as failed, so that the requests after it aren't
+        held back forever."""
+        with self._in_flight_lock:
+            # A request the process died before taking would otherwise be downloaded by its replacement as well.
+            try:
+                while True:
+                    self._work_queues[worker].get_nowait()
+            except Empty:
+                pass
+            in_flight = self._in_flight[worker]
+            if in_flight is None:
+                return
+            self._in_flight[worker] = None
+            dispatch_number, request = in_flight
+            self._report_lost(request, "The downloader died.")
+            self._failed_downloads.put(request[1])
+            self._finished_queues[worker].put(dispatch_number)  # Frees up the dispatcher for the replacement process.
+
+    def _report_lost(self, request: Request, reason: str) -> None:
+        """Reports a request that its downloader stopped working on without reporting it as failed, so that the
+        requests after it aren't held back forever."""
+        sequence_number, youtube_id, times = request
+        self._dead_letter_queue.put(DeadLetter(youtube_id, reason, 1, False, time()))
+        self._downloaded_queue.put((sequence_number, None, times))
+
+    def _songs_until_needed(self, request: Request) -> int:
+        """Roughly how many songs will play before the requested one, going by where it is in the play queue.
+        Used to decide which request to download next."""
+        sequence_number, youtube_id, _ = request
+        cursor, queued = self._play_queue.cursor, len(self._play_queue)
+        if sequence_number == PLAY_NEXT:
+            return 0
+        elif sequence_number is None:  # Already registered, but evicted since.
+            song_id = self._available_song_ids.get_song_id_from_youtube_id(youtube_id)
+            position = None if song_id is None else self._play_queue.position_of(song_id)
+            if position is None or position < cursor:  # Only wanted again if the listener goes back.
+                return queued - cursor
+            return position - cursor
+        else:  # Queued at the end once every earlier request is registered, so it plays after them.
+            return max(0, queued - cursor - 1 + sequence_number - self._next_registration_number)
+
+    def _new_downloader(self) -> YoutubeDownloader:
+        """Each download worker keeps its own for as long as it runs."""
+        return YoutubeDownloader(self._transcode)
+
+    def _peer_holders(self, youtube_id: str) -> List[Peer]:
+        return [] if self._peer_server is None else self._peer_server.holders_of(youtube_id)
+
+    def _download(self, request: Request, downloader: YoutubeDownloader, dl_logger: Logger,
+                  peer_holders: Sequence[Peer] = ()) -> bool:
+        """Downloads the requested song, and reports it on the downloaded queue. A long, blocking call, which retries
+        transient failures. Never raises for a failed download, so that one bad request can't stop the downloader.
+        peer_holders are the peers known to have the song already, which are asked for it first.
+        Returns whether the download succeeded."""
+        sequence_number, youtube_id, times = request
+        times = times._replace(download_started=time())
+        reported = False
+
+        def report_playable():
+            nonlocal reported
+            reported = True
+            self._downloaded_queue.put((sequence_number, youtube_id, times._replace(downloaded=time())))
+
+        if self._peers and self._copy_from_peers(youtube_id, peer_holders):
+            report_playable()
+            self._finish_download(youtube_id, dl_logger)
+            return True
+
+        delay = DOWNLOAD_RETRY_MIN_DELAY_SECS
+        for attempt in range(1, DOWNLOAD_MAX_ATTEMPTS + 1):
+            try:
+                if self._progressive:
+                    downloader.stream_audio(youtube_id, _song_path(youtube_id), PROGRESSIVE_PLAYABLE_BYTES,
+                                            report_playable)
+                    # So that the finished song gets cached. Sent before indexing, since the partial file is gone.
+                    self._downloaded_queue.put((None, youtube_id, times._replace(downloaded=time())))
+                else:
+                    downloader.download_audio(youtube_id, DOWNLOAD_DIRECTORY)
+                    report_playable()
+            except Exception as e:
+                error = e
+            else:
+                self._finish_download(youtube_id, dl_logger)
+                return True
+            permanent = is_permanent_error(error)
+            # Once part of a progressive download has been played, starting over would play a different song.
+            if permanent or reported or attempt == DOWNLOAD_MAX_ATTEMPTS:
+                break
+            dl_logger.warning(f"Attempt {attempt} at downloading video ID {youtube_id} failed: {error}. "
+                              f"Retrying in {delay}s.")
+            sleep(delay)
+            delay = min(delay * 2, DOWNLOAD_RETRY_MAX_DELAY_SECS)
+
+        dl_logger.warning(f"Giving up on downloading video ID {youtube_id} after {attempt} attempts: {error}")
+        self._dead_letter_queue.put(DeadLetter(youtube_id, str(error), attempt, permanent, time()))
+        if not reported:
+            # Still reported so that the requests received after this one aren't held back forever.
+            self._downloaded_queue.put((sequence_number, None, times))
+        return False
+
+    def _copy_from_peers(self, youtube_id: str, peer_holders: Sequence[Peer]) -> bool:
+        """Whether the song could be copied from a peer, in a container this node can play."""
+        if self._transcode or self._progressive:
+            extensions = (MUSIC_EXTENSION,)
+        else:  # The source containers are preferred, since they're what this node would have downloaded.
+            extensions = (*SOURCE_EXTENSIONS, MUSIC_EXTENSION)
+        if copy_from_peers(youtube_id, extensions, Path(DOWNLOAD_DIRECTORY), self._peers, peer_holders) is None:
+            return False
+        with self._peer_copies.get_lock():
+            self._peer_copies.value += 1
+        return True
+
+    def _finish_download(self, youtube_id: str, dl_logger: Logger) -> None:
+        """Done after the song has been reported, so that it doesn't delay it. A song played before it's indexed loads
+        the index when it's first seeked in. Failing to is only logged, since the song was downloaded either way."""
+        try:
+            if os.path.isfile(_song_path(youtube_id)):  # Untranscoded songs are seeked in by time anyway.
+                index_song(_song_path(youtube_id))
+            self._announce(youtube_id)
+        except Exception as e:
+            dl_logger.warning(f"Could not finish up after downloading video ID {youtube_id}: {e}")
+
+    def _announce(self, youtube_id: str) -> None:
+        if self._peer_port is not None:
+            announce(youtube_id, self._peer_port, self._peers)
+
     def _process_downloaded_queue(self):
         """An unfortunate consequence of multiprocessing. It would be difficult to handle this in child process due to
         IPC making copies of objects when sending them between processes.
         Should be called before any operation that uses the ID cache."""
-        try:
-            while not self._downloaded_queue.empty():
-                downloaded_youtube_id = self._downloaded_queue.get()
-                self._available_song_ids.register_song(downloaded_youtube_id)
-        except OSError as e:
-            # TODO: .empty() can cause an "handle is closed" error during termination.
-            #  Really, termination should be more controlled to ensure that everything shuts down in the correct order.
-            service_logger.warning(e)
+        with self._registration_lock:
+            try:
+                while True:
+                    self._accept_downloaded(*self._downloaded_queue.get_nowait())
+            except Empty:
+                pass
+            except OSError as e:
+                # TODO: The queue can cause an "handle is closed" error during termination.
+                #  Really, termination should be more controlled to ensure that everything shuts down in the correct
+                #  order.
+                service_logger.warning(e)
+
+            self._register_pending_in_order()
+
+    def _accept_downloaded(self, sequence_number: Optional[int], youtube_id: Optional[str],
+                           times: RequestTimes) -> None:
+        if sequence_number is None:
+            self._redownloading.discard(youtube_id)
+            if youtube_id is not None:
+                self._cache.touch(youtube_id)
+            return
+        if sequence_number != PLAY_NEXT and (sequence_number < self._next_registration_number
+                                             or sequence_number in self._pending_registrations):
+            # Reported twice, by a downloader that died just after reporting it, and by _fail_in_flight, in either
+            #  order. The first report stands.
+            if youtube_id is not None:
+                self._cache.touch(youtube_id)  # Kept, so it counts towards the cache's quota.
+            return
+        if youtube_id is not None and times.download_started is not None:  # Cache hits skip the downloaders.
+            self._queue_wait_seconds.observe(times.download_started - times.received)
+            self._download_seconds.observe(times.downloaded - times.download_started)
+        if sequence_number == PLAY_NEXT:
+            if youtube_id is not None:  # Nothing to do if it failed, since nothing waits for it.
+                self._play_queue.play_next(self._register(youtube_id, times))
+        else:
+            self._pending_registrations[sequence_number] = (youtube_id, times)
+
+    def _register_pending_in_order(self) -> None:
+        """Registers every held download that no longer has an earlier request outstanding."""
+        while self._next_registration_number in self._pending_registrations:
+            youtube_id, times = self._pending_registrations.pop(self._next_registration_number)
+            self._next_registration_number += 1
+            if youtube_id is not None:  # None marks a failed download.
+                self._register(youtube_id, times)
+
+    def _register(self, youtube_id: str, times: RequestTimes) -> int:
+        """Returns the song's ID, which is an existing one if the song was registered before (possibly in an earlier
+        run). The song is queued at the end of the play queue, unless it's already queued and hasn't been played yet."""
+        registered = time()
+        song_id = self._available_song_ids.register_song(youtube_id)
+        position = self._play_queue.position_of(song_id)
+        if position is None or position < self._play_queue.cursor:
+            if position is None:
+                self._play_queue.append(song_id)
+            else:  # Requested again after it was played, so it's played again.
+                self._play_queue.move(position, len(self._play_queue) - 1)
+            self._unplayed_times[song_id] = (times.received, registered)
+        self._registration_delay_seconds.observe(registered - (times.downloaded or times.received))
+        self._cache.touch(youtube_id)
+        for evicted_id in self._cache.evict(self._protected_youtube_ids()):
+            remove_seek_index(_song_path(evicted_id))
+        return song_id
+
+    def _protected_youtube_ids(self) -> Set[str]:
+        """The songs around the current song in the play queue, which shouldn't be evicted from the cache since
+        they're likely to be played soon."""
+        youtube_ids = (self._available_song_ids.get_youtube_id_from_song_id(song_id)
+                       for song_id in self._play_queue.around_cursor(CACHE_PROTECTED_WINDOW))
+        return {youtube_id for youtube_id in youtube_ids if youtube_id is not None}
+
+    def wait_for_song(self, after_song_id: int, timeout: Optional[float] = None) -> bool:
+        """Blocks until a song after the given song ID is registered, or until the timeout elapses. Returns whether
+        such a song is available."""
+        return self._wait_for(lambda: len(self) > after_song_id + 1, timeout)
+
+    def wait_for_next_song(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until there's a song after the current one in the play queue, or until the timeout elapses. Returns
+        whether there is one."""
+        return self._wait_for(lambda: self.play_queue.peek_next() is not None, timeout)
+
+    def wait_for_current_song(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until the current song in the play queue can be played, or until the timeout elapses. Before
+        anything has been played, waits for a song to start with instead. Returns whether there's a song to play."""
+        return self._wait_for(self._current_song_playable, timeout)
+
+    def _current_song_playable(self) -> bool:
+        play_queue = self.play_queue
+        song_id = play_queue.current
+        if song_id is None:
+            return play_queue.peek_next() is not None
+        with self._registration_lock:
+            youtube_id = self._available_song_ids.get_youtube_id_from_song_id(song_id)
+            return youtube_id is not None and (self._on_disk(youtube_id) or (
+                    self._progressive and os.path.isfile(partial_path(_song_path(youtube_id)))))
+
+    def _on_disk(self, youtube_id: str) -> bool:
+        """Whether the song's file is there, including if it just finished downloading and isn't in the cache yet."""
+        return youtube_id in self._cache or self._cache.path_for(youtube_id) is not None
+
+    def _wait_for(self, condition: Callable[[], bool], timeout: Optional[float]) -> bool:
+        """Wakes as soon as a finished download is registered to check the condition again."""
+        deadline = None if timeout is None else monotonic() + timeout
+        while not condition():
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                downloaded = self._downloaded_queue.get(timeout=remaining)
+            except Empty:
+                return False
+            with self._registration_lock:
+                self._accept_downloaded(*downloaded)
+                self._register_pending_in_order()
+        return True
+
+    def report_song_started(self, song_id: int) -> None:
+        """Tells the service that a song has started playing, for the end-to-end latency metrics."""
+        with self._registration_lock:
+            times = self._unplayed_times.pop(song_id, None)
+        if times is not None:
+            received, registered = times
+            now = time()
+            self._registered_to_playing_seconds.observe(now - registered)
+            self._request_to_playing_seconds.observe(now - received)
+
+    def set_playback_position(self, song_id: int) -> None:
+        """Tells the service which song is currently being played, after the play queue's cursor moved to it.
+        The song is saved, so playback can resume from it after a restart."""
+        self._available_song_ids.save_playback_position(song_id)
+        self._scheduler.reprioritize()
+
+    @property
+    def play_queue(self) -> PlayQueue:
+        """The order songs are played in, including every song registered so far."""
+        self._process_downloaded_queue()
+        return self._play_queue
+
+    @property
+    def saved_playback_position(self) -> Optional[int]:
+        """The song that was being played when the service last ran. None if nothing has been played yet."""
+        position = self._available_song_ids.saved_playback_position
+        # The position is saved separately from the songs, so it may be ahead of a history that lost its last record.
+        return position if position is not None and position < len(self._available_song_ids) else None
 
     def get_song_path_by_song_id(self, song_id: int) -> Optional[str]:
         """Gets the youtube ID at the given song ID, if that song ID is available.
         If no such song ID exists, None is returned."""
-        self._process_downloaded_queue()
-        youtube_id = self._available_song_ids.get_youtube_id_from_song_id(song_id)
+        with self._registration_lock:
+            self._process_downloaded_queue()
+            youtube_id = self._available_song_ids.get_youtube_id_from_song_id(song_id)
 
-        if youtube_id is None:
-            return None
-        else:
-            return _song_path(youtube_id)
+            if youtube_id is None:
+                return None
+            elif self._progressive and os.path.isfile(partial_path(_song_path(youtube_id))):
+                # Still downloading. It's played through a stream that follows the download.
+                return stream_while_growing(partial_path(_song_path(youtube_id)), _song_path(youtube_id))
+            elif not self._on_disk(youtube_id):
+                # Evicted while outside of the protected window. Getting it back is better than skipping it. (A song
+                #  that just finished downloading is on disk, but only added to the cache once its completion is
+                #  processed.)
+                if youtube_id not in self._redownloading:
+                    # Not worth blocking playback over if the queue is full. It's tried again the next time the song
+                    #  is wanted.
+                    if not self._queue_redownload((None, youtube_id, RequestTimes(time()))):
+                        return None
+                    service_logger.warning(f"Song {youtube_id} is no longer cached. Downloading it again.")
+                    self._redownloading.add(youtube_id)
+                    self._cache.forget(youtube_id)
+                return None
+            else:
+                self._cache.touch(youtube_id)
+                return str(self._cache.path_for(youtube_id))
+
+    def _queue_redownload(self, request: Request) -> bool:
+        """Queues the request without waiting. Returns whether there was room for it."""
+        if not self._scheduler.has_room():
+            return False
+        self._scheduler.add(request)
+        return True
 
     def __iter__(self) -> Iterator[Tuple[int, str]]:
         """Returns an iterator of all downloaded songs as tuples of (song_id, youtube_id)."""
@@ -148,27 +897,150 @@ class SongService:
         self._process_downloaded_queue()
         return len(self._available_song_ids)
 
+    @property
+    def metrics(self) -> MetricsRegistry:
+        """The service's metrics, for exporting with a MetricsExporter."""
+        return self._metrics
+
+    @property
+    def duplicates_suppressed(self) -> int:
+        """How many requests were dropped because the song was already requested."""
+        return self._duplicates_suppressed.value
+
+    @property
+    def requests_shed(self) -> int:
+        """How many requests were dropped because the downloaders were too far behind to queue them."""
+        return self._requests_shed.value
+
+    @property
+    def dead_letters(self) -> List[DeadLetter]:
+        """The most recent requests that failed to download, even after retrying. Oldest first."""
+        self._process_dead_letter_queue()
+        return list(self._dead_letters)
+
+    @property
+    def dead_letter_count(self) -> int:
+        """How many requests failed to download, including those no longer in dead_letters."""
+        self._process_dead_letter_queue()
+        return self._dead_letter_count
+
+    def _process_dead_letter_queue(self) -> None:
+        try:
+            while True:
+                self._dead_letters.append(self._dead_letter_queue.get_nowait())
+                self._dead_letter_count += 1
+        except Empty:
+            pass
+
+    @property
+    def peer_copies(self) -> int:
+        """How many songs were copied from a peer instead of being downloaded."""
+        return self._peer_copies.value
+
+    @property
+    def worker_restarts(self) -> int:
+        """How many times a receiver or downloader process was restarted after dying."""
+        return sum(supervised.restarts for supervised in [self._receive_process, *self._download_processes]
+                   if supervised is not None)
+
     def song_available(self) -> bool:
         return len(self) > 0
 
-    def start_service(self) -> None:
-        """Starts the service. Must be called before any other methods."""
-        self._receive_process.start()
-        self._download_process.start()
+    def start_service(self, in_background: bool = False) -> None:
+        """Starts the service. Must be called before any other methods.
+        If in_background, only what's needed to play songs that were already downloaded is done before returning,
+        and the receiver and downloaders are started on a background thread."""
+        self._cache.load()
+        startup_timer.mark("cache loaded")
+        if self._peer_port is not None:
+            self._peer_server = PeerCacheServer(Path(DOWNLOAD_DIRECTORY), self._peer_port,
+                                                lambda youtube_id: YOUTUBE_ID_PATTERN.fullmatch(youtube_id) is not None)
+            self._peer_port = self._peer_server.port  # The one picked, if it was 0.
+        if in_background:
+            self._warm_up_thread = Thread(target=self._start_workers, daemon=True)
+            self._warm_up_thread.start()
+        else:
+            self._start_workers()
+
+    def _start_workers(self) -> None:
+        # The queue of what requests have been received. Moved into the scheduler as soon as there's room in it.
+        self._receive_queue = Queue(RECEIVE_QUEUE_MAX_SIZE)
+        # Play next requests skip the receive queue, so that they don't wait behind a backlog of other requests.
+        self._play_next_queue = Queue()
+        # The receiver drops requests for songs it has already accepted. Failed downloads are reported back to it
+        #  through this queue so that they can be requested again.
+        self._failed_downloads = Queue()
+        # Each downloader process is handed one request at a time by its own dispatcher thread, through its own work
+        #  queue, and reports back on its own finished queue once done, so that what's downloaded next is always
+        #  decided by the scheduler at the last moment.
+        self._work_queues = [Queue() for _ in range(self._download_workers)]
+        self._finished_queues = [Queue() for _ in range(self._download_workers)]
+
+        self._receive_process = SupervisedProcess("receiver", self._new_receiver_process)
+        self._download_processes = [
+            SupervisedProcess(f"downloader {worker}", lambda worker=worker: self._new_downloader_process(worker),
+                              lambda worker=worker: self._fail_in_flight(worker))
+            for worker in range(self._download_workers)]
+        for supervised in [self._receive_process, *self._download_processes]:
+            supervised.start()
+        self._dispatch_threads = [
+            Thread(target=self._receive_forever, args=(self._receive_queue, True), daemon=True),
+            Thread(target=self._receive_forever, args=(self._play_next_queue, False), daemon=True),
+            *(Thread(target=self._dispatch_forever, args=(worker,), daemon=True)
+              for worker in range(self._download_workers))]
+        for thread in self._dispatch_threads:
+            thread.start()
+        self._supervisor_thread = Thread(target=self._supervise, daemon=True)
+        self._supervisor_thread.start()
+        startup_timer.mark("receiver and downloaders started")
+
+    def _supervise(self) -> None:
+        """Restarts whichever child processes die, until the service is terminated."""
+        while not self._stopping.wait(SUPERVISOR_INTERVAL_SECS):
+            for supervised in [self._receive_process, *self._download_processes]:
+                try:
+                    supervised.check()
+                except Exception as e:  # E.g. out of memory. Tried again on the next check.
+                    service_logger.warning(f"Could not restart the {supervised.name}: {e}")
 
     def terminate_service(self) -> None:
         """Closes all resources associated with the service. Must be called for a clean shutdown."""
-        self._receive_process.terminate()
-        self._download_process.terminate()
-        self._receive_process.join()
-        self._download_process.join()
-        self._receive_process.close()
-        self._download_process.close()
+        service_logger.info(f"Suppressed {self.duplicates_suppressed} duplicate requests. "
+                            f"Shed {self.requests_shed} requests.")
+        if self._warm_up_thread is not None:
+            self._warm_up_thread.join()
+        self._stop_workers()
+        if self._peer_server is not None:
+            self._peer_server.close()
+        self._cache.flush()
+        self._available_song_ids.close()
 
-        self._receive_queue.close()
-        self._downloaded_queue.close()
+    def _stop_workers(self) -> None:
+        self._stopping.set()
+        self._scheduler.close()
+        if self._supervisor_thread is not None:
+            self._supervisor_thread.join()
+        # None if the workers were never started.
+        receive_queues = [queue for queue in [self._receive_queue, self._play_next_queue] if queue is not None]
+        for queue in [*receive_queues, *self._finished_queues]:
+            try:
+                queue.put_nowait(None)  # Wakes whatever is waiting on it.
+            except Full:  # Then nothing is waiting on it.
+                pass
+        for thread in self._dispatch_threads:
+            thread.join()
+        supervised_processes = [supervised for supervised in [self._receive_process, *self._download_processes]
+                                if supervised is not None]
+        for supervised in supervised_processes:
+            supervised.stop()
+        for supervised in supervised_processes:
+            supervised.join()
 
-        _clear_downloaded()
+        for queue in [*receive_queues, self._downloaded_queue, self._dead_letter_queue, *self._work_queues,
+                      *self._finished_queues]:
+            queue.close()
+        if self._failed_downloads is not None:
+            self._failed_downloads.close()
 
     def __enter__(self) -> SongService:
         self.start_service()
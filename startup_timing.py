@@ -0,0 +1,35 @@
+from threading import Lock
+from time import monotonic
+from typing import List, Tuple
+
+from logging_util import setup_logger
+
+startup_logger = setup_logger("startup", "main.log")
+
+
+class StartupTimer:
+    """Records how long each phase of starting up took, measured from when the timer was created. Phases can be marked
+    from any thread, or from a forked child process."""
+    def __init__(self):
+        self._start = monotonic()
+        self._phases: List[Tuple[str, float]] = []
+        self._lock = Lock()
+
+    def mark(self, phase: str) -> None:
+        """Records that the phase has just finished, and logs how long it took to get there."""
+        elapsed = monotonic() - self._start
+        with self._lock:
+            previous = self._phases[-1][1] if self._phases else 0.0
+            self._phases.append((phase, elapsed))
+        startup_logger.info(f"Startup: {phase} at {elapsed:.3f}s (+{elapsed - previous:.3f}s)")
+
+    @property
+    def phases(self) -> List[Tuple[str, float]]:
+        """Each phase that's been marked, with how many seconds after the start it finished."""
+        with self._lock:
+            return list(self._phases)
+
+
+# Created as early as possible by being imported first. Monotonic time is shared between processes, so marks made in
+#  the service's child processes are measured from the same start.
+startup_timer = StartupTimer()
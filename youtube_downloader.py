@@ -1,9 +1,17 @@
-from os import PathLike
-from typing import Union
+from __future__ import annotations
 
-import youtube_dl
+import os
+import subprocess as sp
+import tempfile
+from collections import OrderedDict
+from copy import deepcopy
+from os import PathLike
+from time import sleep, monotonic
+from typing import Union, Callable, Tuple, Any, Dict
 from pathlib import PurePath
 
+# youtube_dl is imported where it's used, since importing it takes seconds on a Pi. See YoutubeDownloader.warm_up.
+
 AUDIO_DOWNLOAD_OPTIONS = \
     {'format': "worstaudio/worst",
      'postprocessors': [{
@@ -17,13 +25,151 @@ AUDIO_DOWNLOAD_OPTIONS = \
 
 BASE_URL = "https://www.youtube.com/watch?v="
 
+# Parts of youtube_dl's error messages for videos that will never download, however often the download is retried.
+#  Anything else (network errors, throttling, a failed transcode) is assumed to be transient.
+PERMANENT_ERROR_MARKERS = ("video unavailable", "private video", "this video is private", "has been removed",
+                           "copyright", "not available in your country", "sign in to confirm your age",
+                           "account associated with this video has been terminated", "incomplete youtube id",
+                           "is not a valid url", "unsupported url")
+
+
+# Parts of youtube_dl's error messages that mean the format URLs extracted for a video stopped working (they expire, and
+#  are tied to the address that extracted them), so that it has to be extracted again.
+STALE_METADATA_MARKERS = ("http error 403", "http error 404", "http error 410", "403 forbidden")
+
+# How long what was extracted about a video (its formats, and the URLs to download them from) is reused for. YouTube's
+#  format URLs last about six hours.
+METADATA_TTL_SECS = 30 * 60
+# How many videos' metadata is kept, at most. Each is tens of KB.
+METADATA_CACHE_MAX_SIZE = 64
+
+# How often to check how much of a streamed song has been written.
+STREAM_PROGRESS_POLL_SECS = 0.2
+STREAM_BITRATE = "192k"
+
+Info = Dict[str, Any]
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """Whether retrying the download that raised the error is pointless."""
+    message = str(error).lower()
+    return any(marker in message for marker in PERMANENT_ERROR_MARKERS)
+
+
+def is_stale_metadata_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return any(marker in message for marker in STALE_METADATA_MARKERS)
+
+
+def partial_path(final_path: str) -> str:
+    """Where a song is written while it's still being streamed in."""
+    return final_path + ".part"
+
+
+class YoutubeDownloader:
+    """Downloads through a single YoutubeDL that lives as long as the downloader does, so that its extractors, cookies
+    and HTTP opener are set up once rather than for every song. What's extracted about each video is kept for
+    METADATA_TTL_SECS, so that retrying a download or requesting the song again goes straight to downloading it.
+    Not thread-safe. Each download worker needs its own."""
+    def __init__(self, transcode: bool = True):
+        """If transcode is False, the audio is left in the container it was downloaded in (usually webm/Opus or
+        m4a/AAC) instead of being converted to MP3, which saves the most CPU intensive step."""
+        self._transcode = transcode
+        self._youtube_dl = None
+        # The (expiry, unprocessed info) of each video. Oldest first, which is also the order they expire in.
+        self._metadata: OrderedDict[str, Tuple[float, Info]] = OrderedDict()
+
+    def warm_up(self) -> None:
+        """Imports youtube_dl and sets up the session ahead of the first download, so that the download isn't slowed
+        down by it."""
+        self._session()
+
+    def _session(self):
+        if self._youtube_dl is None:
+            import youtube_dl
+            # Making a copy so the global settings aren't mutated.
+            options = dict(AUDIO_DOWNLOAD_OPTIONS)
+            if not self._transcode:
+                del options['postprocessors']
+            self._youtube_dl = youtube_dl.YoutubeDL(options)
+        return self._youtube_dl
+
+    def _extract(self, video_id: str) -> Info:
+        """Contacts YouTube. The info's format still has to be picked by processing it."""
+        return self._session().extract_info(BASE_URL + video_id, download=False, process=False)
+
+    def _extraction(self, video_id: str) -> Info:
+        now = monotonic()
+        while self._metadata and next(iter(self._metadata.values()))[0] <= now:
+            self._metadata.popitem(last=False)
+        cached = self._metadata.get(video_id)
+        if cached is not None:
+            return cached[1]
+        info = self._extract(video_id)
+        self._metadata[video_id] = (now + METADATA_TTL_SECS, info)
+        if len(self._metadata) > METADATA_CACHE_MAX_SIZE:
+            self._metadata.popitem(last=False)
+        return info
+
+    def _process(self, video_id: str, download: bool) -> Info:
+        try:
+            # Processing adds to the info it's given, so the cached copy is left alone.
+            return self._session().process_ie_result(deepcopy(self._extraction(video_id)), download=download)
+        except Exception as e:
+            if is_stale_metadata_error(e):
+                self._metadata.pop(video_id, None)
+            raise
+
+    def extract_info(self, video_id: str) -> Info:
+        """The video's info, with the format to download picked."""
+        return self._process(video_id, download=False)
+
+    def download_audio(self, video_id: str, download_directory: Union[str, bytes, PathLike]) -> None:
+        """Downloads the audio to the provided location. The filename matches the video ID."""
+        self._session().params['outtmpl'] = str(PurePath(download_directory) / "%(id)s.%(ext)s")
+        self._process(video_id, download=True)
+
+    def stream_audio(self, video_id: str, final_path: str, playable_bytes: int,
+                     on_playable: Callable[[], None]) -> None:
+        """Downloads and transcodes the audio in a single pass, writing it progressively to partial_path(final_path)
+        and moving it to final_path once finished.
+        on_playable is called once at least playable_bytes have been written (or when finished, for short songs), so
+        that playback of the partial file can start before the download ends."""
+        info = self.extract_info(video_id)
+        try:
+            stream_with_ffmpeg(info, final_path, playable_bytes, on_playable)
+        except Exception as e:
+            if is_stale_metadata_error(e):
+                self._metadata.pop(video_id, None)
+            raise
+
+
+def stream_with_ffmpeg(info: Info, final_path: str, playable_bytes: int, on_playable: Callable[[], None]) -> None:
+    """ffmpeg is run directly, instead of as a youtube_dl postprocessor, so that the song can be played while it's
+    still being transcoded. See YoutubeDownloader.stream_audio."""
+    from youtube_dl.utils import DownloadError
+    headers = "".join(f"{key}: {value}\r\n" for key, value in info.get('http_headers', {}).items())
+    writing_path = partial_path(final_path)
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+               "-headers", headers, "-i", info['url'],
+               "-vn", "-codec:a", "libmp3lame", "-b:a", STREAM_BITRATE, "-f", "mp3", writing_path]
+    # Its errors go to a file rather than a pipe, which nothing reads until it exits, and which it would block on
+    #  writing to once full.
+    with tempfile.TemporaryFile() as error_log:
+        transcoder = sp.Popen(command, stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=error_log)
+
+        playable = False
+        while transcoder.poll() is None:
+            if not playable and os.path.isfile(writing_path) and os.path.getsize(writing_path) >= playable_bytes:
+                playable = True
+                on_playable()
+            sleep(STREAM_PROGRESS_POLL_SECS)
 
-def download_audio(video_id: str, download_directory: Union[str, bytes, PathLike]) -> None:
-    """Downloads the audio to the provided location.
-    The filename matches the video ID."""
-    # Making a copy so the global settings aren't mutated.
-    options = dict(AUDIO_DOWNLOAD_OPTIONS)
-    save_path = str(PurePath(download_directory) / "%(id)s.%(ext)s")
-    options['outtmpl'] = save_path
-    with youtube_dl.YoutubeDL(options) as dl:
-        dl.download([BASE_URL + video_id])
\ No newline at end of file
+        if transcoder.returncode != 0:
+            if os.path.isfile(writing_path):
+                os.remove(writing_path)
+            error_log.seek(0)
+            raise DownloadError(f"ffmpeg failed: {error_log.read().decode(errors='replace').strip()}")
+    os.replace(writing_path, final_path)
+    if not playable:
+        on_playable()